@@ -0,0 +1,512 @@
+"""
+Micro-benchmarks of the proxy's hot paths.
+
+Every benchmark runs in isolation on responses captured from PrusaLink (see
+fixtures/) and is compared with the results recorded in baseline.json. The run fails
+when a benchmark lost more ops/sec or allocates more memory per operation than the
+thresholds allow.
+
+Usage:
+    python benchmarks/bench.py              Compare with the baseline
+    python benchmarks/bench.py --update     Record the results as the new baseline
+    python benchmarks/bench.py -k poll      Run the benchmarks matching a substring
+
+Ops/sec depend on the machine and its load, so every benchmark is compared relative to
+a reference workload measured in alternating rounds with it. Allocations and relative
+speeds differ between Python versions, so a baseline recorded with another Python
+version is not compared with; record a new one for that version instead.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Awaitable, Callable
+from itertools import cycle
+from pathlib import Path
+from typing import Any
+
+BENCHMARKS_DIR: Path = Path(__file__).resolve().parent
+FIXTURES_DIR: Path = BENCHMARKS_DIR / "fixtures"
+BASELINE_PATH: Path = BENCHMARKS_DIR / "baseline.json"
+
+# Keep the encryption key and caches out of the real state directory
+DATA_DIR: tempfile.TemporaryDirectory[str] = tempfile.TemporaryDirectory(
+    prefix="prusa-bench-"
+)
+os.environ["PRUSA_OCTOAPP_PROXY_DATA_DIR"] = DATA_DIR.name
+sys.path.insert(0, str(BENCHMARKS_DIR.parent / "src"))
+
+from data_poller import DataPoller
+from encryption import EncryptionHandler
+from gcode_analysis import GcodeAnalyzer
+from gcode_cache import GcodeCache
+from print_job import PrintJob
+from printer_status import PrinterState, PrinterStatus
+from websocket import WebSocketHandler
+
+# Shortest time a timed batch runs, the batch size is calibrated to reach it
+MIN_BATCH_TIME: float = 0.05
+
+# Timed batches per round, the median one counts
+REPEATS: int = 7
+
+# Rounds of timing the reference workload and the benchmark, the median speed relative
+# to the reference counts
+ROUNDS: int = 5
+
+# Operations measured for the allocations
+ALLOCATION_SAMPLES: int = 20
+
+# Share of the baseline ops/sec a benchmark may lose, relative to the reference workload.
+# Wide enough for load on a shared machine, narrow enough for a lost cache or a
+# quadratic lookup.
+OPS_TOLERANCE: float = 0.40
+
+# Share of the baseline peak bytes per operation a benchmark may add, plus a fixed
+# slack so small allocations do not fail the run on interpreter noise
+ALLOCATION_TOLERANCE: float = 0.25
+ALLOCATION_SLACK: int = 1024
+
+# Registry sizes PrintJob.get is measured at
+REGISTRY_SIZES: tuple[int, ...] = (10, 100, 1000)
+
+REFERENCE_PAYLOAD: Any = json.loads((FIXTURES_DIR / "status.json").read_text())
+
+
+def copy_tree(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: copy_tree(item) for key, item in value.items()}  # pyright: ignore[reportUnknownVariableType]
+    if isinstance(value, list):
+        return [copy_tree(item) for item in value]  # pyright: ignore[reportUnknownVariableType]
+    return value
+
+
+def reference() -> None:
+    """
+    Workload the machine speed is measured with, a copy of the status responses.
+
+    It runs in Python rather than in the C JSON codec, so it speeds up and slows down
+    with the interpreter like the benchmarks do.
+    """
+
+    _ = copy_tree(REFERENCE_PAYLOAD)
+
+
+def load_fixture(name: str) -> Any:
+    return json.loads((FIXTURES_DIR / name).read_text())
+
+
+class FixtureLink:
+    """
+    Serves the captured PrusaLink responses in turn. Every call parses the response
+    again, so each poll gets fresh dicts like it does from the printer.
+    """
+
+    def __init__(self, status: list[dict[str, Any]], job: list[dict[str, Any]]):
+        self._status = cycle([json.dumps(response) for response in status])
+        self._job = cycle([json.dumps(response) for response in job])
+
+    async def get_status(self) -> dict[str, Any] | None:
+        return json.loads(next(self._status))
+
+    async def get_job(self) -> dict[str, Any] | None:
+        return json.loads(next(self._job))
+
+
+def fixture_poller(status: list[dict[str, Any]] | None = None) -> DataPoller:
+    """
+    Create a DataPoller polling the captured responses, marked online.
+
+    Args:
+        status (list[dict[str, Any]] | None): The status responses, all captured ones by default.
+
+    Returns:
+        DataPoller: The DataPoller.
+    """
+
+    responses: list[dict[str, Any]] = (
+        load_fixture("status.json") if status is None else status
+    )
+    link = FixtureLink(responses, load_fixture("job.json"))
+    data_poller = DataPoller(link)  # pyright: ignore[reportArgumentType]
+    data_poller.online = True
+    return data_poller
+
+
+class SyncRunner:
+    """
+    Runs a synchronous operation.
+    """
+
+    def __init__(self, operation: Callable[[], Any]):
+        self.operation: Callable[[], Any] = operation
+
+    def batch(self, number: int) -> None:
+        for _ in range(number):
+            self.operation()
+
+    def peaks(self, number: int) -> list[int]:
+        peaks: list[int] = []
+        for _ in range(number):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            self.operation()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        return peaks
+
+
+class AsyncRunner:
+    """
+    Runs an async operation. The event loop is entered once per batch, so neither the
+    timings nor the allocations include starting it.
+    """
+
+    def __init__(self, operation: Callable[[], Awaitable[Any]]):
+        self.operation: Callable[[], Awaitable[Any]] = operation
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+
+    def batch(self, number: int) -> None:
+        async def batch() -> None:
+            for _ in range(number):
+                await self.operation()
+
+        self.loop.run_until_complete(batch())
+
+    def peaks(self, number: int) -> list[int]:
+        async def peaks() -> list[int]:
+            peaks: list[int] = []
+            for _ in range(number):
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                await self.operation()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            return peaks
+
+        return self.loop.run_until_complete(peaks())
+
+
+Runner = SyncRunner | AsyncRunner
+
+
+def bench_encrypt_notification() -> Runner:
+    payload = load_fixture("notification.json")
+    handler = EncryptionHandler()
+    return SyncRunner(lambda: handler.encrypt_notification(payload))
+
+
+def bench_ws_payload_status() -> Runner:
+    _ = fixture_poller()
+    handler = WebSocketHandler()
+    statuses = [
+        PrinterStatus(
+            state=PrinterState(printer["state"]),
+            temp_bed=float(printer["temp_bed"]),
+            temp_nozzle=float(printer["temp_nozzle"]),
+            target_bed=float(printer["target_bed"]),
+            target_nozzle=float(printer["target_nozzle"]),
+            z_height=float(printer["axis_z"]),
+            flow=float(printer["flow"]),
+            speed=float(printer["speed"]),
+            fan_hotend_rpm=int(printer["fan_hotend"]),
+            fan_print_rpm=int(printer["fan_print"]),
+        )
+        for printer in (status["printer"] for status in load_fixture("status.json"))
+    ]
+    updates = cycle(statuses)
+
+    async def operation() -> None:
+        await handler.handle_update(next(updates))
+
+    return AsyncRunner(operation)
+
+
+def bench_ws_payload_job() -> Runner:
+    directory = Path(DATA_DIR.name)
+    _ = GcodeCache(directory / "gcode", None)  # pyright: ignore[reportArgumentType]
+    _ = GcodeAnalyzer(directory / "analysis.json", None)  # pyright: ignore[reportArgumentType]
+    _ = fixture_poller()
+    handler = WebSocketHandler()
+
+    PrintJob._print_jobs.clear()  # pyright: ignore[reportPrivateUsage]
+    jobs = load_fixture("job.json")
+    print_job = PrintJob(jobs[0]["id"], True, 0.0, 0, 0, "", "", "")
+    # The arguments of PrintJob.update, in order
+    updates: cycle[tuple[bool, float, int, int, str, str, str]] = cycle(
+        [
+            (
+                True,
+                float(job["progress"]),
+                int(job["time_remaining"]),
+                int(job["time_printing"]),
+                str(job["file"]["display_name"]),
+                str(job["file"]["path"]),
+                str(job["file"]["name"]),
+            )
+            for job in jobs
+        ]
+    )
+
+    async def operation() -> None:
+        print_job.update(*next(updates))
+        await handler.handle_update(print_job)
+
+    return AsyncRunner(operation)
+
+
+def bench_poll_status() -> Runner:
+    data_poller = fixture_poller()
+    return AsyncRunner(data_poller._poll_status)  # pyright: ignore[reportPrivateUsage]
+
+
+def bench_poll_status_unchanged() -> Runner:
+    data_poller = fixture_poller(load_fixture("status.json")[:1])
+    return AsyncRunner(data_poller._poll_status)  # pyright: ignore[reportPrivateUsage]
+
+
+def bench_poll_job() -> Runner:
+    PrintJob._print_jobs.clear()  # pyright: ignore[reportPrivateUsage]
+    data_poller = fixture_poller()
+    return AsyncRunner(data_poller._poll_job)  # pyright: ignore[reportPrivateUsage]
+
+
+def bench_print_job_get(size: int) -> Callable[[], Runner]:
+    def setup() -> Runner:
+        PrintJob._print_jobs.clear()  # pyright: ignore[reportPrivateUsage]
+        for print_id in range(size):
+            _ = PrintJob(print_id, False, 100.0, 0, 3600, "job", "/usb", "JOB.BGC")
+
+        # A job that is not registered yet, as on the first poll of a new print
+        return SyncRunner(lambda: PrintJob.get(size))  # pyright: ignore[reportArgumentType]
+
+    return setup
+
+
+BENCHMARKS: dict[str, Callable[[], Runner]] = {
+    "encrypt_notification": bench_encrypt_notification,
+    "ws_payload_status": bench_ws_payload_status,
+    "ws_payload_job": bench_ws_payload_job,
+    "poll_status": bench_poll_status,
+    "poll_status_unchanged": bench_poll_status_unchanged,
+    "poll_job": bench_poll_job,
+    **{f"print_job_get[{size}]": bench_print_job_get(size) for size in REGISTRY_SIZES},
+}
+
+
+def measure(runner: Runner) -> dict[str, float]:
+    """
+    Measure the speed and the allocations of a benchmark.
+
+    Args:
+        runner (Runner): Runs the operation of the benchmark.
+
+    Returns:
+        dict[str, float]: The operations per second, those of the reference workload
+            in the same round, and the peak bytes allocated per operation.
+    """
+
+    reference_runner = SyncRunner(reference)
+    reference_number = calibrate(reference_runner)
+    number = calibrate(runner)
+
+    rounds = [
+        (time_batches(reference_runner, reference_number), time_batches(runner, number))
+        for _ in range(ROUNDS)
+    ]
+    # The round with the median relative speed, so both values come from one round
+    rounds.sort(key=lambda timing: timing[1] / timing[0])
+    reference_ops, ops = rounds[len(rounds) // 2]
+
+    tracemalloc.start()
+    try:
+        peaks = runner.peaks(ALLOCATION_SAMPLES)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "opsPerSecond": round(ops, 1),
+        "referenceOpsPerSecond": round(reference_ops, 1),
+        "peakBytes": int(statistics.median(peaks)),
+    }
+
+
+def calibrate(runner: Runner) -> int:
+    """
+    Warm up an operation and grow the batch until it runs long enough to time reliably.
+
+    Args:
+        runner (Runner): Runs the operation.
+
+    Returns:
+        int: The number of operations per batch.
+    """
+
+    number = 1
+    while True:
+        started = time.perf_counter()
+        runner.batch(number)
+        if time.perf_counter() - started >= MIN_BATCH_TIME:
+            return number
+        number *= 2
+
+
+def time_batches(runner: Runner, number: int) -> float:
+    """
+    Time an operation in batches.
+
+    Args:
+        runner (Runner): Runs the operation.
+        number (int): The number of operations per batch.
+
+    Returns:
+        float: The operations per second of the median batch.
+    """
+
+    timings: list[float] = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(REPEATS):
+            started = time.perf_counter()
+            runner.batch(number)
+            timings.append(time.perf_counter() - started)
+    finally:
+        gc.enable()
+
+    return number / statistics.median(timings)
+
+
+def expected_ops(result: dict[str, float], baseline: dict[str, float]) -> float:
+    """
+    Scale the baseline ops/sec to the machine speed the result was measured at.
+    """
+
+    return (
+        baseline["opsPerSecond"]
+        * result["referenceOpsPerSecond"]
+        / baseline["referenceOpsPerSecond"]
+    )
+
+
+def regressions(
+    name: str, result: dict[str, float], baseline: dict[str, float]
+) -> list[str]:
+    """
+    Compare a result with its baseline.
+
+    Args:
+        name (str): The name of the benchmark.
+        result (dict[str, float]): The measured result.
+        baseline (dict[str, float]): The recorded result.
+
+    Returns:
+        list[str]: A description of every threshold the result exceeds.
+    """
+
+    found: list[str] = []
+
+    expected = expected_ops(result, baseline)
+    if result["opsPerSecond"] < expected * (1 - OPS_TOLERANCE):
+        found.append(
+            f"{name}: {result['opsPerSecond']:.0f} ops/sec, "
+            + f"{expected:.0f} expected from the baseline "
+            + f"(minimum {expected * (1 - OPS_TOLERANCE):.0f})"
+        )
+
+    max_bytes = baseline["peakBytes"] * (1 + ALLOCATION_TOLERANCE) + ALLOCATION_SLACK
+    if result["peakBytes"] > max_bytes:
+        found.append(
+            f"{name}: {result['peakBytes']:.0f} peak bytes/op, "
+            + f"baseline {baseline['peakBytes']:.0f} (maximum {max_bytes:.0f})"
+        )
+
+    return found
+
+
+def python_release(version: str) -> str:
+    """
+    Strip the patch level from a Python version, it does not change the results.
+    """
+
+    return ".".join(version.split(".")[:2])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=(__doc__ or "").split("\n\n")[0].strip()
+    )
+    _ = parser.add_argument(
+        "--update", action="store_true", help="record the results as the new baseline"
+    )
+    _ = parser.add_argument(
+        "-k", dest="pattern", default="", help="run the benchmarks matching a substring"
+    )
+    args = parser.parse_args()
+
+    baseline: dict[str, Any] = (
+        json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    )
+    recorded: dict[str, dict[str, float]] = baseline.get("benchmarks", {})
+
+    python = platform.python_version()
+    if recorded and python_release(baseline.get("python", "")) != python_release(
+        python
+    ):
+        print(
+            f"Baseline was recorded with Python {baseline.get('python')}, "
+            + f"not comparing with it on Python {python}. "
+            + "Record a baseline for it with --update.\n"
+        )
+        recorded = {}
+
+    results: dict[str, dict[str, float]] = {}
+    failures: list[str] = []
+
+    print(f"{'benchmark':<26} {'ops/sec':>12} {'expected':>12} {'peak B/op':>10}")
+    for name, setup in BENCHMARKS.items():
+        if args.pattern not in name:
+            continue
+
+        result = results[name] = measure(setup())
+        previous = recorded.get(name)
+        print(
+            f"{name:<26} {result['opsPerSecond']:>12.0f} "
+            + f"{expected_ops(result, previous) if previous else float('nan'):>12.0f} "
+            + f"{result['peakBytes']:>10.0f}"
+        )
+        if previous is not None:
+            failures += regressions(name, result, previous)
+
+    if args.update:
+        _ = BASELINE_PATH.write_text(
+            json.dumps(
+                {
+                    "python": python,
+                    "machine": platform.machine(),
+                    "benchmarks": recorded | results,
+                },
+                indent=4,
+            )
+            + "\n"
+        )
+        print(f"Baseline written to {BASELINE_PATH}")
+        return
+
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
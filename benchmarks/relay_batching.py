@@ -0,0 +1,141 @@
+"""
+Check that notifications reach all devices in as few relay requests as possible.
+
+A printing notification is sent to growing numbers of registered devices through a
+local stub relay, which counts the requests and the targets in them. Every event has
+to take one request per RELAY_MAX_TARGETS devices and reach every device exactly once,
+otherwise the check exits with status 1.
+
+Usage:
+    python benchmarks/relay_batching.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+# Numbers of registered devices an event is sent to
+DEVICE_COUNTS: tuple[int, ...] = (1, 10, 100, 250)
+
+
+class StubRelay(BaseHTTPRequestHandler):
+    """
+    Accepts relay requests and records their targets.
+    """
+
+    requests: list[list[dict[str, Any]]] = []
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StubRelay.requests.append(body["targets"])
+
+        response = json.dumps({"invalidTokens": []}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        _ = self.wfile.write(response)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class StubRelayServer(ThreadingHTTPServer):
+    # Batches are posted concurrently
+    request_queue_size = 256
+
+
+relay = StubRelayServer(("127.0.0.1", 0), StubRelay)
+threading.Thread(target=relay.serve_forever, daemon=True).start()
+
+# Point the proxy at the stub relay and keep its state out of the real state directory
+os.environ["PRUSA_OCTOAPP_PROXY_RELAY_URL"] = (
+    f"http://127.0.0.1:{relay.server_address[1]}/sendNotificationV2"
+)
+DATA_DIR: tempfile.TemporaryDirectory[str] = tempfile.TemporaryDirectory(
+    prefix="prusa-relay-"
+)
+os.environ["PRUSA_OCTOAPP_PROXY_DATA_DIR"] = DATA_DIR.name
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from notifications import RELAY_MAX_TARGETS, NotificationHandler
+from print_job import PrintJob
+
+
+async def send_event(devices: int) -> list[list[dict[str, Any]]]:
+    """
+    Send a printing notification to a number of registered devices.
+
+    Args:
+        devices (int): The number of devices.
+
+    Returns:
+        list[list[dict[str, Any]]]: The targets of every relay request the event took.
+    """
+
+    handler = NotificationHandler()
+    handler.devices.clear()
+    for index in range(devices):
+        handler.register(
+            {
+                "fcmToken": f"token-{index}",
+                "fcmTokenFallback": None,
+                "instanceId": f"instance-{index}",
+            }
+        )
+
+    StubRelay.requests.clear()
+    print_job = PrintJob(
+        devices, True, 42.0, 1800, 1200, "benchy.gcode", "/usb", "B.GCO"
+    )
+    await handler.send_printing_notification(print_job)
+    # Waits for the background delivery
+    await handler.close()
+
+    return list(StubRelay.requests)
+
+
+async def check() -> list[str]:
+    failures: list[str] = []
+
+    print(f"{'devices':>8} {'requests':>9} {'expected':>9}")
+    for devices in DEVICE_COUNTS:
+        requests = await send_event(devices)
+        expected = math.ceil(devices / RELAY_MAX_TARGETS)
+        print(f"{devices:>8} {len(requests):>9} {expected:>9}")
+
+        if len(requests) != expected:
+            failures.append(
+                f"{devices} devices took {len(requests)} relay requests, "
+                + f"expected {expected}"
+            )
+
+        targets = [target["instanceId"] for request in requests for target in request]
+        if sorted(targets) != sorted(f"instance-{index}" for index in range(devices)):
+            failures.append(f"{devices} devices were not all reached exactly once")
+
+    return failures
+
+
+def main() -> None:
+    failures = asyncio.run(check())
+    relay.shutdown()
+
+    if failures:
+        print("\nFailures:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
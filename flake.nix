@@ -43,11 +43,15 @@
               cryptography
               fastapi
               httpx
-              requests
               uvicorn
               websockets
               wsproto
             ];
+
+            # Renders timelapses
+            makeWrapperArgs = [
+              "--prefix PATH : ${pkgs.lib.makeBinPath [ pkgs.ffmpeg-headless ]}"
+            ];
           };
         }
       );
@@ -104,6 +108,7 @@
               Group = cfg.group;
               ExecStart = "${cfg.package}/bin/prusa-octoapp-proxy";
               Restart = "always";
+              StateDirectory = "prusa-octoapp-proxy";
             };
           };
 
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import logging
+import time
+from enum import Enum
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an upstream that keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and requests are
+    rejected without being sent. Once the reset timeout has passed, a single probe
+    request is let through (half-open): if it succeeds the circuit closes, otherwise it
+    opens again with a doubled reset timeout.
+    """
+
+    class State(Enum):
+        CLOSED = "closed"
+        OPEN = "open"
+        HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 2.0,
+        max_reset_timeout: float = 60.0,
+        probe_timeout: float = 10.0,
+    ):
+        """
+        Args:
+            name (str): The name of the upstream, for logging.
+            failure_threshold (int): Consecutive failures that open the circuit.
+            reset_timeout (float): Time before the first probe, in seconds.
+            max_reset_timeout (float): Upper bound of the doubled reset timeout, in seconds.
+            probe_timeout (float): Time after which an unanswered probe is replaced, in seconds.
+        """
+
+        self.name: str = name
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.max_reset_timeout: float = max_reset_timeout
+        self.probe_timeout: float = probe_timeout
+
+        self.state: CircuitBreaker.State = CircuitBreaker.State.CLOSED
+        self.failures: int = 0
+        self.rejected: int = 0
+        self._current_reset_timeout: float = reset_timeout
+        self._opened_at: float = 0.0
+        self._probe_started_at: float = 0.0
+
+    def allow(self) -> bool:
+        """
+        Check whether a request may be sent.
+
+        Returns:
+            bool: True if the request may be sent, False if it must fail right away.
+        """
+
+        now = time.monotonic()
+
+        match self.state:
+            case CircuitBreaker.State.CLOSED:
+                return True
+            case CircuitBreaker.State.OPEN if (
+                now - self._opened_at >= self._current_reset_timeout
+            ):
+                self.state = CircuitBreaker.State.HALF_OPEN
+                self._probe_started_at = now
+                return True
+            case CircuitBreaker.State.HALF_OPEN if (
+                now - self._probe_started_at >= self.probe_timeout
+            ):
+                # The probe never reported back, let another one through
+                self._probe_started_at = now
+                return True
+            case _:
+                self.rejected += 1
+                return False
+
+    def record_success(self) -> None:
+        """
+        Record a request the upstream answered.
+        """
+
+        if self.state != CircuitBreaker.State.CLOSED:
+            logger.info("%s is reachable again, closing circuit", self.name)
+
+        self.state = CircuitBreaker.State.CLOSED
+        self.failures = 0
+        self._current_reset_timeout = self.reset_timeout
+
+    def record_failure(self) -> None:
+        """
+        Record a request the upstream failed to answer.
+        """
+
+        self.failures += 1
+
+        if self.state == CircuitBreaker.State.HALF_OPEN:
+            self._current_reset_timeout = min(
+                self._current_reset_timeout * 2, self.max_reset_timeout
+            )
+            self._open()
+        elif (
+            self.state == CircuitBreaker.State.CLOSED
+            and self.failures >= self.failure_threshold
+        ):
+            self._open()
+
+    def report(self) -> dict[str, Any]:
+        """
+        Describe the state of the circuit.
+
+        Returns:
+            dict[str, Any]: The state, failure count and current reset timeout.
+        """
+
+        return {
+            "state": self.state.value,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "resetTimeout": self._current_reset_timeout,
+        }
+
+    def _open(self) -> None:
+        logger.warning(
+            "%s is unreachable, opening circuit for %.0fs",
+            self.name,
+            self._current_reset_timeout,
+        )
+        self.state = CircuitBreaker.State.OPEN
+        self._opened_at = time.monotonic()
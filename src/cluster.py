@@ -0,0 +1,341 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+from config import DATA_DIR
+from data_poller import DataPoller
+from gcode_analysis import GcodeAnalyzer
+from gcode_cache import GcodeCache
+from notifications import NotificationHandler
+from print_job import PrintJob
+from printer_status import PrinterStatus
+
+logger = logging.getLogger(__name__)
+
+LOCK_PATH: Path = DATA_DIR / "leader.lock"
+SOCKET_PATH: Path = DATA_DIR / "cluster.sock"
+
+# Delay between attempts to reach or replace the leader, in seconds
+RETRY_INTERVAL: float = 0.5
+
+# Unsent bytes after which a follower is considered stuck and dropped
+MAX_FOLLOWER_BUFFER: int = 1024 * 1024
+
+
+class ClusterNode:
+    """
+    Shares a single DataPoller between worker processes.
+
+    The worker holding the leader lock polls the printer, sends notifications and
+    publishes every update over a unix socket. All other workers follow: they replay
+    the published updates and resources into their own DataPoller, so clients are
+    served from the shared state, and forward update requests, notification
+    registrations, gcode analyses and downloads to the leader. Only the leader sends
+    requests to the printer. When the leader exits, the first follower to take the
+    lock leads.
+    """
+
+    _instance: ClusterNode | None = None
+
+    def __init__(
+        self,
+        data_poller: DataPoller,
+        notifications: NotificationHandler,
+        gcode_cache: GcodeCache,
+        gcode_analyzer: GcodeAnalyzer,
+    ):
+        ClusterNode._instance = self
+
+        self.data_poller: DataPoller = data_poller
+        self.notifications: NotificationHandler = notifications
+        self.gcode_cache: GcodeCache = gcode_cache
+        self.gcode_analyzer: GcodeAnalyzer = gcode_analyzer
+        self.is_leader: bool = False
+
+        self._lock_fd: int | None = None
+        self._server: asyncio.Server | None = None
+        self._followers: set[asyncio.StreamWriter] = set()
+        # Latest message per event and resource, sent to followers when they connect
+        self._snapshot: dict[str, str] = {}
+        self._leader: asyncio.StreamWriter | None = None
+        self._follow_task: asyncio.Task[None] | None = None
+        # Downloads the leader runs for followers
+        self._fetches: set[asyncio.Task[None]] = set()
+
+    @classmethod
+    def get_instance(cls) -> ClusterNode:
+        if cls._instance is None:
+            raise ValueError("ClusterNode instance not initialized")
+        return cls._instance
+
+    async def start(self) -> None:
+        """
+        Become the leader if there is none yet, otherwise follow the leader.
+        """
+
+        for event in DataPoller.Event:
+            self.data_poller.subscribe(event, self._publisher(event))
+
+        if self._try_lock():
+            await self._lead()
+        else:
+            self._follow()
+
+    async def stop(self) -> None:
+        """
+        Stop leading or following and release the leader lock.
+        """
+
+        if self._follow_task:
+            _ = self._follow_task.cancel()
+
+        if self.data_poller.listen_task:
+            _ = self.data_poller.listen_task.cancel()
+
+        if self._server:
+            self._server.close()
+
+        for follower in list(self._followers):
+            follower.close()
+
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _try_lock(self) -> bool:
+        LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        return True
+
+    async def _lead(self) -> None:
+        logger.info("Worker %d is polling the printer", os.getpid())
+
+        self.is_leader = True
+        self.data_poller.forward_request = None
+        self.notifications.forward = None
+        self.gcode_cache.forward = None
+        self.gcode_analyzer.forward = None
+        self.data_poller.publish_resource = self._publish_resource
+        self.gcode_analyzer.publish = self._publish_analysis
+        # The previous leader may have registered devices since this worker started
+        self.notifications.reload()
+
+        # Only the lock holder binds the socket, so a leftover file is stale
+        SOCKET_PATH.unlink(missing_ok=True)
+        self._server = await asyncio.start_unix_server(
+            self._serve_follower, path=SOCKET_PATH
+        )
+        await self.data_poller.start()
+
+    def _follow(self) -> None:
+        self.data_poller.forward_request = self._forward_request
+        self.notifications.forward = self._forward_registration
+        self.gcode_cache.forward = self._forward_fetch
+        self.gcode_analyzer.forward = self._forward_analysis
+        self._follow_task = asyncio.create_task(self._follow_loop())
+
+    def _publisher(self, event: DataPoller.Event):
+        async def publish(update: PrintJob | PrinterStatus) -> None:
+            if not self.is_leader:
+                return
+
+            current_print = self.data_poller.current_print
+            self._broadcast(
+                {
+                    "type": "event",
+                    "event": event.name,
+                    "update": update.to_dict(),
+                    "currentPrint": current_print.print_id if current_print else None,
+                    "polledAt": self.data_poller.polled_at,
+                    "online": self.data_poller.online,
+                },
+                snapshot=f"event:{event.name}",
+            )
+
+        return publish
+
+    def _publish_resource(
+        self, resource: DataPoller.Resource, data: dict[str, Any]
+    ) -> None:
+        self._broadcast(
+            {"type": "resource", "resource": resource.name, "data": data},
+            snapshot=f"resource:{resource.name}",
+        )
+
+    def _publish_analysis(self, key: str, result: dict[str, Any]) -> None:
+        # Followers load earlier results from disk when they connect
+        self._broadcast({"type": "analysis", "key": key, "result": result})
+
+    def _broadcast(self, message: dict[str, Any], snapshot: str | None = None) -> None:
+        """
+        Send a message to all followers.
+
+        Args:
+            message (dict[str, Any]): The message.
+            snapshot (str | None): Keep the message for followers that connect later,
+                replacing the message kept under the same key.
+        """
+
+        line = json.dumps(message) + "\n"
+
+        if snapshot is not None:
+            # Reinserted so the snapshot is replayed in the order it was published
+            _ = self._snapshot.pop(snapshot, None)
+            self._snapshot[snapshot] = line
+
+        for follower in list(self._followers):
+            self._write(follower, line)
+
+    def _write(self, follower: asyncio.StreamWriter, message: str) -> None:
+        if follower.transport.get_write_buffer_size() > MAX_FOLLOWER_BUFFER:
+            logger.warning("Worker is not keeping up, dropping it")
+            self._followers.discard(follower)
+            follower.close()
+            return
+
+        follower.write(message.encode("utf-8"))
+
+    async def _serve_follower(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        for message in self._snapshot.values():
+            self._write(writer, message)
+        self._followers.add(writer)
+
+        try:
+            while line := await reader.readline():
+                self._handle_follower_message(json.loads(line))
+        except (ConnectionError, ValueError) as e:
+            logger.error("Connection to worker failed: %s", e)
+        finally:
+            self._followers.discard(writer)
+            writer.close()
+
+    def _handle_follower_message(self, message: dict[str, Any]) -> None:
+        match message.get("type"):
+            case "request":
+                self.data_poller.request_update(
+                    *(DataPoller.Resource[name] for name in message["resources"])
+                )
+            case "register":
+                self.notifications.register(message["data"])
+            case "unregister":
+                self.notifications.unregister(message["data"])
+            case "analyze":
+                self.gcode_analyzer.analyze(
+                    message["key"], message["size"], message["mTimestamp"]
+                )
+            case "fetch":
+                task = asyncio.create_task(self._fetch(message["key"]))
+                self._fetches.add(task)
+                task.add_done_callback(self._fetches.discard)
+            case _:
+                logger.warning("Unknown message from worker: %s", message)
+
+    async def _fetch(self, key: str) -> None:
+        try:
+            _ = await self.gcode_cache.get(key)
+        finally:
+            # Also on failure, so followers serve what is cached instead of waiting
+            self._broadcast({"type": "fetched", "key": key})
+
+    async def _follow_loop(self) -> None:
+        while True:
+            try:
+                reader, leader = await asyncio.open_unix_connection(SOCKET_PATH)
+            except OSError:
+                reader = leader = None
+
+            if reader is not None and leader is not None:
+                self._leader = leader
+                logger.info("Worker %d is following the leader", os.getpid())
+                # The leader only publishes new results, earlier ones are on disk
+                await self.gcode_analyzer.reload()
+                try:
+                    while line := await reader.readline():
+                        await self._handle_leader_message(json.loads(line))
+                except (ConnectionError, ValueError) as e:
+                    logger.error("Connection to leader failed: %s", e)
+
+                leader.close()
+                self._leader = None
+                self.gcode_cache.fetched()
+
+            if self._try_lock():
+                await self._lead()
+                return
+
+            await asyncio.sleep(RETRY_INTERVAL)
+
+    async def _handle_leader_message(self, message: dict[str, Any]) -> None:
+        match message.get("type"):
+            case "event":
+                await self._replay(message)
+            case "resource":
+                self.data_poller.set_resource(
+                    DataPoller.Resource[message["resource"]], message["data"]
+                )
+            case "analysis":
+                self.gcode_analyzer.apply(message["key"], message["result"])
+            case "fetched":
+                self.gcode_cache.fetched(message["key"])
+            case _:
+                logger.warning("Unknown message from leader: %s", message)
+
+    async def _replay(self, message: dict[str, Any]) -> None:
+        event = DataPoller.Event[message["event"]]
+        update = (
+            PrinterStatus.from_dict(message["update"])
+            if event in (DataPoller.Event.PRINTER_STATUS, DataPoller.Event.CONNECTION)
+            else PrintJob.from_dict(message["update"])
+        )
+
+        await self.data_poller.replay(
+            event,
+            update,
+            message["currentPrint"],
+            message["polledAt"],
+            message["online"],
+        )
+
+    def _send_to_leader(self, message: dict[str, Any]) -> None:
+        if self._leader is None:
+            logger.warning("No leader to forward to, dropping message")
+            return
+
+        self._leader.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    def _forward_request(self, resources: set[DataPoller.Resource]) -> None:
+        self._send_to_leader(
+            {"type": "request", "resources": [resource.name for resource in resources]}
+        )
+
+    def _forward_registration(self, action: str, data: dict[str, Any]) -> None:
+        self._send_to_leader({"type": action, "data": data})
+
+    def _forward_analysis(self, key: str, size: int, m_timestamp: int) -> None:
+        self._send_to_leader(
+            {"type": "analyze", "key": key, "size": size, "mTimestamp": m_timestamp}
+        )
+
+    def _forward_fetch(self, key: str) -> None:
+        if self._leader is None:
+            # Nobody would answer, serve what is cached right away
+            self.gcode_cache.fetched(key)
+            return
+
+        self._send_to_leader({"type": "fetch", "key": key})
@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+
+# Directory for persistent proxy state (history database, caches, ...).
+# Defaults to the systemd StateDirectory when running as a service.
+DATA_DIR: Path = Path(
+    os.environ.get(
+        "PRUSA_OCTOAPP_PROXY_DATA_DIR",
+        os.environ.get(
+            "STATE_DIRECTORY",
+            Path.home() / ".local" / "state" / "prusa-octoapp-proxy",
+        ),
+    )
+)
+
+# Websocket frames smaller than this are sent without permessage-deflate, in bytes
+WS_COMPRESSION_MIN_SIZE: int = int(
+    os.environ.get("PRUSA_OCTOAPP_PROXY_WS_COMPRESSION_MIN_SIZE", 256)
+)
+
+# Estimate the bytes sent on the wire per websocket client (costs CPU)
+WS_MEASURE_BANDWIDTH: bool = (
+    os.environ.get("PRUSA_OCTOAPP_PROXY_WS_MEASURE_BANDWIDTH", "") == "1"
+)
+
+# Number of worker processes serving clients, one of them polls the printer
+WORKERS: int = int(os.environ.get("PRUSA_OCTOAPP_PROXY_WORKERS", 1))
+
+# Fraction of poll cycles that are traced, 0 disables tracing
+TRACE_SAMPLE_RATE: float = float(
+    os.environ.get("PRUSA_OCTOAPP_PROXY_TRACE_SAMPLE_RATE", 0)
+)
+
+# Token required by admin endpoints, in the X-Admin-Token header. Unset disables them.
+ADMIN_TOKEN: str | None = os.environ.get("PRUSA_OCTOAPP_PROXY_ADMIN_TOKEN") or None
+
+# URL of a camera snapshot used for timelapses. Unset uses the PrusaLink camera.
+TIMELAPSE_SNAPSHOT_URL: str | None = (
+    os.environ.get("PRUSA_OCTOAPP_PROXY_TIMELAPSE_SNAPSHOT_URL") or None
+)
+
+# The printer served by this process
+PRINTER_HOST: str = os.environ.get(
+    "PRUSA_OCTOAPP_PROXY_PRINTER_HOST", "http://192.168.2.137"
+)
+PRINTER_USERNAME: str = os.environ.get("PRUSA_OCTOAPP_PROXY_PRINTER_USERNAME", "maker")
+PRINTER_PASSWORD: str = os.environ.get(
+    "PRUSA_OCTOAPP_PROXY_PRINTER_PASSWORD", "izPjsV5TQJR4Eai"
+)
+
+# Address to listen on. A unix socket replaces the TCP port when set.
+HOST: str = os.environ.get("PRUSA_OCTOAPP_PROXY_HOST", "0.0.0.0")
+PORT: int = int(os.environ.get("PRUSA_OCTOAPP_PROXY_PORT", 8000))
+UNIX_SOCKET: str | None = os.environ.get("PRUSA_OCTOAPP_PROXY_UNIX_SOCKET") or None
+
+# Path prefix the app is served under, when behind the fleet router
+ROOT_PATH: str = os.environ.get("PRUSA_OCTOAPP_PROXY_ROOT_PATH", "")
+
+# JSON list of the printers served by the fleet supervisor, each with a name, host,
+# username and password
+FLEET_CONFIG: Path = Path(
+    os.environ.get("PRUSA_OCTOAPP_PROXY_FLEET_CONFIG", DATA_DIR / "fleet.json")
+)
+
+# Level of the root logger, changeable at runtime through the diagnostics endpoints
+LOG_LEVEL: str = os.environ.get("PRUSA_OCTOAPP_PROXY_LOG_LEVEL", "INFO").upper()
+
+# "text" for plain lines, "json" for one JSON object per line
+LOG_FORMAT: str = os.environ.get("PRUSA_OCTOAPP_PROXY_LOG_FORMAT", "text")
+
+# OctoApp's notification relay
+RELAY_URL: str = os.environ.get(
+    "PRUSA_OCTOAPP_PROXY_RELAY_URL",
+    "https://europe-west1-octoapp-4e438.cloudfunctions.net/sendNotificationV2",
+)
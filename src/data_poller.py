@@ -1,13 +1,50 @@
 from __future__ import annotations
 
 import asyncio
+import logging
+import time
 from collections.abc import Coroutine
 from enum import Enum
 from typing import Any, Callable
 
 from print_job import PrintJob
 from printer_status import PrinterState, PrinterStatus
+from poll_scheduler import PollScheduler, ScheduledResource
 from prusa_link import PrusaLink
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Maps the PrusaLink job/printer state a print ended in to the stored result
+JOB_END_RESULTS: dict[str, str] = {
+    "FINISHED": "success",
+    "STOPPED": "cancelled",
+    "ERROR": "failed",
+}
+
+# Refresh intervals of the printer's resources, in seconds
+STATUS_INTERVAL: float = 2.0
+OFFLINE_INTERVAL: float = 10.0
+JOB_INTERVAL: float = 15.0
+FILES_INTERVAL: float = 60.0
+STORAGE_INTERVAL: float = 60.0
+INFO_INTERVAL: float = 3600.0
+
+# Upper bound of requests sent to the printer
+MAX_REQUESTS_PER_SECOND: float = 5.0
+
+# Age after which the file list is fetched on access, normally it is refreshed before
+FILES_MAX_AGE: float = 2 * FILES_INTERVAL
+
+# Longest time a worker that does not poll waits for the leader to fetch the file list
+FILES_WAIT: float = 10.0
+
+# Delay before restarting a crashed poll loop, doubled per crash up to the maximum
+RESTART_DELAY: float = 1.0
+RESTART_DELAY_MAX: float = 60.0
+
+# Time a poll loop has to run to reset the restart delay, in seconds
+RESTART_RESET_AFTER: float = 300.0
 
 
 class DataPoller:
@@ -20,6 +57,16 @@ class DataPoller:
     class Event(Enum):
         PRINTER_STATUS = 1
         PRINT_JOB = 2
+        PRINT_JOB_ENDED = 3
+        # The printer went offline or came back, with the last known PrinterStatus
+        CONNECTION = 4
+
+    class Resource(Enum):
+        STATUS = 1
+        JOB = 2
+        FILES = 3
+        STORAGE = 4
+        INFO = 5
 
     def __init__(self, link: PrusaLink):
         DataPoller._instance = self
@@ -33,9 +80,95 @@ class DataPoller:
         self.listen_task: asyncio.Task[None] | None = None
         self.previous_status: dict[str, Any] | None = None
         self.previous_job: dict[str, Any] | None = None
+        self.printer_status: PrinterStatus | None = None
+        # Whether the printer answered the last connection check, None before the first
+        self.online: bool | None = None
+        # Monotonic time of the last successful status poll
+        self.polled_at: float | None = None
+        self.files: dict[str, Any] | None = None
+        self.files_polled_at: float | None = None
+        self.storage: dict[str, Any] | None = None
+        self.info: dict[str, Any] | None = None
+        self.scheduler: PollScheduler = PollScheduler(MAX_REQUESTS_PER_SECOND)
+        self._leader_only: set[
+            Callable[[PrintJob | PrinterStatus], Coroutine[Any, Any, None]]
+        ] = set()
+        # Set on workers that do not poll themselves, to pass requests to the leader
+        self.forward_request: Callable[[set[DataPoller.Resource]], None] | None = None
+        # Set on the worker that polls for others, to share the polled resources
+        self.publish_resource: (
+            Callable[[DataPoller.Resource, dict[str, Any]], None] | None
+        ) = None
+        self._files_received: asyncio.Event = asyncio.Event()
+
+        for resource in (
+            ScheduledResource(
+                DataPoller.Resource.STATUS.name,
+                self._poll_status,
+                STATUS_INTERVAL,
+                priority=0,
+                staleness_budget=3 * STATUS_INTERVAL,
+            ),
+            ScheduledResource(
+                DataPoller.Resource.JOB.name,
+                self._poll_job,
+                JOB_INTERVAL,
+                priority=1,
+                staleness_budget=3 * JOB_INTERVAL,
+                enabled=self._has_job,
+            ),
+            ScheduledResource(
+                DataPoller.Resource.FILES.name,
+                self._poll_files,
+                FILES_INTERVAL,
+                priority=2,
+                staleness_budget=2 * FILES_INTERVAL,
+                enabled=self._is_reachable,
+            ),
+            ScheduledResource(
+                DataPoller.Resource.STORAGE.name,
+                self._poll_storage,
+                STORAGE_INTERVAL,
+                priority=3,
+                staleness_budget=2 * STORAGE_INTERVAL,
+                enabled=self._is_reachable,
+            ),
+            ScheduledResource(
+                DataPoller.Resource.INFO.name,
+                self._poll_info,
+                INFO_INTERVAL,
+                priority=4,
+                staleness_budget=2 * INFO_INTERVAL,
+                enabled=self._is_reachable,
+            ),
+        ):
+            self.scheduler.register(resource)
 
     async def start(self) -> None:
-        self.listen_task = asyncio.create_task(self.listen(2))
+        self.listen_task = asyncio.create_task(self.supervise())
+
+    async def supervise(self) -> None:
+        """
+        Run the poll loop, restarting it with increasing delays when it crashes.
+        """
+
+        restarts = 0
+
+        while True:
+            started = time.monotonic()
+
+            try:
+                await self.listen()
+            except Exception as e:
+                logger.exception("Poll loop crashed: %r", e)
+
+            if time.monotonic() - started > RESTART_RESET_AFTER:
+                restarts = 0
+
+            delay = min(RESTART_DELAY * 2**restarts, RESTART_DELAY_MAX)
+            restarts += 1
+            logger.info("Restarting poll loop in %.0fs", delay)
+            await asyncio.sleep(delay)
 
     @classmethod
     def get_instance(cls) -> DataPoller:
@@ -47,6 +180,7 @@ class DataPoller:
         self,
         event: DataPoller.Event,
         callback: Callable[[PrintJob | PrinterStatus], Coroutine[Any, Any, None]],
+        leader_only: bool = False,
     ) -> None:
         """
         Subscribe to data updates for an event.
@@ -54,8 +188,12 @@ class DataPoller:
         Args:
             event (Event): The event to subscribe to.
             callback (Callable[[dict[str, Any]], Coroutine[Any, Any, None]]): The callback function to handle data updates.
+            leader_only (bool): Skip the callback for updates replayed from another worker,
+                for subscribers with side effects that must only happen once.
         """
         self._subscribers.setdefault(event, set()).add(callback)
+        if leader_only:
+            self._leader_only.add(callback)
 
     def unsubscribe(
         self,
@@ -70,95 +208,336 @@ class DataPoller:
             callback (Callable[[dict[str, Any]], Coroutine[Any, Any, None]]): The callback function to handle data updates.
         """
         self._subscribers.setdefault(event, set()).remove(callback)
+        self._leader_only.discard(callback)
 
     async def _notify_subscribers(
-        self, event: DataPoller.Event, update: PrinterStatus | PrintJob
+        self,
+        event: DataPoller.Event,
+        update: PrinterStatus | PrintJob,
+        replayed: bool = False,
     ) -> None:
         for callback in self._subscribers.get(event, set()):
-            await callback(update)
+            if replayed and callback in self._leader_only:
+                continue
+            with span("notify", event=event.name, subscriber=callback.__qualname__):
+                await callback(update)
 
-    async def listen(self, rate: float) -> None:
+    async def replay(
+        self,
+        event: DataPoller.Event,
+        update: PrinterStatus | PrintJob,
+        current_print_id: int | None,
+        polled_at: float | None,
+        online: bool | None,
+    ) -> None:
         """
-        Listen for data updates.
+        Apply an update polled by another worker, notifying all but leader-only subscribers.
 
         Args:
-            rate (float): The rate at which to listen for data updates.
+            event (Event): The event of the update.
+            update (PrinterStatus | PrintJob): The update.
+            current_print_id (int | None): The ID of the leader's current print job.
+            polled_at (float | None): Monotonic time the leader last polled the printer.
+            online (bool | None): Whether the leader reaches the printer.
+        """
+
+        self.polled_at = polled_at
+        self.online = online
+
+        if isinstance(update, PrinterStatus):
+            self.printer_status = update
+        elif update.print_id == current_print_id:
+            self.current_print = update
+
+        if current_print_id is None:
+            self.current_print = None
+
+        await self._notify_subscribers(event, update, replayed=True)
+
+    async def listen(self) -> None:
+        """
+        Refresh the printer's resources on their schedule and notify subscribers of changes.
         """
         self.previous_status = None
         self.previous_job = None
 
-        while True:
-            if len(self._subscribers) == 0 or not await self.link.is_online():
-                print("No subscribers or offline")
-                await asyncio.sleep(rate * 5)
-                continue
+        await self.scheduler.run()
 
-            # Check for status updates
-            status: dict[str, Any] | None = await self.link.get_status()
-
-            if status is not None and status != self.previous_status:
-                printer: dict[str, int | str] = status["printer"]
-
-                printer_status = PrinterStatus(
-                    state=PrinterState(printer["state"]),
-                    temp_bed=float(printer["temp_bed"]),
-                    temp_nozzle=float(printer["temp_nozzle"]),
-                    target_bed=float(printer["target_bed"]),
-                    target_nozzle=float(printer["target_nozzle"]),
-                    z_height=float(printer["axis_z"]),
-                    flow=float(printer["flow"]),
-                    speed=float(printer["speed"]),
-                    fan_hotend_rpm=int(printer["fan_hotend"]),
-                    fan_print_rpm=int(printer["fan_print"]),
-                )
+    async def _set_online(self, online: bool) -> None:
+        """
+        Track the connection to the printer, notifying subscribers when it changes.
+        The last known status is kept, so clients are served it marked offline.
 
-                await self._notify_subscribers(
-                    DataPoller.Event.PRINTER_STATUS, printer_status
-                )
-                self.previous_status = status
+        Args:
+            online (bool): Whether the printer is reachable.
+        """
+
+        if online == self.online:
+            return
+
+        self.online = online
+        if online:
+            logger.info("Printer is online")
+        else:
+            logger.warning("Printer is offline")
+        self.scheduler.resources[DataPoller.Resource.STATUS.name].interval = (
+            STATUS_INTERVAL if online else OFFLINE_INTERVAL
+        )
+
+        if self.printer_status is not None:
+            await self._notify_subscribers(
+                DataPoller.Event.CONNECTION, self.printer_status
+            )
+
+    def request_update(self, *resources: DataPoller.Resource) -> None:
+        """
+        Request an immediate refresh of resources instead of waiting for their interval.
+        Requests arriving close together are merged into a single refresh.
+
+        Args:
+            *resources (Resource): The resources to refresh.
+        """
+
+        if self.forward_request is not None:
+            self.forward_request(set(resources))
+            return
+
+        self.scheduler.request(*(resource.name for resource in resources))
+
+    async def get_files(self) -> dict[str, Any] | None:
+        """
+        Get the file list, fetching it if the cached copy is too old. Workers that do not
+        poll themselves have the leader fetch it.
+
+        Returns:
+            dict[str, Any] | None: The file list, or None if it could not be fetched.
+        """
+
+        if (
+            self.files is not None
+            and self.files_polled_at is not None
+            and time.monotonic() - self.files_polled_at <= FILES_MAX_AGE
+        ):
+            return self.files
+
+        if self.forward_request is None:
+            _ = await self._poll_files()
+            return self.files
 
-            # Check for job updates
-            job: dict[str, Any] | None = (
-                await self.link.get_job()
-                if (status is not None and status.get("job", None) is not None)
-                else None
+        # The leader fetches the list and publishes it to all workers
+        self._files_received.clear()
+        self.forward_request({DataPoller.Resource.FILES})
+        try:
+            _ = await asyncio.wait_for(self._files_received.wait(), FILES_WAIT)
+        except TimeoutError:
+            logger.warning("Leader did not send the file list, serving the last one")
+
+        return self.files
+
+    def set_resource(self, resource: DataPoller.Resource, data: dict[str, Any]) -> None:
+        """
+        Store a polled file list, storage list or printer info and publish it to the
+        other workers.
+
+        Args:
+            resource (Resource): The resource, FILES, STORAGE or INFO.
+            data (dict[str, Any]): The response of the printer.
+        """
+
+        match resource:
+            case DataPoller.Resource.FILES:
+                self.files = data
+                self.files_polled_at = time.monotonic()
+                self._files_received.set()
+            case DataPoller.Resource.STORAGE:
+                self.storage = data
+            case DataPoller.Resource.INFO:
+                self.info = data
+            case _:
+                raise ValueError(f"{resource.name} is not stored as a resource")
+
+        if self.publish_resource is not None:
+            self.publish_resource(resource, data)
+
+    async def _poll_files(self) -> bool:
+        if (files := await self.link.get_files()) is None:
+            return False
+
+        self.set_resource(DataPoller.Resource.FILES, files)
+        return True
+
+    async def _poll_storage(self) -> bool:
+        if (storage := await self.link.get_storage()) is None:
+            return False
+
+        self.set_resource(DataPoller.Resource.STORAGE, storage)
+        return True
+
+    async def _poll_info(self) -> bool:
+        if (info := await self.link.get_info()) is None:
+            return False
+
+        self.set_resource(DataPoller.Resource.INFO, info)
+        return True
+
+    def _is_reachable(self) -> bool:
+        return bool(self.online)
+
+    def _has_job(self) -> bool:
+        # The job is only polled while the printer reports one
+        return bool(self.online) and self._status_job_id() is not None
+
+    def _status_job_id(self) -> int | None:
+        if self.previous_status is None:
+            return None
+        return (self.previous_status.get("job", None) or {}).get("id", None)
+
+    async def _poll_status(self) -> bool:
+        """
+        Poll the printer status and notify subscribers of changes.
+
+        Returns:
+            bool: True if the printer answered, False otherwise.
+        """
+
+        status: dict[str, Any] | None = await self.link.get_status()
+        await self._set_online(status is not None)
+
+        if status is None:
+            return False
+
+        self.polled_at = time.monotonic()
+        previous_job_id = self._status_job_id()
+
+        with span("poll.diff", resource="status") as diff:
+            changed = status != self.previous_status
+            diff.set(changed=changed)
+
+        if changed:
+            printer: dict[str, int | str] = status["printer"]
+
+            printer_status = PrinterStatus(
+                state=PrinterState(printer["state"]),
+                temp_bed=float(printer["temp_bed"]),
+                temp_nozzle=float(printer["temp_nozzle"]),
+                target_bed=float(printer["target_bed"]),
+                target_nozzle=float(printer["target_nozzle"]),
+                z_height=float(printer["axis_z"]),
+                flow=float(printer["flow"]),
+                speed=float(printer["speed"]),
+                fan_hotend_rpm=int(printer["fan_hotend"]),
+                fan_print_rpm=int(printer["fan_print"]),
             )
 
-            if job is not None and job != self.previous_job:
-                if not (print_job := PrintJob.get(job["id"])):
-                    print_job = PrintJob(
-                        print_id=job["id"],
-                        running=job["state"] == "PRINTING",
-                        progress=float(job["progress"]),
-                        time_remaining_seconds=int(job["time_remaining"]),
-                        time_printing_seconds=int(job["time_printing"]),
-                        display_name=job["file"]["display_name"],
-                        path=job["file"]["path"],
-                    )
-                else:
-                    print_job.update(
-                        running=job["state"] == "PRINTING",
-                        progress=float(job["progress"]),
-                        time_remaining_seconds=int(job["time_remaining"]),
-                        time_printing_seconds=int(job["time_printing"]),
-                        display_name=job["file"]["display_name"],
-                        path=job["file"]["path"],
-                    )
-
-                await self._notify_subscribers(DataPoller.Event.PRINT_JOB, print_job)
-                self.previous_job = job
-
-            await asyncio.sleep(rate)
+            self.printer_status = printer_status
+            await self._notify_subscribers(
+                DataPoller.Event.PRINTER_STATUS, printer_status
+            )
+            self.previous_status = status
+
+        # A new job shows up in the status first, fetch it right away
+        if (job_id := self._status_job_id()) is not None and job_id != previous_job_id:
+            self.request_update(DataPoller.Resource.JOB)
+
+        await self._check_job_end(status, self.previous_job)
+        return True
+
+    async def _poll_job(self) -> bool:
+        """
+        Poll the current job and notify subscribers of changes.
+
+        Returns:
+            bool: True if the printer answered, False otherwise.
+        """
+
+        job: dict[str, Any] | None = await self.link.get_job()
+
+        with span("poll.diff", resource="job") as diff:
+            changed = job is not None and job != self.previous_job
+            diff.set(changed=changed)
+
+        if job is not None and changed:
+            if not (print_job := PrintJob.get(job["id"])):
+                print_job = PrintJob(
+                    print_id=job["id"],
+                    running=job["state"] == "PRINTING",
+                    progress=float(job["progress"]),
+                    time_remaining_seconds=int(job["time_remaining"]),
+                    time_printing_seconds=int(job["time_printing"]),
+                    display_name=job["file"]["display_name"],
+                    path=job["file"]["path"],
+                    file_name=job["file"]["name"],
+                )
+            else:
+                print_job.update(
+                    running=job["state"] == "PRINTING",
+                    progress=float(job["progress"]),
+                    time_remaining_seconds=int(job["time_remaining"]),
+                    time_printing_seconds=int(job["time_printing"]),
+                    display_name=job["file"]["display_name"],
+                    path=job["file"]["path"],
+                    file_name=job["file"]["name"],
+                )
+
+            if job["state"] not in JOB_END_RESULTS:
+                self.current_print = print_job
+
+            await self._notify_subscribers(DataPoller.Event.PRINT_JOB, print_job)
+            self.previous_job = job
+
+        if self.previous_status is not None:
+            await self._check_job_end(self.previous_status, job)
+
+        return job is not None
+
+    async def _check_job_end(
+        self, status: dict[str, Any], job: dict[str, Any] | None
+    ) -> None:
+        """
+        Detect the end of the current print job and notify subscribers.
+
+        Args:
+            status (dict[str, Any]): The latest printer status.
+            job (dict[str, Any] | None): The latest job information, if fetched.
+        """
+
+        if self.current_print is None:
+            return
+
+        print_id = self.current_print.print_id
+        status_job: dict[str, Any] | None = status.get("job", None)
+        job_state: str | None = (
+            job["state"] if job is not None and job["id"] == print_id else None
+        )
+
+        if (
+            status_job is not None
+            and status_job.get("id", None) == print_id
+            and job_state not in JOB_END_RESULTS
+        ):
+            return
+
+        result = JOB_END_RESULTS.get(job_state or "") or JOB_END_RESULTS.get(
+            status["printer"]["state"]
+        )
+        if result is None:
+            result = "success" if self.current_print.progress >= 100 else "cancelled"
+
+        ended_print = self.current_print
+        self.current_print = None
+        ended_print.finish(result)
+
+        await self._notify_subscribers(DataPoller.Event.PRINT_JOB_ENDED, ended_print)
 
     async def is_online(self) -> bool:
         """
-        Check if the printer is online.
+        Check if the printer was online at the last poll, without contacting it.
 
         Returns:
             bool: True if the printer is online, False otherwise.
         """
 
-        return await self.link.is_online()
+        return bool(self.online)
 
     def force_update(self) -> None:
         """
@@ -1,6 +1,5 @@
 from fastapi import APIRouter, WebSocket
 
-from data_poller import DataPoller
 from websocket import WebSocketHandler
 
 router = APIRouter()
@@ -17,12 +16,10 @@ async def sockjs_info():
 
 
 @router.websocket("/sockjs/{server_id}/{session_id}/websocket")
-async def sockjs_session(websocket: WebSocket, _server_id: str, _session_id: str):
-    DataPoller.get_instance().force_update()
-    await WebSocketHandler.get_instance().register_ws(websocket)
+async def sockjs_session(websocket: WebSocket, server_id: str, session_id: str):
+    await WebSocketHandler.get_instance().register_ws(websocket, framed=True)
 
 
 @router.websocket("/sockjs/websocket")
 async def sockjs_raw(websocket: WebSocket):
-    DataPoller.get_instance().force_update()
-    await WebSocketHandler.get_instance().register_ws(websocket)
+    await WebSocketHandler.get_instance().register_ws(websocket, framed=False)
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from types import FrameType
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Interval of the event loop heartbeat, in seconds
+HEARTBEAT_INTERVAL: float = 0.05
+
+# Loop stall after which the blocking stack is captured, in seconds
+SLOW_CALLBACK_THRESHOLD: float = 0.25
+
+# Upper bounds of the loop lag histogram buckets, in milliseconds
+LAG_BUCKETS: tuple[float, ...] = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+# Number of slow callbacks kept
+RECENT_SLOW_CALLBACKS: int = 50
+
+# Maximum duration of a profiling run, in seconds
+MAX_PROFILE_SECONDS: float = 60.0
+
+
+class Diagnostics:
+    """
+    Event loop health diagnostics for production.
+
+    A heartbeat task measures how late the loop wakes it up and keeps a histogram of
+    the lag. A watchdog thread checks the heartbeat, and when the loop has been blocked
+    longer than the threshold it captures the stack of the loop thread, which shows
+    what is blocking it. The sampling profiler reads the stacks of all threads from
+    another thread, so it sees the loop while it is busy.
+    """
+
+    _instance: Diagnostics | None = None
+
+    def __init__(self, slow_callback_threshold: float = SLOW_CALLBACK_THRESHOLD):
+        Diagnostics._instance = self
+
+        self.slow_callback_threshold: float = slow_callback_threshold
+        self.lag_histogram: list[int] = [0] * (len(LAG_BUCKETS) + 1)
+        self.max_lag: float = 0.0
+        self.samples: int = 0
+        self.slow_callbacks: deque[dict[str, Any]] = deque(maxlen=RECENT_SLOW_CALLBACKS)
+
+        self._heartbeat_at: float = time.monotonic()
+        self._heartbeat_task: asyncio.Task[None] | None = None
+        self._loop_thread_id: int | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped: threading.Event = threading.Event()
+        self._profile_lock: asyncio.Lock = asyncio.Lock()
+
+    @classmethod
+    def get_instance(cls) -> Diagnostics:
+        if cls._instance is None:
+            raise ValueError("Diagnostics instance not initialized")
+        return cls._instance
+
+    async def start(self) -> None:
+        """
+        Start the heartbeat task and the watchdog thread.
+        """
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat_at = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        self._watchdog = threading.Thread(
+            target=self._watchdog_loop, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        """
+        Stop the heartbeat task and the watchdog thread.
+        """
+
+        self._stopped.set()
+
+        if self._heartbeat_task:
+            _ = self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    def loop_lag(self) -> dict[str, Any]:
+        """
+        Report the event loop lag.
+
+        Returns:
+            dict[str, Any]: The lag histogram, maximum and sample count.
+        """
+
+        bounds = [f"<={bound:g}ms" for bound in LAG_BUCKETS] + [
+            f">{LAG_BUCKETS[-1]:g}ms"
+        ]
+
+        return {
+            "samples": self.samples,
+            "maxLagMs": round(self.max_lag * 1000, 3),
+            "histogram": dict(zip(bounds, self.lag_histogram)),
+            "slowCallbackThresholdMs": self.slow_callback_threshold * 1000,
+            "slowCallbacks": len(self.slow_callbacks),
+        }
+
+    def recent_slow_callbacks(self) -> list[dict[str, Any]]:
+        """
+        Get the recent loop stalls, with the stack that blocked the loop.
+
+        Returns:
+            list[dict[str, Any]]: The stalls, most recent first. The duration is None
+                while a stall is ongoing.
+        """
+
+        return [
+            {key: value for key, value in stall.items() if not key.startswith("_")}
+            for stall in reversed(self.slow_callbacks)
+        ]
+
+    async def profile(self, seconds: float, interval: float = 0.005) -> str:
+        """
+        Sample the stacks of all threads for a while.
+
+        Args:
+            seconds (float): How long to sample, capped to MAX_PROFILE_SECONDS.
+            interval (float): Time between samples, in seconds.
+
+        Returns:
+            str: The samples in collapsed stack format ("thread;frame;frame count"),
+                the input format of flamegraph tools.
+        """
+
+        async with self._profile_lock:
+            stacks = await asyncio.to_thread(
+                self._sample, min(seconds, MAX_PROFILE_SECONDS), interval
+            )
+
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            expected = time.monotonic() + HEARTBEAT_INTERVAL
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            self._heartbeat_at = now
+
+            lag = max(now - expected, 0.0)
+            self.samples += 1
+            self.max_lag = max(self.max_lag, lag)
+
+            lag_ms = lag * 1000
+            bucket = next(
+                (index for index, bound in enumerate(LAG_BUCKETS) if lag_ms <= bound),
+                len(LAG_BUCKETS),
+            )
+            self.lag_histogram[bucket] += 1
+
+    def _watchdog_loop(self) -> None:
+        stall: dict[str, Any] | None = None
+
+        while not self._stopped.wait(self.slow_callback_threshold / 2):
+            blocked = time.monotonic() - self._heartbeat_at - HEARTBEAT_INTERVAL
+
+            if blocked < self.slow_callback_threshold:
+                if stall is not None:
+                    # The loop recovered, the stall lasted until the last heartbeat
+                    stall["durationMs"] = round(
+                        (self._heartbeat_at - stall["_started"]) * 1000, 1
+                    )
+                    stall = None
+                continue
+
+            if stall is not None or self._loop_thread_id is None:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stall = {
+                "_started": self._heartbeat_at + HEARTBEAT_INTERVAL,
+                "detectedAt": time.time(),
+                "durationMs": None,
+                "stack": traceback.format_stack(frame) if frame else [],
+            }
+            self.slow_callbacks.append(stall)
+            logger.warning("Event loop blocked for over %.0f ms", blocked * 1000)
+
+    def _sample(self, seconds: float, interval: float) -> Counter[str]:
+        stacks: Counter[str] = Counter()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                name = names.get(thread_id, str(thread_id))
+                stacks[";".join([name, *_collapse(frame)])] += 1
+
+            time.sleep(interval)
+
+        return stacks
+
+
+def _collapse(frame: FrameType | None) -> list[str]:
+    frames: list[str] = []
+
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_qualname} ({code.co_filename})")
+        frame = frame.f_back
+
+    frames.reverse()
+    return frames
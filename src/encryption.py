@@ -5,19 +5,26 @@ import hashlib
 import json
 import os
 import uuid
+from pathlib import Path
 from typing import Any, Final
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+from config import DATA_DIR
+
+# The key is shared by all worker processes, so notifications decrypt no matter
+# which worker sent them
+KEY_PATH: Path = DATA_DIR / "encryption.key"
+
 
 class EncryptionHandler:
     _instance: EncryptionHandler | None = None
 
     def __init__(self):
         EncryptionHandler._instance = self
-        self.key: Final[str] = str(uuid.uuid4())
+        self.key: Final[str] = self._load_key()
 
     @classmethod
     def get_instance(cls) -> EncryptionHandler:
@@ -37,6 +44,36 @@ class EncryptionHandler:
 
         return self.key
 
+    @staticmethod
+    def _load_key() -> str:
+        """
+        Read the persisted key, creating it if it does not exist yet.
+
+        Returns:
+            str: The encryption key.
+        """
+
+        try:
+            return KEY_PATH.read_text().strip()
+        except FileNotFoundError:
+            pass
+
+        KEY_PATH.parent.mkdir(parents=True, exist_ok=True)
+        partial = KEY_PATH.with_suffix(f".{os.getpid()}.part")
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as file:
+            _ = file.write(str(uuid.uuid4()))
+
+        try:
+            # Linking fails if another process created the key first, its key wins
+            os.link(partial, KEY_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            partial.unlink()
+
+        return KEY_PATH.read_text().strip()
+
     def encrypt_notification(self, payload: dict[str, Any]) -> str:
         """
         Encrypts the notification payload using AES encryption with a randomly generated IV.
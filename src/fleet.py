@@ -0,0 +1,477 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any
+
+import httpx
+import uvicorn
+from fastapi import (
+    APIRouter,
+    FastAPI,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.websockets import WebSocketState
+from websockets.asyncio.client import ClientConnection, unix_connect
+from websockets.exceptions import WebSocketException
+
+from config import DATA_DIR, FLEET_CONFIG, HOST, PORT
+from logs import LogPipeline
+from ws_compression import CompressedWebSocketProtocol
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR: Path = DATA_DIR / "printers"
+
+# Delay before restarting a crashed shard, doubled per crash up to the maximum
+RESTART_DELAY: float = 1.0
+RESTART_DELAY_MAX: float = 60.0
+
+# Time a shard has to run to reset the restart delay, in seconds
+RESTART_RESET_AFTER: float = 300.0
+
+# Time a shard has to exit after being asked to, in seconds
+STOP_TIMEOUT: float = 10.0
+
+# Time a shard may take to report its load, in seconds
+STATS_TIMEOUT: float = 2.0
+
+NAME_PATTERN: re.Pattern[str] = re.compile(r"^[\w.-]+$")
+
+# Headers describing a single connection, which are not forwarded
+HOP_BY_HOP_HEADERS: set[str] = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+}
+
+CLOCK_TICKS: int = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE: int = os.sysconf("SC_PAGE_SIZE")
+
+
+class Shard:
+    """
+    A worker process serving a single printer.
+
+    The worker is a regular proxy process with its own event loop, DataPoller and
+    websocket hub, listening on a unix socket in its own data directory. It is
+    restarted with increasing delays when it dies.
+    """
+
+    def __init__(self, name: str, host: str, username: str, password: str):
+        """
+        Args:
+            name (str): The name of the printer, used in the URL of its routes.
+            host (str): The URL of the printer's PrusaLink.
+            username (str): The PrusaLink username.
+            password (str): The PrusaLink password.
+        """
+
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid printer name: {name}")
+
+        self.name: str = name
+        self.host: str = host
+        self.username: str = username
+        self.password: str = password
+        self.directory: Path = SHARDS_DIR / name
+        self.socket_path: Path = self.directory / "http.sock"
+
+        self.process: asyncio.subprocess.Process | None = None
+        self.started_at: float | None = None
+        self.restarts: int = 0
+        self.client: httpx.AsyncClient = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=str(self.socket_path)),
+            base_url="http://shard",
+            timeout=None,
+        )
+
+        self._cpu_sample: tuple[float, float] | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self) -> None:
+        """
+        Stop the worker process, killing it if it does not exit in time.
+        """
+
+        if self._task:
+            _ = self._task.cancel()
+            self._task = None
+
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                _ = await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+            except TimeoutError:
+                self.process.kill()
+
+        await self.client.aclose()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def report(self) -> dict[str, Any]:
+        """
+        Describe the load of the shard.
+
+        Returns:
+            dict[str, Any]: The process, its CPU and memory use and what it serves.
+        """
+
+        report: dict[str, Any] = {
+            "alive": self.is_alive(),
+            "pid": self.process.pid if self.process else None,
+            "uptime": time.monotonic() - self.started_at
+            if self.started_at is not None and self.is_alive()
+            else None,
+            "restarts": self.restarts,
+        }
+
+        if not self.is_alive():
+            return report
+
+        report |= self._process_load()
+
+        try:
+            async with asyncio.timeout(STATS_TIMEOUT):
+                printer, websocket = await asyncio.gather(
+                    self.client.get("/proxy/stats/printer"),
+                    self.client.get("/proxy/stats/websocket"),
+                )
+            report["online"] = printer.json()["online"]
+            report["connections"] = websocket.json()["connections"]
+        except (httpx.HTTPError, TimeoutError, ValueError, KeyError) as e:
+            report["error"] = repr(e)
+
+        return report
+
+    def environment(self) -> dict[str, str]:
+        return os.environ | {
+            "PRUSA_OCTOAPP_PROXY_DATA_DIR": str(self.directory),
+            "PRUSA_OCTOAPP_PROXY_PRINTER_HOST": self.host,
+            "PRUSA_OCTOAPP_PROXY_PRINTER_USERNAME": self.username,
+            "PRUSA_OCTOAPP_PROXY_PRINTER_PASSWORD": self.password,
+            "PRUSA_OCTOAPP_PROXY_UNIX_SOCKET": str(self.socket_path),
+            "PRUSA_OCTOAPP_PROXY_ROOT_PATH": f"/printers/{self.name}",
+            # The output is forwarded line by line
+            "PYTHONUNBUFFERED": "1",
+        }
+
+    async def _supervise(self) -> None:
+        restarts = 0
+
+        while True:
+            started = time.monotonic()
+
+            try:
+                await self._run()
+            except OSError as e:
+                logger.error("Could not start shard %s: %s", self.name, e)
+
+            if time.monotonic() - started > RESTART_RESET_AFTER:
+                restarts = 0
+
+            delay = min(RESTART_DELAY * 2**restarts, RESTART_DELAY_MAX)
+            restarts += 1
+            self.restarts += 1
+            logger.info("Restarting shard %s in %.0fs", self.name, delay)
+            await asyncio.sleep(delay)
+
+    async def _run(self) -> None:
+        await asyncio.to_thread(self.directory.mkdir, parents=True, exist_ok=True)
+        self.socket_path.unlink(missing_ok=True)
+        self._cpu_sample = None
+
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            str(Path(__file__).with_name("main.py")),
+            env=self.environment(),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        self.started_at = time.monotonic()
+        logger.info("Shard %s started as process %d", self.name, self.process.pid)
+
+        assert self.process.stdout is not None
+        output = logging.getLogger(f"shard.{self.name}")
+        while line := await self.process.stdout.readline():
+            # Already rate limited by the shard
+            output.info(
+                "%s", line.decode(errors="replace").rstrip(), extra={"unlimited": True}
+            )
+
+        code = await self.process.wait()
+        logger.warning("Shard %s exited with code %d", self.name, code)
+
+    def _process_load(self) -> dict[str, Any]:
+        assert self.process is not None
+
+        try:
+            stat = Path(f"/proc/{self.process.pid}/stat").read_text()
+            statm = Path(f"/proc/{self.process.pid}/statm").read_text()
+        except OSError:
+            return {}
+
+        # The fields after the command name, which may contain spaces
+        fields = stat.rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        now = time.monotonic()
+
+        cpu_percent = None
+        if self._cpu_sample is not None:
+            sampled_at, sampled_cpu = self._cpu_sample
+            cpu_percent = round(
+                (cpu_seconds - sampled_cpu) / max(now - sampled_at, 1e-6) * 100, 1
+            )
+        self._cpu_sample = (now, cpu_seconds)
+
+        return {
+            "cpuSeconds": cpu_seconds,
+            # Since the previous report
+            "cpuPercent": cpu_percent,
+            "rssBytes": int(statm.split()[1]) * PAGE_SIZE,
+        }
+
+
+class FleetSupervisor:
+    """
+    Serves many printers by running each one in its own worker process.
+
+    All state of the proxy lives in per-process singletons, so every printer gets a
+    process of its own, which the operating system spreads across the cores. A front
+    router forwards the routes under /printers/<name>/ to the printer's process.
+    """
+
+    _instance: FleetSupervisor | None = None
+
+    def __init__(self, printers: list[dict[str, str]]):
+        """
+        Args:
+            printers (list[dict[str, str]]): The printers, each with a name, host,
+                username and password.
+        """
+
+        FleetSupervisor._instance = self
+
+        self.shards: dict[str, Shard] = {}
+        for printer in printers:
+            shard = Shard(
+                printer["name"],
+                printer["host"],
+                printer.get("username", "maker"),
+                printer["password"],
+            )
+            if shard.name in self.shards:
+                raise ValueError(f"Duplicate printer name: {shard.name}")
+            self.shards[shard.name] = shard
+
+    @classmethod
+    def get_instance(cls) -> FleetSupervisor:
+        if cls._instance is None:
+            raise ValueError("FleetSupervisor instance not initialized")
+        return cls._instance
+
+    @classmethod
+    def load(cls, path: Path) -> FleetSupervisor:
+        """
+        Create the supervisor from a JSON list of printers.
+
+        Args:
+            path (Path): The file listing the printers.
+
+        Returns:
+            FleetSupervisor: The supervisor.
+        """
+
+        return cls(json.loads(path.read_text()))
+
+    async def start(self) -> None:
+        for shard in self.shards.values():
+            shard.start()
+
+    async def stop(self) -> None:
+        _ = await asyncio.gather(*(shard.stop() for shard in self.shards.values()))
+
+    async def report(self) -> dict[str, Any]:
+        """
+        Describe the load of every shard.
+
+        Returns:
+            dict[str, Any]: The number of shards alive and the load of each shard.
+        """
+
+        reports = await asyncio.gather(
+            *(shard.report() for shard in self.shards.values())
+        )
+
+        return {
+            "cpus": os.cpu_count(),
+            "shards": len(self.shards),
+            "alive": sum(report["alive"] for report in reports),
+            "printers": dict(zip(self.shards, reports)),
+        }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    supervisor = FleetSupervisor.load(FLEET_CONFIG)
+    await supervisor.start()
+
+    yield
+
+    await supervisor.stop()
+
+
+def app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    return app
+
+
+router = APIRouter()
+
+
+@router.get("/fleet/stats")
+async def fleet_stats():
+    return await FleetSupervisor.get_instance().report()
+
+
+@router.api_route(
+    "/printers/{name}/{path:path}",
+    methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+)
+async def forward_request(name: str, path: str, request: Request) -> Response:
+    shard = FleetSupervisor.get_instance().shards.get(name)
+    if shard is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown printer"})
+
+    upstream = shard.client.build_request(
+        request.method,
+        f"/{path}",
+        params=request.query_params,
+        headers=_forwarded_headers(request.headers.items()),
+        content=request.stream(),
+    )
+
+    try:
+        response = await shard.client.send(upstream, stream=True)
+    except httpx.TransportError:
+        return JSONResponse(
+            status_code=502, content={"error": "Printer worker is unavailable"}
+        )
+
+    forwarded = StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        background=BackgroundTask(response.aclose),
+    )
+    # Appended as a list, so repeated headers like Set-Cookie are all passed on
+    forwarded.raw_headers.extend(
+        (key.lower(), value)
+        for key, value in response.headers.raw
+        if key.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS
+    )
+    return forwarded
+
+
+@router.websocket("/printers/{name}/{path:path}")
+async def forward_websocket(websocket: WebSocket, name: str, path: str) -> None:
+    shard = FleetSupervisor.get_instance().shards.get(name)
+    if shard is None:
+        await websocket.close(code=1008)
+        return
+
+    query = f"?{websocket.url.query}" if websocket.url.query else ""
+
+    try:
+        # Compressing the local hop only costs CPU
+        async with unix_connect(
+            str(shard.socket_path), f"ws://shard/{path}{query}", compression=None
+        ) as upstream:
+            await websocket.accept()
+            await _pump(websocket, upstream)
+    except (OSError, WebSocketException) as e:
+        logger.error("Could not reach shard %s: %r", name, e)
+
+    if websocket.client_state != WebSocketState.DISCONNECTED:
+        await websocket.close(
+            code=1011 if websocket.client_state == WebSocketState.CONNECTING else 1000
+        )
+
+
+async def _pump(websocket: WebSocket, upstream: ClientConnection) -> None:
+    async def to_upstream() -> None:
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("text") is not None:
+                    await upstream.send(message["text"])
+                elif message.get("bytes") is not None:
+                    await upstream.send(message["bytes"])
+        except (WebSocketDisconnect, WebSocketException):
+            pass
+
+    async def to_client() -> None:
+        try:
+            async for message in upstream:
+                if isinstance(message, str):
+                    await websocket.send_text(message)
+                else:
+                    await websocket.send_bytes(message)
+        except (WebSocketDisconnect, WebSocketException):
+            pass
+
+    # Whichever side closes first ends both directions
+    tasks = {asyncio.create_task(to_upstream()), asyncio.create_task(to_client())}
+    try:
+        _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            _ = task.cancel()
+        _ = await asyncio.wait(tasks)
+
+
+def _forwarded_headers(headers: Any) -> list[tuple[str, str]]:
+    return [
+        (key, value) for key, value in headers if key.lower() not in HOP_BY_HOP_HEADERS
+    ]
+
+
+def main():
+    LogPipeline.get_instance().start()
+
+    uvicorn.run(
+        app(),
+        host=HOST,
+        port=PORT,
+        ws=CompressedWebSocketProtocol or "auto",
+        log_config=None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+from gcode_cache import GcodeCache
+from prusa_link import PrusaLink
+from tracing import detached
+
+logger = logging.getLogger(__name__)
+
+# Errors of parsing truncated or corrupt files
+PARSE_ERRORS: tuple[type[Exception], ...] = (
+    zlib.error,
+    struct.error,
+    ValueError,
+    OSError,
+)
+
+# Bytes fetched from the start and end of a file to find its metadata
+HEAD_SIZE: int = 256 * 1024
+TAIL_SIZE: int = 256 * 1024
+
+BGCODE_MAGIC: bytes = b"GCDE"
+BGCODE_GCODE_BLOCK: int = 1
+BGCODE_THUMBNAIL_BLOCK: int = 5
+BGCODE_METADATA_BLOCKS: set[int] = {0, 2, 3, 4}
+
+TIME_PATTERN: re.Pattern[str] = re.compile(r"(\d+)\s*([dhms])")
+TIME_UNITS: dict[str, int] = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+
+METADATA_KEYS: dict[str, str] = {
+    "estimated printing time (normal mode)": "time",
+    "filament used [mm]": "length",
+    "filament used [cm3]": "volume",
+    "max_layer_z": "max_z",
+    # Cura
+    "TIME": "time_seconds",
+    "Filament used": "length_m",
+    "MINX": "min_x",
+    "MINY": "min_y",
+    "MINZ": "min_z",
+    "MAXX": "max_x",
+    "MAXY": "max_y",
+    "MAXZ": "max_z",
+}
+
+
+class GcodeAnalyzer:
+    """
+    Background analysis of gcode and binary gcode files.
+
+    Metadata is read from the file headers (fetched with Range requests), with a full
+    streaming parse of locally cached files as fallback. Parsing runs in a process pool,
+    results are cached by path, size and modification time and persisted to disk, so
+    requests only ever read precomputed results.
+
+    With multiple workers only the leader analyzes and persists results. The other
+    workers forward their requests to it and receive the results it publishes.
+    """
+
+    _instance: GcodeAnalyzer | None = None
+
+    def __init__(self, cache_path: Path, link: PrusaLink, workers: int = 1):
+        GcodeAnalyzer._instance = self
+
+        self.cache_path: Path = cache_path
+        self.link: PrusaLink = link
+        self.workers: int = workers
+
+        self._results: dict[str, dict[str, Any]] = {}
+        self._pending: dict[str, asyncio.Task[None]] = {}
+        self._pool: ProcessPoolExecutor | None = None
+        # Set on workers that do not analyze themselves, to pass requests to the leader
+        self.forward: Callable[[str, int, int], None] | None = None
+        # Set on the worker that analyzes for others, to share its results
+        self.publish: Callable[[str, dict[str, Any]], None] | None = None
+
+    @classmethod
+    def get_instance(cls) -> GcodeAnalyzer:
+        if cls._instance is None:
+            raise ValueError("GcodeAnalyzer instance not initialized")
+        return cls._instance
+
+    async def start(self) -> None:
+        """
+        Load the persisted results and start the worker processes.
+        """
+
+        self._results = await asyncio.to_thread(self._load)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    async def stop(self) -> None:
+        """
+        Cancel running analyses and stop the worker processes.
+        """
+
+        for task in list(self._pending.values()):
+            _ = task.cancel()
+
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def get(self, path: str, size: int, m_timestamp: int) -> dict[str, Any] | None:
+        """
+        Get the analysis of a file, scheduling it in the background if it is missing.
+
+        Args:
+            path (str): The path of the file.
+            size (int): The size of the file in bytes.
+            m_timestamp (int): The modification time of the file.
+
+        Returns:
+            dict[str, Any] | None: The OctoPrint gcodeAnalysis, or None if not analyzed yet.
+        """
+
+        key = GcodeCache.normalize(path)
+
+        if (result := self._current(key, size, m_timestamp)) is not None:
+            return result["analysis"]
+
+        if self.forward is not None:
+            self.forward(key, size, m_timestamp)
+        elif key not in self._pending and self._pool is not None:
+            task = asyncio.create_task(
+                self._analyze(key, size, m_timestamp), context=detached()
+            )
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        return None
+
+    def lookup(self, path: str) -> dict[str, Any] | None:
+        """
+        Get the latest analysis of a file without scheduling anything.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            dict[str, Any] | None: The OctoPrint gcodeAnalysis, or None if not analyzed yet.
+        """
+
+        result = self._results.get(GcodeCache.normalize(path))
+        return result["analysis"] if result is not None else None
+
+    def analyze(self, path: str, size: int, m_timestamp: int) -> None:
+        """
+        Schedule the analysis of a file for another worker, unless it is up to date.
+
+        Args:
+            path (str): The path of the file.
+            size (int): The size of the file in bytes.
+            m_timestamp (int): The modification time of the file.
+        """
+
+        key = GcodeCache.normalize(path)
+
+        if (result := self._current(key, size, m_timestamp)) is None:
+            _ = self.get(path, size, m_timestamp)
+        elif self.publish is not None:
+            # The worker missed the result, publish it again
+            self.publish(key, result)
+
+    def apply(self, key: str, result: dict[str, Any]) -> None:
+        """
+        Store a result published by the leader.
+
+        Args:
+            key (str): The normalized path of the file.
+            result (dict[str, Any]): The size, modification time and analysis of the file.
+        """
+
+        self._results[key] = result
+
+    async def reload(self) -> None:
+        """
+        Reload the results persisted by the leader.
+        """
+
+        self._results = await asyncio.to_thread(self._load)
+
+    def _current(self, key: str, size: int, m_timestamp: int) -> dict[str, Any] | None:
+        result = self._results.get(key)
+        if result is None or (result["size"], result["m_timestamp"]) != (
+            size,
+            m_timestamp,
+        ):
+            return None
+        return result
+
+    async def _analyze(self, key: str, size: int, m_timestamp: int) -> None:
+        metadata: dict[str, Any] = {}
+
+        head = await self.link.read_file_range(key, 0, HEAD_SIZE)
+        if head is not None:
+            metadata = await self._parse(key, parse_head, head)
+
+        tail: bytes | None = None
+        if "time" not in metadata and not head_is_bgcode(head):
+            tail = await self.link.read_file_range(key, -TAIL_SIZE, TAIL_SIZE)
+            if tail is not None:
+                metadata |= await self._parse(key, parse_text, tail)
+
+        cached_file = None
+        if "time" not in metadata or "max_x" not in metadata:
+            cached_file = GcodeCache.get_instance().cached(key)
+            if cached_file is not None:
+                metadata = (
+                    await self._parse(key, parse_file, cached_file.path) | metadata
+                )
+
+        if not metadata and head is None and tail is None and cached_file is None:
+            # Nothing could be read, try again on the next listing
+            return
+
+        # Files without metadata are stored too, so they are not fetched again until
+        # they change
+        result = self._results[key] = {
+            "size": size,
+            "m_timestamp": m_timestamp,
+            "analysis": to_gcode_analysis(metadata) if metadata else None,
+        }
+        if self.publish is not None:
+            self.publish(key, result)
+        await asyncio.to_thread(self._save, dict(self._results))
+
+    async def _parse(
+        self, key: str, parser: Callable[[Any], dict[str, Any]], data: bytes | Path
+    ) -> dict[str, Any]:
+        """
+        Run a parser in the worker processes.
+
+        Args:
+            key (str): The path of the file, for logging.
+            parser (Callable[[Any], dict[str, Any]]): The parser.
+            data (bytes | Path): The data or file to parse.
+
+        Returns:
+            dict[str, Any]: The metadata found, empty if the data could not be parsed.
+        """
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._pool, parser, data
+            )
+        except PARSE_ERRORS as e:
+            logger.warning("Could not parse %s: %s", key, e)
+            return {}
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        try:
+            return json.loads(self.cache_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, results: dict[str, dict[str, Any]]) -> None:
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        partial = self.cache_path.with_suffix(f".{os.getpid()}.part")
+        _ = partial.write_text(json.dumps(results))
+        _ = partial.replace(self.cache_path)
+
+
+def head_is_bgcode(head: bytes | None) -> bool:
+    return head is not None and head.startswith(BGCODE_MAGIC)
+
+
+def parse_head(head: bytes) -> dict[str, Any]:
+    """
+    Parse the metadata from the start of a gcode or binary gcode file.
+
+    Args:
+        head (bytes): The first bytes of the file.
+
+    Returns:
+        dict[str, Any]: The metadata found.
+    """
+
+    if head_is_bgcode(head):
+        return parse_bgcode(head)
+    return parse_text(head)
+
+
+def parse_bgcode(data: bytes) -> dict[str, Any]:
+    """
+    Parse the metadata blocks of a binary gcode file, stopping at the first gcode block.
+
+    Args:
+        data (bytes): The start of the file.
+
+    Returns:
+        dict[str, Any]: The metadata found.
+    """
+
+    metadata: dict[str, Any] = {}
+
+    _, checksum_type = struct.unpack_from("<IH", data, 4)
+    checksum_size = 4 if checksum_type == 1 else 0
+    offset = 10
+
+    while offset + 8 <= len(data):
+        block_type, compression, uncompressed_size = struct.unpack_from(
+            "<HHI", data, offset
+        )
+        offset += 8
+
+        size = uncompressed_size
+        if compression != 0:
+            if offset + 4 > len(data):
+                break
+            (size,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+
+        if block_type == BGCODE_GCODE_BLOCK:
+            break
+
+        params_size = 6 if block_type == BGCODE_THUMBNAIL_BLOCK else 2
+        payload = data[offset + params_size : offset + params_size + size]
+        offset += params_size + size + checksum_size
+
+        if block_type not in BGCODE_METADATA_BLOCKS or len(payload) < size:
+            continue
+
+        if compression == 1:
+            payload = zlib.decompress(payload)
+        elif compression != 0:
+            # Heatshrink compressed metadata is not supported
+            continue
+
+        for line in payload.decode("utf-8", errors="replace").splitlines():
+            key, _, value = line.partition("=")
+            _add_metadata(metadata, key, value)
+
+    return metadata
+
+
+def parse_text(data: bytes) -> dict[str, Any]:
+    """
+    Parse the metadata comments of a chunk of a plain gcode file.
+
+    Args:
+        data (bytes): Part of the file.
+
+    Returns:
+        dict[str, Any]: The metadata found.
+    """
+
+    metadata: dict[str, Any] = {}
+
+    for line in data.decode("utf-8", errors="replace").splitlines():
+        if not line.startswith(";"):
+            continue
+
+        comment = line[1:].strip()
+        separator = "=" if "=" in comment else ":"
+        key, _, value = comment.partition(separator)
+        _add_metadata(metadata, key, value)
+
+    return metadata
+
+
+def parse_file(path: Path) -> dict[str, Any]:
+    """
+    Parse a whole gcode file, collecting metadata comments and the printed area.
+
+    Args:
+        path (Path): The gcode file.
+
+    Returns:
+        dict[str, Any]: The metadata found.
+    """
+
+    metadata: dict[str, Any] = {}
+
+    if path.suffix.lower() == ".bgcode":
+        with path.open("rb") as file:
+            return parse_bgcode(file.read(HEAD_SIZE * 4))
+
+    x = y = z = 0.0
+    area = [float("inf")] * 3 + [float("-inf")] * 3
+
+    with path.open("rb") as file:
+        for raw_line in file:
+            if raw_line.startswith(b";"):
+                comment = raw_line[1:].decode("utf-8", errors="replace").strip()
+                key, _, value = comment.partition("=" if "=" in comment else ":")
+                _add_metadata(metadata, key, value)
+                continue
+
+            if not raw_line.startswith((b"G1 ", b"G0 ")):
+                continue
+
+            extruding = False
+            for word in raw_line.split(b";", 1)[0].split()[1:]:
+                try:
+                    value = float(word[1:])
+                except ValueError:
+                    continue
+
+                match word[:1]:
+                    case b"X":
+                        x = value
+                    case b"Y":
+                        y = value
+                    case b"Z":
+                        z = value
+                    case b"E":
+                        extruding = value > 0
+                    case _:
+                        pass
+
+            if extruding:
+                area = [
+                    min(area[0], x),
+                    min(area[1], y),
+                    min(area[2], z),
+                    max(area[3], x),
+                    max(area[4], y),
+                    max(area[5], z),
+                ]
+
+    if area[0] != float("inf"):
+        for name, value in zip(
+            ("min_x", "min_y", "min_z", "max_x", "max_y", "max_z"), area
+        ):
+            metadata[name] = value
+
+    return metadata
+
+
+def to_gcode_analysis(metadata: dict[str, Any]) -> dict[str, Any]:
+    """
+    Convert parsed metadata to OctoPrint's gcodeAnalysis format.
+
+    Args:
+        metadata (dict[str, Any]): The parsed metadata.
+
+    Returns:
+        dict[str, Any]: The gcodeAnalysis.
+    """
+
+    analysis: dict[str, Any] = {}
+
+    if "time" in metadata:
+        analysis["estimatedPrintTime"] = metadata["time"]
+
+    if "length" in metadata:
+        analysis["filament"] = {
+            "tool0": {"length": metadata["length"], "volume": metadata.get("volume", 0)}
+        }
+
+    if all(name in metadata for name in ("min_x", "min_y", "max_x", "max_y", "max_z")):
+        area = {
+            "minX": metadata["min_x"],
+            "minY": metadata["min_y"],
+            "minZ": metadata.get("min_z", 0.0),
+            "maxX": metadata["max_x"],
+            "maxY": metadata["max_y"],
+            "maxZ": metadata["max_z"],
+        }
+        analysis["printingArea"] = area
+        analysis["dimensions"] = {
+            "width": area["maxX"] - area["minX"],
+            "depth": area["maxY"] - area["minY"],
+            "height": area["maxZ"] - area["minZ"],
+        }
+
+    return analysis
+
+
+def parse_duration(value: str) -> int:
+    """
+    Parse a slicer duration like "1d 2h 3m 4s" to seconds.
+    """
+
+    return sum(
+        int(amount) * TIME_UNITS[unit] for amount, unit in TIME_PATTERN.findall(value)
+    )
+
+
+def _add_metadata(metadata: dict[str, Any], key: str, value: str) -> None:
+    name = METADATA_KEYS.get(key.strip())
+    if name is None:
+        return
+
+    value = value.strip()
+
+    try:
+        match name:
+            case "time":
+                metadata["time"] = parse_duration(value)
+            case "time_seconds":
+                metadata["time"] = int(float(value))
+            case "length_m":
+                metadata["length"] = float(value.rstrip("m")) * 1000
+            case "length" | "volume":
+                # Multi material files list one value per extruder
+                metadata[name] = sum(float(v) for v in value.split(",") if v.strip())
+            case _:
+                metadata[name] = float(value)
+    except ValueError:
+        pass
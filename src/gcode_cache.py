@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from array import array
+from pathlib import Path
+from typing import Any, Callable
+
+from data_poller import DataPoller
+from prusa_link import PrusaLink
+
+logger = logging.getLogger(__name__)
+
+# Comments slicers emit right before the first move of a new layer
+LAYER_MARKERS: tuple[bytes, ...] = (b";LAYER_CHANGE", b";LAYER:")
+
+# Longest time a worker that does not download waits for the leader to fetch a file
+LEADER_FETCH_WAIT: float = 300.0
+
+
+class CachedFile:
+    """
+    A gcode file downloaded from the printer, with its layer offset index.
+    """
+
+    def __init__(self, path: Path, size: int, m_timestamp: int, layers: array[int]):
+        self.path: Path = path
+        self.size: int = size
+        self.m_timestamp: int = m_timestamp
+        self.layers: array[int] = layers
+
+    def layer_range(self, first: int, last: int) -> tuple[int, int]:
+        """
+        Get the byte range covering the given layers.
+
+        Args:
+            first (int): The first layer (zero-based).
+            last (int): The last layer, inclusive.
+
+        Returns:
+            tuple[int, int]: The start and end offset, end exclusive.
+        """
+
+        if not self.layers:
+            return 0, self.size
+
+        first = max(0, min(first, len(self.layers) - 1))
+        start = self.layers[first]
+        end = self.layers[last + 1] if last + 1 < len(self.layers) else self.size
+        return start, max(start, end)
+
+
+class GcodeCache:
+    """
+    Local cache of gcode files from the printer.
+
+    Files are downloaded once and served from disk, so viewers can request byte ranges
+    without going through the printer's slow link. For every file a compact
+    layer-to-byte-offset index is built and stored next to it.
+
+    With multiple workers the directory is shared. Only the leader contacts the
+    printer, the other workers serve current copies from disk and have the leader
+    fetch the rest.
+    """
+
+    _instance: GcodeCache | None = None
+
+    def __init__(self, directory: Path, link: PrusaLink):
+        GcodeCache._instance = self
+
+        self.directory: Path = directory
+        self.link: PrusaLink = link
+        self._entries: dict[str, CachedFile] = {}
+        self._downloads: dict[str, asyncio.Task[CachedFile | None]] = {}
+        # Set on workers that do not download themselves, to pass fetches to the leader
+        self.forward: Callable[[str], None] | None = None
+        self._leader_fetches: dict[str, asyncio.Event] = {}
+
+    @classmethod
+    def get_instance(cls) -> GcodeCache:
+        if cls._instance is None:
+            raise ValueError("GcodeCache instance not initialized")
+        return cls._instance
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        """
+        Normalize a file path to its location on the USB storage.
+
+        Args:
+            path (str): A path like "/usb/file.gcode" or "file.gcode".
+
+        Returns:
+            str: The path relative to the USB storage.
+        """
+
+        path = path.lstrip("/")
+        return path.removeprefix("usb/")
+
+    def cached(self, path: str) -> CachedFile | None:
+        """
+        Get a file if it is already cached, without contacting the printer.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            CachedFile | None: The cached file, or None if it is not cached yet.
+        """
+
+        return self._entries.get(GcodeCache.normalize(path))
+
+    async def get(self, path: str) -> CachedFile | None:
+        """
+        Get a file from the cache, downloading and indexing it if needed.
+        Concurrent requests for the same file share a single download.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            CachedFile | None: The cached file, or None if it does not exist on the printer.
+        """
+
+        key = GcodeCache.normalize(path)
+
+        if (task := self._downloads.get(key)) is None:
+            task = asyncio.create_task(self._fetch(key))
+            self._downloads[key] = task
+            task.add_done_callback(lambda _: self._downloads.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    def fetched(self, key: str | None = None) -> None:
+        """
+        Wake the requests waiting for the leader to fetch a file.
+
+        Args:
+            key (str | None): The normalized path of the file, None for all files when
+                the leader is gone.
+        """
+
+        for waiting in list(self._leader_fetches) if key is None else [key]:
+            if (fetch := self._leader_fetches.pop(waiting, None)) is not None:
+                fetch.set()
+
+    def file_position(self, path: str, progress: float) -> int | None:
+        """
+        Estimate the current position in a cached file from the print progress.
+
+        Args:
+            path (str): The path of the file.
+            progress (float): The print progress in percent.
+
+        Returns:
+            int | None: The byte offset, or None if the file is not cached.
+        """
+
+        if (entry := self.cached(path)) is None:
+            return None
+
+        return min(entry.size, max(0, int(entry.size * progress / 100)))
+
+    async def _fetch(self, key: str) -> CachedFile | None:
+        file_path = self.directory / (
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + Path(key).suffix.lower()
+        )
+
+        # The polled file listing tells whether the local copy is current, so files
+        # are served without asking the printer, even while it is offline
+        listed = self._listed(key)
+
+        if (forward := self.forward) is not None:
+            return await self._fetch_from_leader(key, file_path, listed, forward)
+
+        if listed is None:
+            info = await self.link.get_file(key)
+            if info is None:
+                # Unreachable, circuit breaker open or deleted, serve what we have
+                entry = self._entries.get(key) or await asyncio.to_thread(
+                    _load, file_path
+                )
+                if entry is not None:
+                    self._entries[key] = entry
+                return entry
+
+            listed = int(info.get("size", 0)), int(info.get("m_timestamp", 0))
+
+        size, m_timestamp = listed
+
+        entry = self._entries.get(key)
+        if entry is not None and (entry.size, entry.m_timestamp) == (size, m_timestamp):
+            return entry
+
+        entry = await asyncio.to_thread(_load, file_path, size, m_timestamp)
+
+        if entry is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            partial = file_path.with_suffix(f".{os.getpid()}.part")
+
+            if not await self.link.download_file(key, partial):
+                partial.unlink(missing_ok=True)
+                return None
+
+            _ = partial.replace(file_path)
+            entry = await asyncio.to_thread(_store, file_path, m_timestamp)
+
+        self._entries[key] = entry
+        return entry
+
+    async def _fetch_from_leader(
+        self,
+        key: str,
+        file_path: Path,
+        listed: tuple[int, int] | None,
+        forward: Callable[[str], None],
+    ) -> CachedFile | None:
+        """
+        Serve a file from the shared directory, having the leader fetch it first
+        unless the copy there matches the listing.
+        """
+
+        entry = self._entries.get(key)
+        if listed is not None:
+            if entry is not None and (entry.size, entry.m_timestamp) == listed:
+                return entry
+            if (
+                entry := await asyncio.to_thread(_load, file_path, *listed)
+            ) is not None:
+                self._entries[key] = entry
+                return entry
+
+        fetch = self._leader_fetches.setdefault(key, asyncio.Event())
+        forward(key)
+        try:
+            _ = await asyncio.wait_for(fetch.wait(), LEADER_FETCH_WAIT)
+        except TimeoutError:
+            logger.warning("Leader did not fetch %s, serving the cached copy", key)
+
+        # Whatever copy the leader left, it may have kept the old one while offline
+        if (loaded := await asyncio.to_thread(_load, file_path)) is not None:
+            entry = self._entries[key] = loaded
+        return entry
+
+    @staticmethod
+    def _listed(key: str) -> tuple[int, int] | None:
+        """
+        Find a file in the last polled file listing.
+
+        Args:
+            key (str): The normalized path of the file.
+
+        Returns:
+            tuple[int, int] | None: The size and modification time of the file, or
+                None if it is not listed.
+        """
+
+        try:
+            files = DataPoller.get_instance().files
+        except ValueError:
+            return None
+
+        children: list[dict[str, Any]] = (files or {}).get("children", [])
+        *folders, name = key.split("/")
+        for folder in folders:
+            children = next(
+                (
+                    child.get("children", [])
+                    for child in children
+                    if child.get("type") == "FOLDER" and child.get("name") == folder
+                ),
+                [],
+            )
+
+        for child in children:
+            if child.get("name") == name and child.get("type") != "FOLDER":
+                return int(child.get("size", 0)), int(child.get("m_timestamp", 0))
+
+        return None
+
+
+def build_layer_index(path: Path) -> array[int]:
+    """
+    Build the layer index of a gcode file in a single streaming pass.
+
+    Layer starts are taken from slicer layer comments. Files without them fall back to
+    the offsets of moves that raise the Z axis.
+
+    Args:
+        path (Path): The gcode file.
+
+    Returns:
+        array[int]: The byte offset of the start of every layer.
+    """
+
+    markers: array[int] = array("Q")
+    z_moves: array[int] = array("Q")
+    current_z = float("-inf")
+    offset = 0
+
+    if path.suffix.lower() == ".bgcode":
+        # Binary gcode is block compressed, offsets into it are meaningless
+        return markers
+
+    with path.open("rb") as file:
+        for line in file:
+            if line.startswith(LAYER_MARKERS):
+                markers.append(offset)
+            elif line.startswith((b"G1 ", b"G0 ")) and b"Z" in line:
+                for word in line.split(b";", 1)[0].split():
+                    if word.startswith(b"Z"):
+                        try:
+                            z = float(word[1:])
+                        except ValueError:
+                            break
+                        if z > current_z:
+                            z_moves.append(offset)
+                            current_z = z
+                        break
+
+            offset += len(line)
+
+    return markers if markers else z_moves
+
+
+def _index_paths(path: Path) -> tuple[Path, Path]:
+    return path.with_name(path.name + ".layers"), path.with_name(path.name + ".json")
+
+
+def _store(path: Path, m_timestamp: int) -> CachedFile:
+    """
+    Index a downloaded file and persist the index next to it.
+    """
+
+    layers = build_layer_index(path)
+    layers_path, meta_path = _index_paths(path)
+    size = path.stat().st_size
+
+    with layers_path.open("wb") as file:
+        layers.tofile(file)
+    _ = meta_path.write_text(
+        json.dumps({"size": size, "m_timestamp": m_timestamp, "layers": len(layers)})
+    )
+
+    return CachedFile(path, size, m_timestamp, layers)
+
+
+def _load(
+    path: Path, size: int | None = None, m_timestamp: int | None = None
+) -> CachedFile | None:
+    """
+    Load a previously cached file, if it matches the printer's copy. Without a size
+    and modification time, whatever copy is cached is loaded.
+    """
+
+    layers_path, meta_path = _index_paths(path)
+
+    try:
+        meta = json.loads(meta_path.read_text())
+        if size is None or m_timestamp is None:
+            size, m_timestamp = int(meta["size"]), int(meta["m_timestamp"])
+        if (meta["size"], meta["m_timestamp"]) != (size, m_timestamp):
+            return None
+        if path.stat().st_size != size:
+            return None
+
+        layers: array[int] = array("Q")
+        with layers_path.open("rb") as file:
+            layers.fromfile(file, meta["layers"])
+    except (OSError, ValueError, KeyError, EOFError):
+        return None
+
+    return CachedFile(path, size, m_timestamp, layers)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections import deque
+from enum import Enum
+
+from data_poller import DataPoller
+from printer_status import PrinterState
+from prusa_link import PrusaLink
+from websocket import WebSocketHandler
+
+logger = logging.getLogger(__name__)
+
+# Command-to-UI latency above which a warning is logged, in seconds
+LATENCY_BUDGET: float = 0.3
+
+
+class JobController:
+    """
+    Executes job commands on the printer and reflects them in the UI right away.
+
+    As soon as the printer accepts a command, the expected state is broadcast to all
+    websocket clients and a confirmation poll is started, without waiting for the next
+    poll tick.
+    """
+
+    _instance: JobController | None = None
+
+    class Command(Enum):
+        START = "start"
+        PAUSE = "pause"
+        RESUME = "resume"
+        CANCEL = "cancel"
+
+    # The state shown after a command, and the printer states confirming it
+    OPTIMISTIC_STATES: dict[Command, tuple[PrinterState, set[PrinterState]]] = {
+        Command.START: (
+            PrinterState.PRINTING,
+            {PrinterState.PRINTING, PrinterState.BUSY},
+        ),
+        Command.PAUSE: (PrinterState.PAUSED, {PrinterState.PAUSED}),
+        Command.RESUME: (PrinterState.PRINTING, {PrinterState.PRINTING}),
+        Command.CANCEL: (
+            PrinterState.STOPPED,
+            {
+                PrinterState.STOPPED,
+                PrinterState.IDLE,
+                PrinterState.READY,
+                PrinterState.FINISHED,
+            },
+        ),
+    }
+
+    def __init__(self, link: PrusaLink):
+        JobController._instance = self
+
+        self.link: PrusaLink = link
+        self.latencies: deque[float] = deque(maxlen=100)
+        self.selected_path: str | None = None
+
+    @classmethod
+    def get_instance(cls) -> JobController:
+        if cls._instance is None:
+            raise ValueError("JobController instance not initialized")
+        return cls._instance
+
+    async def execute(
+        self, command: JobController.Command, path: str | None = None
+    ) -> bool:
+        """
+        Execute a job command.
+
+        Args:
+            command (Command): The command to execute.
+            path (str | None): The file to print, required for Command.START.
+
+        Returns:
+            bool: True if the printer accepted the command, False otherwise.
+        """
+
+        started = time.perf_counter()
+        data_poller = DataPoller.get_instance()
+        current_print = data_poller.current_print
+
+        match command:
+            case JobController.Command.START:
+                accepted = path is not None and await self.link.start_print(path)
+            case JobController.Command.PAUSE if current_print is not None:
+                accepted = await self.link.pause_job(current_print.print_id)
+            case JobController.Command.RESUME if current_print is not None:
+                accepted = await self.link.resume_job(current_print.print_id)
+            case JobController.Command.CANCEL if current_print is not None:
+                accepted = await self.link.stop_job(current_print.print_id)
+            case _:
+                accepted = False
+
+        if not accepted:
+            return False
+
+        state, accepted_states = JobController.OPTIMISTIC_STATES[command]
+        await WebSocketHandler.get_instance().apply_optimistic_state(
+            state, accepted_states
+        )
+        data_poller.request_update(DataPoller.Resource.STATUS, DataPoller.Resource.JOB)
+
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        if latency > LATENCY_BUDGET:
+            logger.warning(
+                "Job command %s took %.0f ms to reach the UI",
+                command.value,
+                latency * 1000,
+            )
+
+        return True
+
+    def toggle_command(self) -> JobController.Command:
+        """
+        Get the command that toggles the pause state of the current job.
+
+        Returns:
+            Command: Command.PAUSE if the printer is printing, Command.RESUME otherwise.
+        """
+
+        printer_status = DataPoller.get_instance().printer_status
+        if printer_status is not None and printer_status.state == PrinterState.PAUSED:
+            return JobController.Command.RESUME
+        return JobController.Command.PAUSE
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
+
+from config import LOG_FORMAT, LOG_LEVEL
+
+# Records waiting for the writer thread, later records are dropped
+QUEUE_SIZE: int = 10000
+
+# Lines of one message type let through at once, and refilled per second
+RATE_LIMIT_BURST: float = 10.0
+RATE_LIMIT_PER_SECOND: float = 0.2
+
+# While a message type is over its rate limit, one in this many lines is let through
+SAMPLE_EVERY: int = 100
+
+# Message types tracked by the rate limiter, the least recently seen are forgotten
+MAX_MESSAGE_TYPES: int = 1000
+
+# Attributes every LogRecord has, everything else was passed in extra
+RECORD_ATTRIBUTES: set[str] = set(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "taskName",
+}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how often a message type is logged.
+
+    The message type is the logger and the unformatted message, so messages have to
+    pass their values as arguments instead of formatting them. Access log lines all
+    share one message, their type is the request method, path and status instead.
+    Each type has a token bucket; once it is empty only every SAMPLE_EVERY-th line is
+    let through, carrying the number of lines suppressed since the previous one. Records logged with
+    extra={"unlimited": True} are never limited.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Tokens, time of the last refill and suppressed lines per message type
+        self.buckets: dict[tuple[str, str], list[float]] = {}
+        self.suppressed: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "unlimited", False):
+            return True
+
+        key = (record.name, message_type(record))
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = [RATE_LIMIT_BURST, now, 0]
+                if len(self.buckets) >= MAX_MESSAGE_TYPES:
+                    del self.buckets[next(iter(self.buckets))]
+            # Reinserted to keep the buckets in least recently seen order
+            self.buckets[key] = bucket
+
+            tokens = min(
+                bucket[0] + (now - bucket[1]) * RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST
+            )
+            bucket[1] = now
+
+            if tokens < 1 and bucket[2] + 1 < SAMPLE_EVERY:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+
+            bucket[0] = max(tokens - 1, 0)
+            if bucket[2]:
+                record.suppressed = int(bucket[2])
+                bucket[2] = 0
+
+        return True
+
+
+def message_type(record: logging.LogRecord) -> str:
+    """
+    Get the type of a message the rate limit applies to.
+
+    Args:
+        record (logging.LogRecord): The record.
+
+    Returns:
+        str: The unformatted message, or the method, path and status of access log lines.
+    """
+
+    if (
+        record.name == "uvicorn.access"
+        and isinstance(record.args, tuple)
+        and len(record.args) == 5
+    ):
+        _, method, path, _, status = record.args
+        return f"{method} {str(path).split('?', 1)[0]} {status}"
+
+    return str(record.msg)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queues records for the writer thread, dropping them when the queue is full
+    instead of blocking the caller.
+    """
+
+    def __init__(self, records: queue.Queue[logging.LogRecord]):
+        super().__init__(records)
+        self.dropped: int = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if suppressed := getattr(record, "suppressed", 0):
+            line += f" ({suppressed} similar lines suppressed)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines, with the values passed in extra as fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key != "unlimited":
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class LogPipeline:
+    """
+    Routes all logging through a bounded in-memory queue to a writer thread.
+
+    Logging only formats the record and puts it on the queue, so a slow stdout, for
+    example under journald pressure, never blocks the event loop. Repetitive lines are
+    rate limited per message type, and levels can be changed at runtime.
+    """
+
+    _instance: LogPipeline | None = None
+
+    def __init__(
+        self, level: str = LOG_LEVEL, json_format: bool = LOG_FORMAT == "json"
+    ):
+        LogPipeline._instance = self
+
+        self.level: str = level
+        self.json_format: bool = json_format
+        self.rate_limit: RateLimitFilter = RateLimitFilter()
+
+        self._records: queue.Queue[logging.LogRecord] = queue.Queue(QUEUE_SIZE)
+        self._handler: DroppingQueueHandler = DroppingQueueHandler(self._records)
+        self._listener: QueueListener | None = None
+
+    @classmethod
+    def get_instance(cls) -> LogPipeline:
+        if cls._instance is None:
+            cls._instance = LogPipeline()
+        return cls._instance
+
+    def start(self) -> None:
+        """
+        Replace the handlers of the root logger with the queue and start the writer.
+        """
+
+        if self._listener is not None:
+            return
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if self.json_format else TextFormatter())
+
+        self._handler.addFilter(self.rate_limit)
+        self._listener = QueueListener(self._records, output)
+        self._listener.start()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(self.level)
+
+        _ = atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """
+        Write the queued records and stop the writer.
+        """
+
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def set_level(self, name: str, level: str) -> None:
+        """
+        Change the level of a logger.
+
+        Args:
+            name (str): The name of the logger, "root" for the root logger.
+            level (str): The level name, or "NOTSET" to inherit the parent's level.
+        """
+
+        logging.getLogger(name).setLevel(level.upper())
+
+    def report(self) -> dict[str, Any]:
+        """
+        Describe the logging pipeline.
+
+        Returns:
+            dict[str, Any]: The levels of the configured loggers and the line counts.
+        """
+
+        levels = {"root": logging.getLevelName(logging.getLogger().level)}
+        for name, logger in sorted(logging.root.manager.loggerDict.items()):
+            if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+                levels[name] = logging.getLevelName(logger.level)
+
+        return {
+            "levels": levels,
+            "queued": self._records.qsize(),
+            "dropped": self._handler.dropped,
+            "suppressed": self.rate_limit.suppressed,
+        }
@@ -1,24 +1,84 @@
 from contextlib import asynccontextmanager
+from typing import Any
 
 import uvicorn
 from fastapi import FastAPI
 
+from cluster import ClusterNode
+from config import (
+    DATA_DIR,
+    HOST,
+    PORT,
+    PRINTER_HOST,
+    PRINTER_PASSWORD,
+    PRINTER_USERNAME,
+    ROOT_PATH,
+    TIMELAPSE_SNAPSHOT_URL,
+    UNIX_SOCKET,
+    WORKERS,
+)
 from data_poller import DataPoller
 from data_routes import router as data_router
+from diagnostics import Diagnostics
+from gcode_analysis import GcodeAnalyzer
+from gcode_cache import GcodeCache
+from job_control import JobController
+from logs import LogPipeline
 from notifications import NotificationHandler
 from octoprint_routes import router as octoprint_router
+from print_history import PrintHistory
+from proxy_routes import admin_router
+from proxy_routes import router as proxy_router
 from prusa_link import PrusaLink
+from static_responses import StaticResponse
+from telemetry import TelemetryStore
+from timelapse import Timelapse
 from websocket import WebSocketHandler
+from ws_compression import CompressedWebSocketProtocol
 
 
 def main():
-    uvicorn.run(app(), host="0.0.0.0", port=8000)
+    LogPipeline.get_instance().start()
+
+    options: dict[str, Any] = {
+        "host": HOST,
+        "port": PORT,
+        "uds": UNIX_SOCKET,
+        "root_path": ROOT_PATH,
+        "ws": CompressedWebSocketProtocol or "auto",
+        # Logged through the LogPipeline instead
+        "log_config": None,
+    }
+
+    if WORKERS > 1:
+        # Workers are separate processes, so the app has to be passed by name
+        uvicorn.run("main:app", factory=True, workers=WORKERS, **options)
+        return
+
+    uvicorn.run(app(), **options)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    prusa_link = PrusaLink("http://192.168.2.137", "maker", "izPjsV5TQJR4Eai")
+    prusa_link = PrusaLink(PRINTER_HOST, PRINTER_USERNAME, PRINTER_PASSWORD)
     data_poller = DataPoller(prusa_link)
+    print_history = PrintHistory(DATA_DIR / "history.sqlite3", prusa_link.host)
+    gcode_cache = GcodeCache(DATA_DIR / "gcode", prusa_link)
+    gcode_analyzer = GcodeAnalyzer(DATA_DIR / "analysis.json", prusa_link)
+    _ = JobController(prusa_link)
+    telemetry = TelemetryStore(prusa_link.host)
+    timelapse = Timelapse(DATA_DIR / "timelapse", prusa_link, TIMELAPSE_SNAPSHOT_URL)
+    diagnostics = Diagnostics()
+    cluster = (
+        ClusterNode(
+            data_poller,
+            NotificationHandler.get_instance(),
+            gcode_cache,
+            gcode_analyzer,
+        )
+        if WORKERS > 1
+        else None
+    )
 
     data_poller.subscribe(
         DataPoller.Event.PRINTER_STATUS, WebSocketHandler.get_instance().handle_update
@@ -26,23 +86,60 @@ async def lifespan(app: FastAPI):
     data_poller.subscribe(
         DataPoller.Event.PRINT_JOB, WebSocketHandler.get_instance().handle_update
     )
+    data_poller.subscribe(
+        DataPoller.Event.CONNECTION, WebSocketHandler.get_instance().handle_update
+    )
     data_poller.subscribe(
         DataPoller.Event.PRINT_JOB,
         NotificationHandler.get_instance().send_printing_notification,
+        leader_only=True,
+    )
+    data_poller.subscribe(
+        DataPoller.Event.PRINT_JOB_ENDED, print_history.record_job_end, leader_only=True
+    )
+    data_poller.subscribe(
+        DataPoller.Event.PRINTER_STATUS, timelapse.handle_status, leader_only=True
+    )
+    data_poller.subscribe(
+        DataPoller.Event.PRINT_JOB_ENDED, timelapse.handle_job_end, leader_only=True
     )
 
-    await data_poller.start()
+    await diagnostics.start()
+    StaticResponse.render_all()
+    await print_history.start()
+    await gcode_analyzer.start()
+    await timelapse.start()
+    if cluster:
+        await cluster.start()
+    else:
+        await data_poller.start()
+    await telemetry.start()
+    await WebSocketHandler.get_instance().start()
 
     yield
 
-    if data_poller.listen_task:
+    if cluster:
+        await cluster.stop()
+    elif data_poller.listen_task:
         _ = data_poller.listen_task.cancel()
 
+    await WebSocketHandler.get_instance().stop()
+    await telemetry.stop()
+    await timelapse.stop()
+    await gcode_analyzer.stop()
+    await print_history.stop()
+    await NotificationHandler.get_instance().close()
+    await diagnostics.stop()
+
 
 def app() -> FastAPI:
+    LogPipeline.get_instance().start()
+
     app = FastAPI(lifespan=lifespan)
     app.include_router(octoprint_router)
     app.include_router(data_router)
+    app.include_router(proxy_router)
+    app.include_router(admin_router)
     return app
 
 
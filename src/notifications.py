@@ -1,19 +1,39 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import logging
+import os
 import time
 from enum import Enum
+from pathlib import Path
 from pprint import pp
-from typing import Any
+from typing import Any, Callable
 
-import requests
+import httpx
 
+from config import DATA_DIR, RELAY_URL
 from encryption import EncryptionHandler
 from print_job import PrintJob
 from printer_status import PrinterStatus
+from tracing import Tracer, detached, span
 
-RELAY_URL: str = (
-    "https://europe-west1-octoapp-4e438.cloudfunctions.net/sendNotificationV2"
-)
+logger = logging.getLogger(__name__)
+
+DEVICES_PATH: Path = DATA_DIR / "devices.json"
+
+# Time after which a device that did not register again is dropped, in seconds
+DEVICE_TTL: float = 30 * 24 * 3600
+
+# Largest number of devices sent in a single relay request
+RELAY_MAX_TARGETS: int = 100
+
+# Time a relay request may take, in seconds
+RELAY_TIMEOUT: float = 2.0
+
+# Attempts per relay request, and the delay before trying again, in seconds
+RELAY_ATTEMPTS: int = 2
+RELAY_RETRY_DELAY: float = 1.0
 
 
 class NotificationHandler:
@@ -24,23 +44,46 @@ class NotificationHandler:
 
     def __init__(self):
         NotificationHandler._instance = self
-        self.devices: list[dict[str, str | None]] = []
+        # Registered devices by instance ID, or FCM token for devices without one
+        self.devices: dict[str, dict[str, Any]] = self._load()
+        # Set on workers that do not send notifications, to pass registrations to the leader
+        self.forward: Callable[[str, dict[str, Any]], None] | None = None
+        # Delivery results by device key, kept in memory only
+        self.deliveries: dict[str, dict[str, Any]] = {}
+        self.relay_requests: int = 0
+        self._client: httpx.AsyncClient | None = None
+        self._deliveries: set[asyncio.Task[None]] = set()
+
+    @staticmethod
+    def _device_key(data: dict[str, Any]) -> str | None:
+        return data.get("instanceId", None) or data.get("fcmToken", None)
 
     def register(self, data: dict[str, Any]):
         """
         Register a device with the notification handler.
+        Registering a known device again only refreshes it.
 
         Args:
             data (dict[str, Any]): The device data.
         """
 
-        self.devices.append(
-            {
-                "fcmToken": data.get("fcmToken", None),
-                "fcmFallbackToken": data.get("fcmTokenFallback", None),
-                "instanceId": data.get("instanceId", None),
-            }
-        )
+        if self.forward is not None:
+            self.forward("register", data)
+            return
+
+        if (key := self._device_key(data)) is None:
+            logger.warning(
+                "Device registered without instance ID or FCM token, ignoring"
+            )
+            return
+
+        self.devices[key] = {
+            "fcmToken": data.get("fcmToken", None),
+            "fcmFallbackToken": data.get("fcmTokenFallback", None),
+            "instanceId": data.get("instanceId", None),
+            "lastSeen": time.time(),
+        }
+        self._save()
 
     def unregister(self, data: dict[str, Any]):
         """
@@ -50,13 +93,57 @@ class NotificationHandler:
             data (dict[str, Any]): The device data.
         """
 
-        self.devices.remove(
-            {
-                "fcmToken": data.get("fcmToken", None),
-                "fcmFallbackToken": data.get("fcmTokenFallback", None),
-                "instanceId": data.get("instanceId", None),
-            }
-        )
+        if self.forward is not None:
+            self.forward("unregister", data)
+            return
+
+        if self.devices.pop(self._device_key(data) or "", None) is not None:
+            self._save()
+
+    def prune(self, invalid_tokens: set[str] | None = None) -> None:
+        """
+        Drop expired devices and devices whose FCM token is invalid.
+
+        Args:
+            invalid_tokens (set[str] | None): FCM tokens reported as invalid by the relay.
+        """
+
+        expired_before = time.time() - DEVICE_TTL
+        stale = [
+            key
+            for key, device in self.devices.items()
+            if device["lastSeen"] < expired_before
+            or (invalid_tokens and device["fcmToken"] in invalid_tokens)
+        ]
+
+        for key in stale:
+            del self.devices[key]
+            _ = self.deliveries.pop(key, None)
+
+        if stale:
+            logger.info(
+                "Dropped %d expired or invalid notification devices", len(stale)
+            )
+            self._save()
+
+    def reload(self) -> None:
+        """
+        Reload the registered devices from disk.
+        """
+
+        self.devices = self._load()
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        try:
+            return json.loads(DEVICES_PATH.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self) -> None:
+        DEVICES_PATH.parent.mkdir(parents=True, exist_ok=True)
+        partial = DEVICES_PATH.with_suffix(f".{os.getpid()}.part")
+        _ = partial.write_text(json.dumps(self.devices))
+        _ = partial.replace(DEVICES_PATH)
 
     @classmethod
     def get_instance(cls) -> NotificationHandler:
@@ -72,6 +159,38 @@ class NotificationHandler:
     def is_registered(cls) -> bool:
         return cls._instance is not None
 
+    async def close(self) -> None:
+        """
+        Wait for running deliveries and close the relay client.
+
+        Deliveries still running after the relay timeout are cancelled.
+        """
+
+        if self._deliveries:
+            _, pending = await asyncio.wait(self._deliveries, timeout=RELAY_TIMEOUT)
+            for task in pending:
+                _ = task.cancel()
+            if pending:
+                _ = await asyncio.wait(pending)
+
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Report the registered devices and their delivery results.
+
+        Returns:
+            dict[str, Any]: The number of relay requests and the results per device.
+        """
+
+        return {
+            "devices": len(self.devices),
+            "relayRequests": self.relay_requests,
+            "deliveries": self.deliveries,
+        }
+
     async def send_printing_notification(self, print_job: PrintJob | PrinterStatus):
         """
         Send a live printing notification to the app.
@@ -115,21 +234,105 @@ class NotificationHandler:
             "message": args.get("message", None),
         }
 
-        for device in self.devices:
-            notification_data = {
-                "targets": [
-                    {
-                        "fcmToken": device["fcmToken"],
-                        "fcmTokenFallback": device["fcmToken"],
-                        "instanceId": device["instanceId"],
-                    },
-                ],
-                "highPriority": True,
-                "androidData": EncryptionHandler.get_instance().encrypt_notification(
-                    android_push_data
-                ),
-                "apnsData": None,
-            }
-
-            # Make the request
-            _ = requests.post(RELAY_URL, timeout=float(2), json=notification_data)
+        self.prune()
+        if not self.devices:
+            return
+
+        # The payload is the same for every device, so it is encrypted once and all
+        # devices are sent in as few relay requests as possible
+        android_data = EncryptionHandler.get_instance().encrypt_notification(
+            android_push_data
+        )
+        devices = list(self.devices.items())
+        batches = [
+            devices[start : start + RELAY_MAX_TARGETS]
+            for start in range(0, len(devices), RELAY_MAX_TARGETS)
+        ]
+
+        # Delivered in the background, so a slow relay does not hold up the poll loop
+        task = asyncio.create_task(
+            self._deliver(android_data, batches), context=detached()
+        )
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(
+        self, android_data: str, batches: list[list[tuple[str, dict[str, Any]]]]
+    ) -> None:
+        with Tracer.get_instance().trace("relay.deliver", batches=len(batches)):
+            results = await asyncio.gather(
+                *(self._send_batch(android_data, batch) for batch in batches)
+            )
+
+        invalid_tokens = set().union(*results)
+        if invalid_tokens:
+            self.prune(invalid_tokens)
+
+    async def _send_batch(
+        self, android_data: str, batch: list[tuple[str, dict[str, Any]]]
+    ) -> set[str]:
+        """
+        Send one relay request for a batch of devices and record the result per device.
+
+        Returns:
+            set[str]: The FCM tokens the relay reported as invalid.
+        """
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=RELAY_TIMEOUT)
+
+        notification_data = {
+            "targets": [
+                {
+                    "fcmToken": device["fcmToken"],
+                    "fcmTokenFallback": device["fcmFallbackToken"],
+                    "instanceId": device["instanceId"],
+                }
+                for _, device in batch
+            ],
+            "highPriority": True,
+            "androidData": android_data,
+            "apnsData": None,
+        }
+
+        response: httpx.Response | None = None
+        for attempt in range(RELAY_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(RELAY_RETRY_DELAY)
+
+            self.relay_requests += 1
+            with span("relay.send", targets=len(batch), attempt=attempt) as relay:
+                try:
+                    response = await self._client.post(
+                        RELAY_URL, json=notification_data
+                    )
+                    relay.set(status=response.status_code)
+                except httpx.HTTPError as e:
+                    relay.set(error=repr(e))
+                    logger.error("Relay request failed: %r", e)
+                    response = None
+
+            # Client errors would fail again
+            if response is not None and not response.is_server_error:
+                break
+
+        invalid_tokens: set[str] = set()
+        if response is not None:
+            try:
+                invalid_tokens = set(response.json().get("invalidTokens", []))
+            except (ValueError, AttributeError):
+                pass
+
+        delivered = response is not None and response.is_success
+        now = time.time()
+        for key, device in batch:
+            result = self.deliveries.setdefault(
+                key, {"deliveredAt": None, "failures": 0}
+            )
+            if delivered and device["fcmToken"] not in invalid_tokens:
+                result["deliveredAt"] = now
+                result["failures"] = 0
+            else:
+                result["failures"] += 1
+
+        return invalid_tokens
@@ -1,20 +1,27 @@
-from pprint import pp
+import logging
 from typing import Any, cast
 
-from fastapi import Request, Response
+from fastapi import Query, Request, Response
 from fastapi.routing import APIRouter
 from pydantic import BaseModel, Field
-from starlette.responses import JSONResponse
+from starlette.responses import FileResponse, JSONResponse
 
 from data_poller import DataPoller
 from encryption import EncryptionHandler
+from gcode_analysis import GcodeAnalyzer
+from gcode_cache import GcodeCache
+from job_control import JobController
 from notifications import NotificationHandler
+from print_history import PrintHistory
+from static_responses import StaticResponse
+from timelapse import Timelapse
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
-@router.get("/api/currentuser")
-async def get_current_user():
+def _current_user() -> dict[str, Any]:
     return {
         "name": "prusa_admin",
         "groups": ["admins", "users"],
@@ -65,6 +72,14 @@ async def get_current_user():
     }
 
 
+CURRENT_USER = StaticResponse(_current_user)
+
+
+@router.get("/api/currentuser")
+async def get_current_user(request: Request) -> Response:
+    return CURRENT_USER.respond(request)
+
+
 class LoginRequest(BaseModel):
     passive: bool = False
     user: str | None = None
@@ -82,36 +97,43 @@ async def login(_login_data: LoginRequest, _response: Response):
     return login_response
 
 
-@router.get("/api/version")
-async def get_version():
+def _version() -> dict[str, Any]:
     return {"api": "0.1", "server": "1.11.4", "text": "OctoPrint 1.11.4"}
 
 
+VERSION = StaticResponse(_version)
+
+
+@router.get("/api/version")
+async def get_version(request: Request) -> Response:
+    return VERSION.respond(request)
+
+
 @router.get("/api/connection")
 async def get_connection():
-    if await DataPoller.get_instance().is_online():
-        return {
-            "current": {
-                "state": "Operational",
-                "port": "/dev/ttyUSB0",
-                "baudrate": 115200,
-                "printerProfile": "_default",
-            },
-            "options": {
-                "ports": ["/dev/ttyUSB0"],
-                "baudrates": [115200],
-                "printerProfiles": [{"id": "_default", "name": "Prusa MK3/4"}],
-            },
-        }
-    else:
-        print("Printer is offline")
-        return {}
+    online = await DataPoller.get_instance().is_online()
+    if not online:
+        logger.debug("Printer is offline")
+
+    return {
+        "current": {
+            "state": "Operational" if online else "Closed",
+            "port": "/dev/ttyUSB0" if online else None,
+            "baudrate": 115200 if online else None,
+            "printerProfile": "_default",
+        },
+        "options": {
+            "ports": ["/dev/ttyUSB0"],
+            "baudrates": [115200],
+            "printerProfiles": [{"id": "_default", "name": "Prusa MK3/4"}],
+        },
+    }
 
 
 @router.post("/api/connection")
 async def post_connection(request: Request):
     data: dict[str, str] = cast(dict[str, str], await request.json())
-    print(f" >>> OCTOAPP SENT COMMAND: {data}")
+    logger.info("OctoApp sent connection command: %s", data)
 
     if data.get("command") == "disconnect":
         return Response(status_code=204)
@@ -119,8 +141,7 @@ async def post_connection(request: Request):
     return Response(status_code=204)
 
 
-@router.get("/api/settings")
-async def get_settings():
+def _settings() -> dict[str, Any]:
     return {
         "api": {"allowCrossOrigin": False, "key": None},
         "appearance": {
@@ -129,7 +150,7 @@ async def get_settings():
         "feature": {
             "gcodeViewer": True,
             "temperatureGraph": True,
-            "modelSizeDetection": False,
+            "modelSizeDetection": True,
         },
         "folder": {
             "uploads": "/home/pi/.octoprint/uploads",
@@ -145,8 +166,15 @@ async def get_settings():
     }
 
 
-@router.get("/api/printerprofiles")
-async def get_printerprofiles():
+SETTINGS = StaticResponse(_settings, lambda: EncryptionHandler.get_instance().get_key())
+
+
+@router.get("/api/settings")
+async def get_settings(request: Request) -> Response:
+    return SETTINGS.respond(request)
+
+
+def _printerprofiles() -> dict[str, Any]:
     return {
         "profiles": {
             "_default": {
@@ -175,12 +203,15 @@ async def get_printerprofiles():
     }
 
 
-@router.get("/api/system/info")
-async def system_info() -> dict[
-    str,
-    dict[str, list[None] | dict[str, int] | dict[str, str]]
-    | dict[str, dict[str, list[None]]],
-]:
+PRINTER_PROFILES = StaticResponse(_printerprofiles)
+
+
+@router.get("/api/printerprofiles")
+async def get_printerprofiles(request: Request) -> Response:
+    return PRINTER_PROFILES.respond(request)
+
+
+def _system_info() -> dict[str, Any]:
     return {
         "system": {
             "actions": [],
@@ -192,6 +223,14 @@ async def system_info() -> dict[
     }
 
 
+SYSTEM_INFO = StaticResponse(_system_info)
+
+
+@router.get("/api/system/info")
+async def system_info(request: Request) -> Response:
+    return SYSTEM_INFO.respond(request)
+
+
 @router.get("/api/system/commands")
 async def system_commands() -> dict[None, None]:
     return {}
@@ -219,13 +258,213 @@ async def printer_status():
     }
 
 
-@router.get("/plugin/pluginmanager/plugins/versions")
-async def plugin_versions() -> dict[str, str | None]:
+def _plugin_versions() -> dict[str, Any]:
     return {
         "octoapp": "3.0.3",
     }
 
 
+PLUGIN_VERSIONS = StaticResponse(_plugin_versions)
+
+
+@router.get("/plugin/pluginmanager/plugins/versions")
+async def plugin_versions(request: Request) -> Response:
+    return PLUGIN_VERSIONS.respond(request)
+
+
+def _file_entry(child: dict[str, Any], base_url: str) -> dict[str, Any]:
+    path: str = child["name"]
+    display: str = child.get("display_name", child["name"])
+
+    if child.get("type") == "FOLDER":
+        return {
+            "name": display,
+            "display": display,
+            "path": path,
+            "origin": "local",
+            "type": "folder",
+            "typePath": ["folder"],
+            "children": [],
+        }
+
+    size = int(child.get("size", 0))
+    m_timestamp = int(child.get("m_timestamp", 0))
+    entry: dict[str, Any] = {
+        "name": display,
+        "display": display,
+        "path": path,
+        "origin": "local",
+        "type": "machinecode",
+        "typePath": ["machinecode", "gcode"],
+        "size": size,
+        "date": m_timestamp,
+        "refs": {
+            "resource": f"{base_url}api/files/local/{path}",
+            "download": f"{base_url}downloads/files/local/{path}",
+        },
+    }
+
+    if (
+        analysis := GcodeAnalyzer.get_instance().get(path, size, m_timestamp)
+    ) is not None:
+        entry["gcodeAnalysis"] = analysis
+
+    return entry
+
+
+@router.get("/api/files")
+@router.get("/api/files/{origin}")
+async def get_files(request: Request, origin: str = "local"):
+    files = await DataPoller.get_instance().get_files()
+    if files is None:
+        return {"files": [], "free": 0, "total": 0}
+
+    base_url = str(request.base_url)
+
+    return {
+        "files": [_file_entry(child, base_url) for child in files.get("children", [])],
+        "free": files.get("free_space", 0),
+        "total": files.get("total_space", 0),
+    }
+
+
+@router.post("/api/files/{origin}/{path:path}")
+async def file_command(origin: str, path: str, request: Request):
+    payload: dict[str, Any] = await request.json()
+
+    if payload.get("command") != "select":
+        return JSONResponse(status_code=400, content={"error": "Unknown command"})
+
+    job_controller = JobController.get_instance()
+    job_controller.selected_path = path
+
+    if payload.get("print", False) and not await job_controller.execute(
+        JobController.Command.START, path
+    ):
+        return JSONResponse(status_code=409, content={"error": "Printer is busy"})
+
+    return Response(status_code=204)
+
+
+@router.post("/api/job")
+async def job_command(request: Request):
+    payload: dict[str, Any] = await request.json()
+    job_controller = JobController.get_instance()
+
+    match payload.get("command"), payload.get("action", "toggle"):
+        case "start", _:
+            command = JobController.Command.START
+        case "pause", "pause":
+            command = JobController.Command.PAUSE
+        case "pause", "resume":
+            command = JobController.Command.RESUME
+        case "pause", "toggle":
+            command = job_controller.toggle_command()
+        case "cancel", _:
+            command = JobController.Command.CANCEL
+        case _:
+            return JSONResponse(status_code=400, content={"error": "Unknown command"})
+
+    if not await job_controller.execute(command, job_controller.selected_path):
+        return JSONResponse(
+            status_code=409, content={"error": "Printer is not in the right state"}
+        )
+
+    return Response(status_code=204)
+
+
+@router.get("/downloads/files/{origin}/{path:path}")
+async def download_file(origin: str, path: str):
+    cached_file = await GcodeCache.get_instance().get(path)
+    if cached_file is None:
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+
+    # Range requests are handled by FileResponse
+    return FileResponse(
+        cached_file.path,
+        filename=path.rsplit("/", 1)[-1],
+        media_type="text/plain",
+    )
+
+
+@router.get("/plugin/gcodeviewer/layers/{origin}/{path:path}")
+async def gcode_layers(
+    origin: str,
+    path: str,
+    first: int | None = Query(None, ge=0),
+    last: int | None = Query(None, ge=0),
+):
+    cached_file = await GcodeCache.get_instance().get(path)
+    if cached_file is None:
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+
+    if first is not None:
+        start, end = cached_file.layer_range(first, last if last is not None else first)
+        return {"size": cached_file.size, "range": {"start": start, "end": end}}
+
+    return {"size": cached_file.size, "layers": cached_file.layers.tolist()}
+
+
+@router.get("/plugin/printhistory/history")
+async def print_history(
+    page: int = Query(0, ge=0),
+    limit: int = Query(25, ge=1, le=500),
+    path: str | None = None,
+    since: float | None = None,
+    until: float | None = None,
+):
+    return await PrintHistory.get_instance().history(page, limit, path, since, until)
+
+
+@router.get("/plugin/printhistory/statistics")
+async def print_statistics(
+    since: float | None = None,
+    until: float | None = None,
+    group: str | None = Query(None, pattern="^(day|month|year)$"),
+):
+    return await PrintHistory.get_instance().statistics(since, until, group)
+
+
+@router.get("/plugin/printhistory/statistics/files")
+async def print_file_statistics(
+    page: int = Query(0, ge=0),
+    limit: int = Query(25, ge=1, le=500),
+):
+    return await PrintHistory.get_instance().file_statistics(page, limit)
+
+
+@router.get("/api/timelapse")
+async def get_timelapses(unrendered: bool = False):
+    return await Timelapse.get_instance().list_timelapses(unrendered)
+
+
+@router.get("/downloads/timelapse/{filename}")
+async def download_timelapse(filename: str):
+    path = Timelapse.get_instance().video_path(filename)
+    if path is None:
+        return JSONResponse(status_code=404, content={"error": "Timelapse not found"})
+
+    return FileResponse(path, filename=filename, media_type="video/mp4")
+
+
+@router.delete("/api/timelapse/{filename}")
+async def delete_timelapse(filename: str):
+    if not await Timelapse.get_instance().delete(filename):
+        return JSONResponse(status_code=404, content={"error": "Timelapse not found"})
+
+    return await Timelapse.get_instance().list_timelapses()
+
+
+@router.delete("/api/timelapse/unrendered/{name}")
+async def delete_unrendered_timelapse(name: str):
+    if not await Timelapse.get_instance().delete_unrendered(name):
+        return JSONResponse(
+            status_code=409, content={"error": "Timelapse is in use or not found"}
+        )
+
+    return await Timelapse.get_instance().list_timelapses(unrendered=True)
+
+
 @router.post("/api/plugin/octoapp")
 async def octoapp_plugin(request: Request):
     payload: dict[str, Any] = await request.json()
@@ -233,7 +472,7 @@ async def octoapp_plugin(request: Request):
 
     match command:
         case "getPrinterFirmware":
-            print("OctoApp requested printer firmware")
+            logger.debug("OctoApp requested printer firmware")
             return {
                 "name": "Marlin",
                 "version": "2.1.2",
@@ -241,11 +480,10 @@ async def octoapp_plugin(request: Request):
             }
 
         case "registerForNotifications":
-            print("OctoApp registered for notifications")
+            logger.info("OctoApp registered for notifications")
             _ = NotificationHandler.get_instance().register(payload)
             return {"result": "ok"}
 
         case _:
-            print(f"Unknown command from OctoApp: {command}")
-            pp(payload)
+            logger.warning("Unknown command from OctoApp: %s %s", command, payload)
             return JSONResponse(status_code=400, content={"error": "Unknown command"})
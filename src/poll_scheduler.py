@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections.abc import Awaitable
+from typing import Any, Callable
+
+from tracing import Tracer
+
+# Window in which update requests are merged into a single poll, in seconds
+REQUEST_COALESCE_WINDOW: float = 0.05
+
+# Longest time the scheduler sleeps before checking the resources again, in seconds
+MAX_IDLE: float = 1.0
+
+
+class ScheduledResource:
+    """
+    An upstream resource refreshed by the PollScheduler.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[], Awaitable[bool]],
+        interval: float,
+        priority: int,
+        staleness_budget: float,
+        enabled: Callable[[], bool] = lambda: True,
+    ):
+        """
+        Args:
+            name (str): The name of the resource.
+            fetch (Callable[[], Awaitable[bool]]): Fetches the resource, returns whether it succeeded.
+            interval (float): Time between refreshes, in seconds.
+            priority (int): Resources with lower values go first when several are due.
+            staleness_budget (float): Age of the last successful refresh that is still acceptable, in seconds.
+            enabled (Callable[[], bool]): Whether the resource should be refreshed at the moment.
+        """
+
+        self.name: str = name
+        self.fetch: Callable[[], Awaitable[bool]] = fetch
+        self.interval: float = interval
+        self.priority: int = priority
+        self.staleness_budget: float = staleness_budget
+        self.enabled: Callable[[], bool] = enabled
+
+        self.next_due: float = 0.0
+        self.refreshed_at: float | None = None
+        self.failures: int = 0
+
+    def report(self, now: float) -> dict[str, Any]:
+        """
+        Describe how up to date the resource is.
+
+        Args:
+            now (float): The current monotonic time.
+
+        Returns:
+            dict[str, Any]: The schedule, the age of the data and how far behind the schedule it runs.
+        """
+
+        age = now - self.refreshed_at if self.refreshed_at is not None else None
+
+        return {
+            "interval": self.interval,
+            "priority": self.priority,
+            "stalenessBudget": self.staleness_budget,
+            "enabled": self.enabled(),
+            "age": age,
+            "behind": max(now - self.next_due, 0.0) if self.enabled() else 0.0,
+            "overBudget": age is None or age > self.staleness_budget,
+            "failures": self.failures,
+        }
+
+
+class PollScheduler:
+    """
+    Refreshes upstream resources, each at its own interval.
+
+    Only one request runs at a time, and requests are spaced so the upstream never
+    gets more than max_requests_per_second. When several resources are due, the one
+    with the lowest priority value goes first. A resource is rescheduled one interval
+    after its refresh started, so a late resource does not cause a burst of catch-up
+    requests.
+    """
+
+    def __init__(self, max_requests_per_second: float = 5.0):
+        self.max_requests_per_second: float = max_requests_per_second
+        self.resources: dict[str, ScheduledResource] = {}
+        self.requests: int = 0
+
+        self._last_request_at: float = 0.0
+        self._wakeup: asyncio.Event = asyncio.Event()
+
+    def register(self, resource: ScheduledResource) -> None:
+        """
+        Register a resource, due right away.
+
+        Args:
+            resource (ScheduledResource): The resource.
+        """
+
+        self.resources[resource.name] = resource
+
+    def request(self, *names: str) -> None:
+        """
+        Make resources due right away instead of at their next interval.
+        Requests arriving close together are served by a single refresh.
+
+        Args:
+            *names (str): The names of the resources.
+        """
+
+        now = time.monotonic()
+        for name in names:
+            if (resource := self.resources.get(name)) is not None:
+                resource.next_due = min(resource.next_due, now)
+
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        """
+        Refresh the resources as they become due, forever.
+        """
+
+        tracer = Tracer.get_instance()
+
+        while True:
+            now = time.monotonic()
+            enabled = [
+                resource for resource in self.resources.values() if resource.enabled()
+            ]
+            due = [resource for resource in enabled if resource.next_due <= now]
+
+            if not due:
+                next_due = min(
+                    (resource.next_due for resource in enabled), default=now + MAX_IDLE
+                )
+                await self._sleep(min(next_due - now, MAX_IDLE))
+                continue
+
+            resource = min(
+                due, key=lambda resource: (resource.priority, resource.next_due)
+            )
+
+            spacing = self._last_request_at + 1 / self.max_requests_per_second - now
+            if spacing > 0:
+                await asyncio.sleep(spacing)
+
+            started = time.monotonic()
+            self._last_request_at = started
+            self.requests += 1
+            resource.next_due = started + resource.interval
+
+            with tracer.trace("poll", resource=resource.name) as root:
+                succeeded = await resource.fetch()
+                root.set(succeeded=succeeded)
+
+            if succeeded:
+                resource.refreshed_at = started
+                resource.failures = 0
+            else:
+                resource.failures += 1
+
+    def report(self) -> dict[str, Any]:
+        """
+        Describe how up to date every resource is.
+
+        Returns:
+            dict[str, Any]: The request rate cap and the state of every resource.
+        """
+
+        now = time.monotonic()
+
+        return {
+            "maxRequestsPerSecond": self.max_requests_per_second,
+            "requests": self.requests,
+            "resources": {
+                name: resource.report(now) for name, resource in self.resources.items()
+            },
+        }
+
+    async def _sleep(self, timeout: float) -> None:
+        """
+        Sleep until the timeout runs out or a resource is requested.
+
+        Args:
+            timeout (float): The maximum time to sleep in seconds.
+        """
+
+        try:
+            _ = await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            # Give requests arriving close together the chance to share the refresh
+            await asyncio.sleep(REQUEST_COALESCE_WINDOW)
+        except TimeoutError:
+            pass
+
+        self._wakeup.clear()
@@ -0,0 +1,498 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from print_job import PrintJob
+from printer_status import PrinterStatus
+
+SCHEMA: str = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+
+CREATE TABLE IF NOT EXISTS prints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    printer TEXT NOT NULL,
+    print_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL NOT NULL,
+    print_time INTEGER NOT NULL,
+    progress REAL NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prints_printer_ended ON prints (printer, ended_at);
+CREATE INDEX IF NOT EXISTS prints_path_ended ON prints (path, ended_at);
+CREATE INDEX IF NOT EXISTS prints_ended ON prints (ended_at);
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    printer TEXT NOT NULL,
+    day TEXT NOT NULL,
+    result TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    print_time INTEGER NOT NULL,
+    PRIMARY KEY (printer, day, result)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS file_stats (
+    printer TEXT NOT NULL,
+    path TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    success INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    cancelled INTEGER NOT NULL,
+    print_time INTEGER NOT NULL,
+    last_ended_at REAL NOT NULL,
+    last_result TEXT NOT NULL,
+    last_print_time INTEGER NOT NULL,
+    PRIMARY KEY (printer, path)
+) WITHOUT ROWID;
+"""
+
+INSERT_PRINT: str = """
+INSERT INTO prints (
+    printer, print_id, path, display_name, started_at, ended_at, print_time, progress, result
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+UPSERT_DAILY: str = """
+INSERT INTO daily_stats (printer, day, result, count, print_time)
+VALUES (?, date(?, 'unixepoch', 'localtime'), ?, 1, ?)
+ON CONFLICT (printer, day, result) DO UPDATE SET
+    count = count + 1,
+    print_time = print_time + excluded.print_time
+"""
+
+UPSERT_FILE: str = """
+INSERT INTO file_stats (
+    printer, path, display_name, count, success, failed, cancelled,
+    print_time, last_ended_at, last_result, last_print_time
+) VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (printer, path) DO UPDATE SET
+    display_name = excluded.display_name,
+    count = count + 1,
+    success = success + excluded.success,
+    failed = failed + excluded.failed,
+    cancelled = cancelled + excluded.cancelled,
+    print_time = print_time + excluded.print_time,
+    last_ended_at = excluded.last_ended_at,
+    last_result = excluded.last_result,
+    last_print_time = excluded.last_print_time
+"""
+
+# Date formats used to group the daily rollups
+STATISTICS_GROUPS: dict[str, str] = {
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+    "year": "%Y",
+}
+
+
+class PrintHistory:
+    """
+    Persistent store of finished print jobs, backed by SQLite.
+
+    Finished jobs are queued in memory and written in batches on a dedicated thread,
+    so the poll loop never waits on disk I/O. Daily and per-file rollups are maintained
+    in the same transaction, so statistics queries never scan the raw history.
+    """
+
+    _instance: PrintHistory | None = None
+
+    def __init__(
+        self,
+        path: Path,
+        printer: str,
+        flush_interval: float = 5.0,
+        batch_size: int = 50,
+    ):
+        PrintHistory._instance = self
+
+        self.path: Path = path
+        self.printer: str = printer
+        self.flush_interval: float = flush_interval
+        self.batch_size: int = batch_size
+
+        self._pending: list[tuple[Any, ...]] = []
+        self._flush_event: asyncio.Event = asyncio.Event()
+        self._flush_task: asyncio.Task[None] | None = None
+        # A single thread owns the connection, serializing all database access
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="print-history"
+        )
+        self._connection: sqlite3.Connection | None = None
+
+    @classmethod
+    def get_instance(cls) -> PrintHistory:
+        if cls._instance is None:
+            raise ValueError("PrintHistory instance not initialized")
+        return cls._instance
+
+    async def start(self) -> None:
+        """
+        Open the database and start the background writer.
+        """
+
+        await self._run(self._open)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """
+        Flush pending records, stop the background writer and close the database.
+        """
+
+        if self._flush_task:
+            _ = self._flush_task.cancel()
+            self._flush_task = None
+
+        await self._flush()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    async def record_job_end(self, print_job: PrintJob | PrinterStatus) -> None:
+        """
+        Queue a finished print job for writing.
+        Subscriber to DataPoller.Event.PRINT_JOB_ENDED
+
+        Args:
+            print_job (PrintJob): The finished print job.
+        """
+
+        if not isinstance(print_job, PrintJob):
+            raise ValueError("record_job_end was called without a PrintJob")
+
+        ended_at = print_job.ended_at or time.time()
+        # started_at is when the proxy first saw the job, which is too late when the
+        # proxy was restarted during the print
+        started_at = print_job.started_at
+        if print_job.time_printing_seconds:
+            started_at = min(started_at, ended_at - print_job.time_printing_seconds)
+
+        self._pending.append(
+            (
+                self.printer,
+                print_job.print_id,
+                print_job.path + "/" + print_job.display_name,
+                print_job.display_name,
+                started_at,
+                ended_at,
+                print_job.time_printing_seconds,
+                print_job.progress,
+                print_job.result or "success",
+            )
+        )
+
+        if len(self._pending) >= self.batch_size:
+            self._flush_event.set()
+
+    async def history(
+        self,
+        page: int = 0,
+        limit: int = 25,
+        path: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+    ) -> dict[str, Any]:
+        """
+        Get a page of finished print jobs, newest first.
+
+        Args:
+            page (int): The zero-based page number.
+            limit (int): The number of jobs per page.
+            path (str | None): Only return jobs of this file.
+            since (float | None): Only return jobs that ended at or after this timestamp.
+            until (float | None): Only return jobs that ended before this timestamp.
+
+        Returns:
+            dict[str, Any]: The total number of matching jobs and the requested page.
+        """
+
+        return await self._run(self._history, page, limit, path, since, until)
+
+    async def statistics(
+        self,
+        since: float | None = None,
+        until: float | None = None,
+        group: str | None = None,
+    ) -> dict[str, Any]:
+        """
+        Get aggregated print statistics from the daily rollups. The window covers whole
+        local days, from the day containing since through the day containing until.
+
+        Args:
+            since (float | None): Start of the window as a timestamp.
+            until (float | None): End of the window as a timestamp, its day included.
+            group (str | None): Optionally group the totals by "day", "month" or "year".
+
+        Returns:
+            dict[str, Any]: The totals and, if requested, the grouped totals.
+        """
+
+        if group is not None and group not in STATISTICS_GROUPS:
+            raise ValueError(f"Unknown statistics group: {group}")
+
+        return await self._run(self._statistics, since, until, group)
+
+    async def file_statistics(self, page: int = 0, limit: int = 25) -> dict[str, Any]:
+        """
+        Get per-file print statistics, ordered by failure rate.
+
+        Args:
+            page (int): The zero-based page number.
+            limit (int): The number of files per page.
+
+        Returns:
+            dict[str, Any]: The total number of files and the requested page.
+        """
+
+        return await self._run(self._file_statistics, page, limit)
+
+    async def _run(self, func: Any, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                _ = await asyncio.wait_for(
+                    self._flush_event.wait(), timeout=self.flush_interval
+                )
+            except TimeoutError:
+                pass
+
+            self._flush_event.clear()
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+
+        try:
+            await self._run(self._write_batch, batch)
+        except sqlite3.Error as e:
+            print(f"Error writing print history: {e}")
+            self._pending = batch + self._pending
+
+    # The methods below run on the executor thread only
+
+    def _open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        _ = self._connection.executescript(SCHEMA)
+
+    def _close(self) -> None:
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None:
+            raise ValueError("PrintHistory database is not open")
+        return self._connection
+
+    def _write_batch(self, batch: list[tuple[Any, ...]]) -> None:
+        db = self._db()
+
+        with db:
+            _ = db.executemany(INSERT_PRINT, batch)
+            _ = db.executemany(
+                UPSERT_DAILY,
+                [
+                    (printer, ended_at, result, print_time)
+                    for printer, _, _, _, _, ended_at, print_time, _, result in batch
+                ],
+            )
+            _ = db.executemany(
+                UPSERT_FILE,
+                [
+                    (
+                        printer,
+                        path,
+                        display_name,
+                        int(result == "success"),
+                        int(result == "failed"),
+                        int(result == "cancelled"),
+                        print_time,
+                        ended_at,
+                        result,
+                        print_time,
+                    )
+                    for printer, _, path, display_name, _, ended_at, print_time, _, result in batch
+                ],
+            )
+
+    def _history(
+        self,
+        page: int,
+        limit: int,
+        path: str | None,
+        since: float | None,
+        until: float | None,
+    ) -> dict[str, Any]:
+        conditions = ["printer = ?"]
+        params: list[Any] = [self.printer]
+
+        if path is not None:
+            conditions.append("path = ?")
+            params.append(path)
+        if since is not None:
+            conditions.append("ended_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("ended_at < ?")
+            params.append(until)
+
+        where = " AND ".join(conditions)
+        db = self._db()
+
+        total: int = db.execute(
+            f"SELECT count(*) FROM prints WHERE {where}", params
+        ).fetchone()[0]
+        rows = db.execute(
+            f"SELECT * FROM prints WHERE {where} ORDER BY ended_at DESC LIMIT ? OFFSET ?",
+            [*params, limit, page * limit],
+        ).fetchall()
+
+        return {
+            "total": total,
+            "page": page,
+            "limit": limit,
+            "jobs": [
+                {
+                    "id": row["id"],
+                    "printId": row["print_id"],
+                    "file": {
+                        "name": row["display_name"],
+                        "display": row["display_name"],
+                        "path": row["path"],
+                        "origin": "sdcard",
+                    },
+                    "startDate": row["started_at"],
+                    "endDate": row["ended_at"],
+                    "printTime": row["print_time"],
+                    "progress": row["progress"],
+                    "success": row["result"] == "success",
+                    "result": row["result"],
+                }
+                for row in rows
+            ],
+        }
+
+    def _statistics(
+        self, since: float | None, until: float | None, group: str | None
+    ) -> dict[str, Any]:
+        conditions = ["printer = ?"]
+        params: list[Any] = [self.printer]
+
+        if since is not None:
+            conditions.append("day >= date(?, 'unixepoch', 'localtime')")
+            params.append(since)
+        if until is not None:
+            conditions.append("day <= date(?, 'unixepoch', 'localtime')")
+            params.append(until)
+
+        where = " AND ".join(conditions)
+        db = self._db()
+
+        totals = _rollup(
+            db.execute(
+                f"SELECT result, sum(count), sum(print_time) FROM daily_stats WHERE {where} GROUP BY result",
+                params,
+            ).fetchall()
+        )
+
+        statistics: dict[str, Any] = {"printer": self.printer, "totals": totals}
+
+        if group is not None:
+            period = f"strftime('{STATISTICS_GROUPS[group]}', day)"
+            rows = db.execute(
+                f"SELECT {period} AS period, result, sum(count), sum(print_time) FROM daily_stats "
+                + f"WHERE {where} GROUP BY period, result ORDER BY period",
+                params,
+            ).fetchall()
+
+            periods: dict[str, list[tuple[str, int, int]]] = {}
+            for row in rows:
+                periods.setdefault(row[0], []).append((row[1], row[2], row[3]))
+
+            statistics["groups"] = [
+                {"period": period, **_rollup(results)}
+                for period, results in periods.items()
+            ]
+
+        return statistics
+
+    def _file_statistics(self, page: int, limit: int) -> dict[str, Any]:
+        db = self._db()
+
+        total: int = db.execute(
+            "SELECT count(*) FROM file_stats WHERE printer = ?", [self.printer]
+        ).fetchone()[0]
+        rows = db.execute(
+            "SELECT * FROM file_stats WHERE printer = ? "
+            + "ORDER BY CAST(failed AS REAL) / count DESC, count DESC LIMIT ? OFFSET ?",
+            [self.printer, limit, page * limit],
+        ).fetchall()
+
+        return {
+            "total": total,
+            "page": page,
+            "limit": limit,
+            "files": [
+                {
+                    "path": row["path"],
+                    "display": row["display_name"],
+                    "prints": {
+                        "success": row["success"],
+                        "failure": row["failed"] + row["cancelled"],
+                        "last": {
+                            "date": row["last_ended_at"],
+                            "success": row["last_result"] == "success",
+                            "printTime": row["last_print_time"],
+                        },
+                    },
+                    "statistics": {
+                        "count": row["count"],
+                        "failed": row["failed"],
+                        "cancelled": row["cancelled"],
+                        "failureRate": row["failed"] / row["count"],
+                        "printTime": row["print_time"],
+                        "averagePrintTime": row["print_time"] / row["count"],
+                    },
+                }
+                for row in rows
+            ],
+        }
+
+
+def _rollup(rows: list[Any]) -> dict[str, Any]:
+    """
+    Combine (result, count, print_time) rows into a statistics summary.
+    """
+
+    counts = {"success": 0, "failed": 0, "cancelled": 0}
+    print_time = 0
+
+    for result, count, result_print_time in rows:
+        counts[result] = counts.get(result, 0) + count
+        print_time += result_print_time
+
+    total = sum(counts.values())
+
+    return {
+        "count": total,
+        **counts,
+        "failureRate": counts["failed"] / total if total else 0.0,
+        "printTime": print_time,
+        "printHours": print_time / 3600,
+    }
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import string
+import time
 from random import choices
+from typing import Any
 
 
 class PrintJob:
@@ -16,17 +18,22 @@ class PrintJob:
         time_printing_seconds: int,
         display_name: str,
         path: str,
+        file_name: str,
     ):
         self.print_id: int = print_id
         self.notification_print_id: str = "".join(
             choices(string.ascii_lowercase + string.digits, k=32)
         )
-        self.running: bool = False
-        self.progress: float = 0.0
-        self.time_remaining_seconds: int = 0
-        self.time_printing_seconds: int = 0
-        self.display_name: str = ""
-        self.path: str = ""
+        self.running: bool = running
+        self.progress: float = progress
+        self.time_remaining_seconds: int = time_remaining_seconds
+        self.time_printing_seconds: int = time_printing_seconds
+        self.display_name: str = display_name
+        self.path: str = path
+        self.file_name: str = file_name
+        self.started_at: float = time.time()
+        self.ended_at: float | None = None
+        self.result: str | None = None
 
         PrintJob._print_jobs.add(self)
 
@@ -56,6 +63,7 @@ class PrintJob:
         time_printing_seconds: int,
         display_name: str,
         path: str,
+        file_name: str,
     ):
         """
         Updates the PrintJob object with the given values.
@@ -66,7 +74,8 @@ class PrintJob:
             time_remaining_seconds (int): The estimated time remaining for the print job in seconds.
             time_printing_seconds (int): The total time spent printing the job in seconds.
             display_name (str): The display name of the print job.
-            path (str): The path to the print job file.
+            path (str): The path of the folder containing the print job file.
+            file_name (str): The name of the print job file on the printer's storage.
         """
         self.running = running
         self.progress = progress
@@ -74,3 +83,64 @@ class PrintJob:
         self.time_printing_seconds = time_printing_seconds
         self.display_name = display_name
         self.path = path
+        self.file_name = file_name
+
+    def finish(self, result: str) -> None:
+        """
+        Marks the PrintJob as ended.
+
+        Args:
+            result (str): How the print ended ("success", "cancelled" or "failed").
+        """
+        self.running = False
+        self.ended_at = time.time()
+        self.result = result
+
+    @property
+    def file_path(self) -> str:
+        """
+        The path of the print job file on the printer's storage.
+        """
+        return self.path + "/" + self.file_name
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Serialize the PrintJob, to share it with other processes.
+
+        Returns:
+            dict[str, Any]: The PrintJob as JSON compatible dict.
+        """
+        return dict(vars(self))
+
+    @staticmethod
+    def from_dict(data: dict[str, Any]) -> PrintJob:
+        """
+        Returns the PrintJob described by the output of to_dict, updating the known
+        PrintJob with the same ID instead of creating a new one.
+
+        Args:
+            data (dict[str, Any]): The serialized PrintJob.
+
+        Returns:
+            PrintJob: The PrintJob.
+        """
+        fields = (
+            "running",
+            "progress",
+            "time_remaining_seconds",
+            "time_printing_seconds",
+            "display_name",
+            "path",
+            "file_name",
+        )
+
+        if (print_job := PrintJob.get(data["print_id"])) is None:
+            print_job = PrintJob(data["print_id"], *(data[field] for field in fields))
+        else:
+            print_job.update(*(data[field] for field in fields))
+
+        print_job.notification_print_id = data["notification_print_id"]
+        print_job.started_at = data["started_at"]
+        print_job.ended_at = data["ended_at"]
+        print_job.result = data["result"]
+        return print_job
@@ -1,4 +1,7 @@
+from __future__ import annotations
+
 from enum import Enum
+from typing import Any
 
 
 class PrinterState(Enum):
@@ -37,3 +40,36 @@ class PrinterStatus:
         self.speed: float = speed
         self.fan_hotend_rpm: int = fan_hotend_rpm
         self.fan_print_rpm: int = fan_print_rpm
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Serialize the PrinterStatus, to share it with other processes.
+
+        Returns:
+            dict[str, Any]: The PrinterStatus as JSON compatible dict.
+        """
+        return vars(self) | {"state": self.state.value}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> PrinterStatus:
+        """
+        Create a PrinterStatus from the output of to_dict.
+
+        Args:
+            data (dict[str, Any]): The serialized PrinterStatus.
+
+        Returns:
+            PrinterStatus: The PrinterStatus.
+        """
+        return cls(
+            state=PrinterState(data["state"]),
+            temp_bed=float(data["temp_bed"]),
+            target_bed=float(data["target_bed"]),
+            temp_nozzle=float(data["temp_nozzle"]),
+            target_nozzle=float(data["target_nozzle"]),
+            z_height=float(data["z_height"]),
+            flow=float(data["flow"]),
+            speed=float(data["speed"]),
+            fan_hotend_rpm=int(data["fan_hotend_rpm"]),
+            fan_print_rpm=int(data["fan_print_rpm"]),
+        )
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import NamedTuple
+
+from print_job import PrintJob
+
+# Number of polled samples the rates are fitted to
+MAX_SAMPLES: int = 12
+
+# Longest time extrapolated past the last sample, in seconds. Beyond it the printer is
+# probably paused or unreachable, so the values stop moving until the next poll.
+MAX_EXTRAPOLATION: float = 30.0
+
+# Print time the samples have to span before the remaining time rate is fitted, in seconds
+MIN_FIT_SPAN: float = 30.0
+
+# Bounds of the fitted rate at which the remaining time counts down
+MAX_REMAINING_RATE: float = 2.0
+
+
+class ProgressSample(NamedTuple):
+    # Monotonic time the sample was taken
+    taken_at: float
+    time_printing: int
+    progress: float
+    time_remaining: int
+
+
+class ProgressEstimate(NamedTuple):
+    completion: float
+    print_time: int
+    print_time_left: int
+
+
+class ProgressModel:
+    """
+    Estimates the progress of a print job between polls.
+
+    The print time advances with the clock. The remaining time counts down at the rate
+    fitted to the recent samples, which absorbs speed changes and estimate drift. The
+    completion moves at the rate that reaches 100% when the remaining time runs out, so
+    it moves smoothly even though the printer reports whole percents. Every polled
+    sample replaces the extrapolated values and refits the rates.
+    """
+
+    def __init__(self, print_id: int):
+        self.print_id: int = print_id
+        self.samples: deque[ProgressSample] = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, print_job: PrintJob) -> None:
+        """
+        Add a polled sample of the job.
+
+        Args:
+            print_job (PrintJob): The job as polled from the printer.
+        """
+
+        sample = ProgressSample(
+            time.monotonic(),
+            print_job.time_printing_seconds,
+            print_job.progress,
+            print_job.time_remaining_seconds,
+        )
+
+        # Other fields changed, the printer has not updated its counters since
+        if self.samples and self.samples[-1][1:] == sample[1:]:
+            return
+
+        self.samples.append(sample)
+
+    def estimate(self, now: float) -> ProgressEstimate | None:
+        """
+        Extrapolate the progress of the job.
+
+        Args:
+            now (float): The current monotonic time.
+
+        Returns:
+            ProgressEstimate | None: The estimated progress, or None without samples.
+        """
+
+        if not self.samples:
+            return None
+
+        last = self.samples[-1]
+        elapsed = min(max(now - last.taken_at, 0.0), MAX_EXTRAPOLATION)
+
+        time_left = max(last.time_remaining - elapsed * self._remaining_rate(), 0.0)
+        completion = last.progress
+        if last.time_remaining > 0:
+            completion += (100 - last.progress) * min(elapsed / last.time_remaining, 1)
+
+        return ProgressEstimate(
+            completion=round(min(completion, 100.0), 2),
+            print_time=round(last.time_printing + elapsed),
+            print_time_left=round(time_left),
+        )
+
+    def _remaining_rate(self) -> float:
+        first, last = self.samples[0], self.samples[-1]
+        span = last.time_printing - first.time_printing
+        if span < MIN_FIT_SPAN:
+            return 1.0
+
+        rate = (first.time_remaining - last.time_remaining) / span
+        return min(max(rate, 0.0), MAX_REMAINING_RATE)
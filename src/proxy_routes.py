@@ -0,0 +1,115 @@
+import secrets
+import time
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from config import ADMIN_TOKEN
+from data_poller import DataPoller
+from diagnostics import Diagnostics
+from logs import LogPipeline
+from notifications import NotificationHandler
+from telemetry import TelemetryStore
+from tracing import Tracer
+from websocket import WebSocketHandler
+
+
+async def require_admin(x_admin_token: str | None = Header(None)) -> None:
+    """
+    Reject requests without the admin token, or all requests if none is configured.
+    """
+
+    if ADMIN_TOKEN is None or not secrets.compare_digest(
+        x_admin_token or "", ADMIN_TOKEN
+    ):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+router = APIRouter(prefix="/proxy")
+admin_router = APIRouter(
+    prefix="/proxy/diagnostics", dependencies=[Depends(require_admin)]
+)
+
+
+@router.get("/stats/websocket")
+async def websocket_stats():
+    return WebSocketHandler.get_instance().bandwidth_report()
+
+
+@router.get("/stats/printer")
+async def printer_stats():
+    data_poller = DataPoller.get_instance()
+    return {
+        "online": data_poller.online,
+        "circuit": data_poller.link.breaker.report(),
+        "pollTaskRunning": data_poller.listen_task is not None
+        and not data_poller.listen_task.done(),
+    }
+
+
+@router.get("/stats/poller")
+async def poller_stats():
+    return DataPoller.get_instance().scheduler.report()
+
+
+@router.get("/stats/notifications")
+async def notification_stats():
+    return NotificationHandler.get_instance().stats()
+
+
+@router.get("/stats/telemetry")
+async def telemetry_stats():
+    return TelemetryStore.get_instance().stats()
+
+
+@router.get("/telemetry")
+async def telemetry(
+    since: float | None = None,
+    until: float | None = None,
+    points: int = Query(500, ge=1, le=5000),
+):
+    until = time.time() if until is None else until
+    since = until - 3600 if since is None else since
+    return TelemetryStore.get_instance().query(since, until, points)
+
+
+@router.get("/traces/slowest")
+async def slowest_traces(limit: int = Query(10, ge=1, le=100)):
+    tracer = Tracer.get_instance()
+    return {
+        "sampleRate": tracer.sample_rate,
+        "traces": tracer.slowest(limit),
+    }
+
+
+@admin_router.get("/loop")
+async def loop_lag():
+    return Diagnostics.get_instance().loop_lag()
+
+
+@admin_router.get("/slow-callbacks")
+async def slow_callbacks():
+    return Diagnostics.get_instance().recent_slow_callbacks()
+
+
+@admin_router.get("/profile", response_class=PlainTextResponse)
+async def profile(
+    seconds: float = Query(10, gt=0, le=60),
+    interval: float = Query(0.005, ge=0.001, le=1),
+):
+    return await Diagnostics.get_instance().profile(seconds, interval)
+
+
+@admin_router.get("/logging")
+async def logging_report():
+    return LogPipeline.get_instance().report()
+
+
+@admin_router.put("/logging/levels/{name:path}")
+async def set_log_level(
+    name: str,
+    level: str = Query(..., pattern="^(?i)(NOTSET|DEBUG|INFO|WARNING|ERROR|CRITICAL)$"),
+):
+    log_pipeline = LogPipeline.get_instance()
+    log_pipeline.set_level(name, level)
+    return log_pipeline.report()
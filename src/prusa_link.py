@@ -1,9 +1,25 @@
 import asyncio
+import logging
+from pathlib import Path
 from pprint import pp
 from typing import Any, Final
+from urllib.parse import quote
 
 import httpx
 
+from circuit_breaker import CircuitBreaker
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Time a single request may take in total, including authentication, in seconds
+REQUEST_DEADLINE: float = 5.0
+
+# Timeouts of file downloads, which take longer than the request deadline in total.
+# The response has to start within the deadline, and the printer may pause sending
+# for up to the read timeout.
+DOWNLOAD_TIMEOUT: httpx.Timeout = httpx.Timeout(REQUEST_DEADLINE, read=30.0)
+
 
 class PrusaLink:
     host: Final[str]
@@ -11,6 +27,7 @@ class PrusaLink:
     password: Final[str]
     client: httpx.AsyncClient | None
     auth: httpx.DigestAuth
+    breaker: CircuitBreaker
 
     def __init__(self, host: str, username: str, password: str):
         """
@@ -26,6 +43,7 @@ class PrusaLink:
         self.password = password
         self.client = None
         self.auth = httpx.DigestAuth(self.username, self.password)
+        self.breaker = CircuitBreaker("PrusaLink")
 
     async def connect(self):
         """
@@ -33,7 +51,7 @@ class PrusaLink:
         """
 
         self.client = httpx.AsyncClient(base_url=self.host)
-        print("Connected to PrusaLink server.")
+        logger.info("Connected to PrusaLink server")
 
     async def disconnect(self):
         """
@@ -43,7 +61,58 @@ class PrusaLink:
         if self.client:
             await self.client.aclose()
             self.client = None
-            print("Disconnected from PrusaLink server.")
+            logger.info("Disconnected from PrusaLink server")
+
+    async def _request(
+        self, method: str, endpoint: str, **kwargs: Any
+    ) -> httpx.Response | None:
+        """
+        Send a request to the PrusaLink server through the circuit breaker.
+
+        Args:
+            method (str): The HTTP method of the request.
+            endpoint (str): The endpoint to send the request to.
+            **kwargs (Any): Further arguments for httpx.AsyncClient.request.
+
+        Returns:
+            httpx.Response | None: The successful response, or None if the request failed
+                or was not sent because the printer is unreachable.
+        """
+
+        with span("prusalink.request", method=method, endpoint=endpoint) as request:
+            if not self.breaker.allow():
+                request.set(rejected=True)
+                return None
+
+            if not self.client:
+                await self.connect()
+
+            assert self.client is not None
+
+            try:
+                async with asyncio.timeout(REQUEST_DEADLINE):
+                    response = await self.client.request(
+                        method, endpoint, auth=self.auth, **kwargs
+                    )
+                _ = response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                logger.error("%s %s failed: %s", method, endpoint, e)
+                request.set(status=e.response.status_code)
+                # The printer answered, only server errors count against it
+                if e.response.is_server_error:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                return None
+            except (httpx.HTTPError, TimeoutError) as e:
+                logger.error("%s %s failed: %r", method, endpoint, e)
+                request.set(error=repr(e))
+                self.breaker.record_failure()
+                return None
+
+            request.set(status=response.status_code)
+            self.breaker.record_success()
+            return response
 
     async def _get(self, endpoint: str) -> dict[str, str] | None:
         """
@@ -56,19 +125,30 @@ class PrusaLink:
             dict[str, str]: The response from the PrusaLink server.
         """
 
-        if not self.client:
-            await self.connect()
-
-        assert self.client is not None
+        response = await self._request("GET", endpoint)
+        if response is None:
+            return None
 
         try:
-            response = await self.client.get(endpoint, auth=self.auth)
-            _ = response.raise_for_status()
             return response.json()
-        except httpx.HTTPError as e:
-            print(f"Error: {e}")
+        except ValueError as e:
+            logger.error("Malformed response from %s: %s", endpoint, e)
             return None
 
+    async def _command(self, method: str, endpoint: str) -> bool:
+        """
+        Send a command request to the PrusaLink server.
+
+        Args:
+            method (str): The HTTP method of the command.
+            endpoint (str): The endpoint to send the command to.
+
+        Returns:
+            bool: True if the printer accepted the command, False otherwise.
+        """
+
+        return await self._request(method, endpoint) is not None
+
     async def is_online(self) -> bool:
         """
         Check if the PrusaLink server is online.
@@ -138,6 +218,178 @@ class PrusaLink:
 
         return await self._get("/api/v1/files/usb")
 
+    async def get_snapshot(self) -> tuple[bytes, str] | None:
+        """
+        Get the latest snapshot of the default camera from the PrusaLink server.
+
+        Returns:
+            tuple[bytes, str] | None: The image and its content type, or None if there is none.
+        """
+
+        response = await self._request("GET", "/api/v1/cameras/snap")
+        if response is None or response.status_code == 204:
+            return None
+
+        return response.content, response.headers.get("content-type", "")
+
+    async def pause_job(self, job_id: int) -> bool:
+        """
+        Pause the running job.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            bool: True if the printer accepted the command, False otherwise.
+        """
+
+        return await self._command("PUT", f"/api/v1/job/{job_id}/pause")
+
+    async def resume_job(self, job_id: int) -> bool:
+        """
+        Resume the paused job.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            bool: True if the printer accepted the command, False otherwise.
+        """
+
+        return await self._command("PUT", f"/api/v1/job/{job_id}/resume")
+
+    async def stop_job(self, job_id: int) -> bool:
+        """
+        Stop the running job.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            bool: True if the printer accepted the command, False otherwise.
+        """
+
+        return await self._command("DELETE", f"/api/v1/job/{job_id}")
+
+    async def start_print(self, path: str) -> bool:
+        """
+        Start printing a file.
+
+        Args:
+            path (str): The path of the file on the USB storage.
+
+        Returns:
+            bool: True if the printer accepted the command, False otherwise.
+        """
+
+        return await self._command("POST", f"/api/v1/files/usb/{quote(path)}")
+
+    async def get_file(self, path: str) -> dict[str, Any] | None:  # pyright: ignore[reportExplicitAny]
+        """
+        Get the information of a single file from the PrusaLink server.
+
+        Args:
+            path (str): The path of the file on the USB storage.
+
+        Returns:
+            dict[str, str]: The file information.
+        """
+
+        return await self._get(f"/api/v1/files/usb/{quote(path)}")
+
+    async def read_file_range(self, path: str, start: int, length: int) -> bytes | None:
+        """
+        Read part of a file from the PrusaLink server using an HTTP Range request.
+
+        Args:
+            path (str): The path of the file on the USB storage.
+            start (int): The offset to start reading at. Negative offsets count from the end.
+            length (int): The maximum number of bytes to read.
+
+        Returns:
+            bytes | None: The requested bytes, or None if the request failed.
+        """
+
+        byte_range = (
+            f"bytes={start}" if start < 0 else f"bytes={start}-{start + length - 1}"
+        )
+
+        response = await self._request(
+            "GET", f"/usb/{quote(path)}", headers={"Range": byte_range}
+        )
+        if response is None:
+            return None
+
+        if response.status_code == 206:
+            return response.content
+
+        # The server ignored the Range header and sent the whole file
+        if start < 0:
+            return response.content[start:]
+        return response.content[start : start + length]
+
+    async def download_file(self, path: str, destination: Path) -> bool:
+        """
+        Stream a file from the PrusaLink server to disk.
+
+        Args:
+            path (str): The path of the file on the USB storage.
+            destination (Path): The local file to write to.
+
+        Returns:
+            bool: True if the download succeeded, False otherwise.
+        """
+
+        if not self.breaker.allow():
+            return False
+
+        if not self.client:
+            await self.connect()
+
+        assert self.client is not None
+
+        request = self.client.build_request(
+            "GET", f"/usb/{quote(path)}", timeout=DOWNLOAD_TIMEOUT
+        )
+
+        try:
+            async with asyncio.timeout(REQUEST_DEADLINE):
+                response = await self.client.send(request, auth=self.auth, stream=True)
+        except (httpx.HTTPError, TimeoutError) as e:
+            logger.error("Downloading %s failed: %r", path, e)
+            self.breaker.record_failure()
+            return False
+
+        try:
+            _ = response.raise_for_status()
+
+            file = await asyncio.to_thread(destination.open, "wb")
+            try:
+                async for chunk in response.aiter_bytes(1 << 16):
+                    _ = await asyncio.to_thread(file.write, chunk)
+            finally:
+                await asyncio.to_thread(file.close)
+        except httpx.HTTPStatusError as e:
+            logger.error("Downloading %s failed: %s", path, e)
+            # The printer answered, only server errors count against it
+            if e.response.is_server_error:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return False
+        except httpx.TransportError as e:
+            logger.error("Downloading %s failed: %r", path, e)
+            self.breaker.record_failure()
+            return False
+        except (httpx.HTTPError, OSError) as e:
+            logger.error("Downloading %s failed: %s", path, e)
+            return False
+        finally:
+            await response.aclose()
+
+        self.breaker.record_success()
+        return True
+
 
 if __name__ == "__main__":
     prusa_link = PrusaLink("http://192.168.2.137", "maker", "izPjsV5TQJR4Eai")
@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable
+from contextlib import suppress
+from typing import Any, Callable
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from config import WS_MEASURE_BANDWIDTH
+from tracing import Span, detached, span
+from ws_compression import BandwidthMeter
+
+logger = logging.getLogger(__name__)
+
+# Interval between heartbeat frames, in seconds (SockJS default)
+HEARTBEAT_INTERVAL: float = 25.0
+
+# Time a single frame may take to send before the client is considered dead, in seconds
+SEND_TIMEOUT: float = 10.0
+
+# Number of queued messages after which a client is considered too slow to keep
+MAX_QUEUED_MESSAGES: int = 100
+
+
+def encode(message: dict[str, Any]) -> str:
+    """
+    Serialize a message once, so it can be queued on any number of connections.
+
+    Args:
+        message (dict[str, Any]): The message.
+
+    Returns:
+        str: The compact JSON encoding of the message.
+    """
+
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class SockJSConnection:
+    """
+    A websocket client speaking the SockJS websocket transport, or raw websockets.
+
+    Messages are queued without blocking and written by a background task. All messages
+    queued while a frame is being sent go out together in a single "a[...]" frame.
+    Heartbeat frames are sent periodically. A client whose sends fail, time out or fall
+    too far behind is closed and reported through on_close right away.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        framed: bool,
+        on_close: Callable[[SockJSConnection], None],
+    ):
+        """
+        Args:
+            websocket (WebSocket): The underlying websocket.
+            framed (bool): Whether to use SockJS framing, False for raw websockets.
+            on_close (Callable[[SockJSConnection], None]): Called once when the connection closes.
+        """
+
+        self.websocket: WebSocket = websocket
+        self.framed: bool = framed
+        self.on_close: Callable[[SockJSConnection], None] = on_close
+        self.closed: bool = False
+        self.meter: BandwidthMeter | None = (
+            BandwidthMeter(websocket.scope) if WS_MEASURE_BANDWIDTH else None
+        )
+
+        self._queue: deque[str] = deque()
+        # Spans of traced messages, ended once the frame carrying them is sent
+        self._send_spans: list[Span] = []
+        self._ready: asyncio.Event = asyncio.Event()
+        self._dead: asyncio.Event = asyncio.Event()
+        self._heartbeat_due: bool = False
+        # Throttled message waiting for its interval to pass, superseded by newer ones
+        self._latest: str | None = None
+        self._latest_partial: bool = False
+        self._latest_sent_at: float = 0.0
+        self._latest_timer: asyncio.TimerHandle | None = None
+
+    async def open(self) -> None:
+        """
+        Accept the websocket and send the SockJS open frame.
+        """
+
+        await self.websocket.accept()
+
+        if self.framed:
+            await self.websocket.send_text("o")
+
+    def send(self, message: dict[str, Any]) -> None:
+        """
+        Queue a message for sending.
+
+        Args:
+            message (dict[str, Any]): The message.
+        """
+
+        self.send_encoded(encode(message))
+
+    def send_encoded(self, message: str) -> None:
+        """
+        Queue an already serialized message for sending.
+
+        Args:
+            message (str): The JSON encoded message.
+        """
+
+        if self.closed:
+            return
+
+        if len(self._queue) >= MAX_QUEUED_MESSAGES:
+            logger.warning("Client is not keeping up, closing connection")
+            self._close()
+            return
+
+        self._queue.append(message)
+        if isinstance(send_span := span("ws.send", framed=self.framed), Span):
+            self._send_spans.append(send_span)
+        self._ready.set()
+
+    def send_latest(
+        self, message: str, min_interval: float, partial: bool = False
+    ) -> None:
+        """
+        Queue an already serialized message, sending at most one per interval.
+        A message arriving within the interval replaces any message still waiting,
+        so the client skips intermediate states but always gets the latest one.
+
+        Args:
+            message (str): The JSON encoded message.
+            min_interval (float): The minimum time between messages, in seconds.
+            partial (bool): Whether the message only updates part of the state. It
+                does not replace a full message still waiting, which is sent instead.
+        """
+
+        if self.closed:
+            return
+
+        if partial and self._latest is not None and not self._latest_partial:
+            return
+
+        due = self._latest_sent_at + min_interval - time.monotonic()
+        if due <= 0 and self._latest_timer is None:
+            self._latest_sent_at = time.monotonic()
+            self.send_encoded(message)
+            return
+
+        self._latest = message
+        self._latest_partial = partial
+        if self._latest_timer is None:
+            self._latest_timer = asyncio.get_running_loop().call_later(
+                max(due, 0), self._flush_latest, context=detached()
+            )
+
+    def _flush_latest(self) -> None:
+        self._latest_timer = None
+        message, self._latest = self._latest, None
+
+        if message is not None:
+            self._latest_sent_at = time.monotonic()
+            self.send_encoded(message)
+
+    async def serve(
+        self, on_message: Callable[[dict[str, Any]], Awaitable[None]]
+    ) -> None:
+        """
+        Run the connection until the client disconnects or is found dead.
+
+        Args:
+            on_message (Callable[[dict[str, Any]], Awaitable[None]]): Called for every message received.
+        """
+
+        tasks = {
+            asyncio.create_task(self._write_loop()),
+            asyncio.create_task(self._heartbeat_loop()),
+        }
+        dead = asyncio.create_task(self._dead.wait())
+        disconnected = False
+
+        try:
+            while not self.closed:
+                receive = asyncio.create_task(self.websocket.receive_text())
+                _ = await asyncio.wait(
+                    {receive, dead}, return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if not receive.done():
+                    _ = receive.cancel()
+                    break
+
+                for message in self._decode(receive.result()):
+                    await on_message(message)
+        except WebSocketDisconnect:
+            logger.debug("Client disconnected")
+            disconnected = True
+        except Exception as e:
+            logger.exception("Websocket connection failed: %s", e)
+        finally:
+            for task in (*tasks, dead):
+                _ = task.cancel()
+
+            self._close()
+
+            if not disconnected:
+                with suppress(Exception):
+                    await self.websocket.close()
+
+    def _decode(self, data: str) -> list[dict[str, Any]]:
+        try:
+            decoded = json.loads(data)
+            if not self.framed:
+                return [decoded]
+
+            # SockJS clients send an array of JSON encoded messages
+            return [json.loads(message) for message in decoded]
+        except (ValueError, TypeError):
+            logger.warning("Received invalid data: %s", data)
+            return []
+
+    async def _write_loop(self) -> None:
+        while True:
+            _ = await self._ready.wait()
+            self._ready.clear()
+
+            messages = list(self._queue)
+            self._queue.clear()
+            send_spans, self._send_spans = self._send_spans, []
+
+            if not messages:
+                # Any frame resets the client's heartbeat timer, so only send one when idle
+                frames = ["h"] if self._heartbeat_due else []
+            elif self.framed:
+                # The messages are already JSON, so the frame is built by hand
+                frames = ["a[" + ",".join(map(json.dumps, messages)) + "]"]
+            else:
+                frames = messages
+
+            self._heartbeat_due = False
+
+            for frame in frames:
+                if not await self._write(frame):
+                    for send_span in send_spans:
+                        send_span.end(failed=True)
+                    return
+
+            for send_span in send_spans:
+                send_span.end(batched=len(messages))
+
+    async def _heartbeat_loop(self) -> None:
+        if not self.framed:
+            # Raw websockets have no heartbeat frame, the server's ping/pong takes over
+            return
+
+        # Heartbeats go through the writer, so frames are never sent concurrently
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            self._heartbeat_due = True
+            self._ready.set()
+
+    async def _write(self, frame: str) -> bool:
+        try:
+            await asyncio.wait_for(self.websocket.send_text(frame), SEND_TIMEOUT)
+        except Exception as e:  # Client disconnected or stalled
+            logger.info("Could not send to client: %r", e)
+            self._close()
+            return False
+
+        if self.meter is not None:
+            self.meter.record(frame)
+
+        return True
+
+    def _close(self) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+        self._queue.clear()
+        self._latest = None
+        if self._latest_timer is not None:
+            self._latest_timer.cancel()
+        for send_span in self._send_spans:
+            send_span.end(failed=True)
+        self._send_spans.clear()
+        self._dead.set()
+        self.on_close(self)
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+from collections.abc import Hashable
+from typing import Any, Callable
+
+from fastapi import Request, Response
+
+# Responses smaller than this are not worth compressing, in bytes
+GZIP_MIN_SIZE: int = 512
+
+
+class StaticResponse:
+    """
+    A JSON response that is rendered to bytes once and served as is.
+
+    The response is rendered again only when the value returned by inputs changes.
+    It carries a strong ETag, answers conditional requests with 304 and keeps a
+    pre-compressed gzip variant for clients accepting it.
+    """
+
+    _responses: list[StaticResponse] = []
+
+    def __init__(
+        self,
+        build: Callable[[], Any],
+        inputs: Callable[[], Hashable] = lambda: None,
+    ):
+        """
+        Args:
+            build (Callable[[], Any]): Builds the JSON content of the response.
+            inputs (Callable[[], Hashable]): Returns everything the content depends on.
+        """
+
+        self.build: Callable[[], Any] = build
+        self.inputs: Callable[[], Hashable] = inputs
+
+        self._rendered_inputs: Hashable = None
+        self.body: bytes | None = None
+        self.gzip_body: bytes | None = None
+        self.etag: str = ""
+
+        StaticResponse._responses.append(self)
+
+    @classmethod
+    def render_all(cls) -> None:
+        """
+        Render all responses ahead of the first request.
+        """
+
+        for response in cls._responses:
+            response.render()
+
+    def render(self) -> None:
+        """
+        Render the response from the current inputs.
+        """
+
+        self._rendered_inputs = self.inputs()
+        self.body = json.dumps(
+            self.build(), separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+        compressed = gzip.compress(self.body, mtime=0)
+        self.gzip_body = (
+            compressed
+            if len(self.body) >= GZIP_MIN_SIZE and len(compressed) < len(self.body)
+            else None
+        )
+
+    def respond(self, request: Request) -> Response:
+        """
+        Serve the response, rendering it first if its inputs changed.
+
+        Args:
+            request (Request): The request to answer.
+
+        Returns:
+            Response: The response, or a 304 response if the client's copy is current.
+        """
+
+        if self.body is None or self.inputs() != self._rendered_inputs:
+            self.render()
+
+        use_gzip = self.gzip_body is not None and "gzip" in request.headers.get(
+            "accept-encoding", ""
+        )
+        # Each representation needs its own strong ETag
+        etag = self.etag[:-1] + '-gzip"' if use_gzip else self.etag
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None and (
+            if_none_match.strip() == "*"
+            or etag in (tag.strip() for tag in if_none_match.split(","))
+        ):
+            return Response(status_code=304, headers=headers)
+
+        if use_gzip:
+            headers["Content-Encoding"] = "gzip"
+
+        return Response(
+            content=self.gzip_body if use_gzip else self.body,
+            media_type="application/json",
+            headers=headers,
+        )
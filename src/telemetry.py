@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from array import array
+from typing import Any
+
+from data_poller import DataPoller
+
+# PrinterStatus attributes that are recorded
+FIELDS: tuple[str, ...] = (
+    "temp_bed",
+    "target_bed",
+    "temp_nozzle",
+    "target_nozzle",
+    "z_height",
+    "flow",
+    "speed",
+    "fan_hotend_rpm",
+    "fan_print_rpm",
+)
+
+# Resolution in seconds and number of buckets of each ring, finest first:
+# 2 s for an hour, 1 min for three days and 15 min for 30 days
+RESOLUTIONS: tuple[tuple[float, int], ...] = ((2.0, 1800), (60.0, 4320), (900.0, 2880))
+
+# Age after which the poller's status is not sampled anymore, in seconds
+STALE_AFTER: float = 10.0
+
+
+class TelemetryRing:
+    """
+    Fixed-size ring of time buckets keeping min, max and average of every field.
+    """
+
+    def __init__(self, resolution: float, capacity: int):
+        """
+        Args:
+            resolution (float): The width of a bucket in seconds.
+            capacity (int): The number of buckets kept.
+        """
+
+        self.resolution: float = resolution
+        self.capacity: int = capacity
+
+        # Number of the bucket stored in each slot, -1 if the slot is empty
+        self.buckets: array[int] = array("q", [-1]) * capacity
+        self.counts: array[int] = array("I", [0]) * capacity
+        self.minimum: list[array[float]] = [
+            array("d", [0.0]) * capacity for _ in FIELDS
+        ]
+        self.maximum: list[array[float]] = [
+            array("d", [0.0]) * capacity for _ in FIELDS
+        ]
+        self.total: list[array[float]] = [array("d", [0.0]) * capacity for _ in FIELDS]
+
+    @property
+    def retention(self) -> float:
+        """
+        The time span covered by the ring in seconds.
+        """
+        return self.resolution * self.capacity
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        The size of the ring's buffers in bytes.
+        """
+        return sum(
+            column.itemsize * self.capacity
+            for column in (
+                self.buckets,
+                self.counts,
+                *self.minimum,
+                *self.maximum,
+                *self.total,
+            )
+        )
+
+    def add(self, timestamp: float, values: tuple[float, ...]) -> None:
+        """
+        Add a sample to its bucket, replacing the bucket the slot held before.
+
+        Args:
+            timestamp (float): The time of the sample.
+            values (tuple[float, ...]): The value of every field, in the order of FIELDS.
+        """
+
+        bucket = int(timestamp // self.resolution)
+        slot = bucket % self.capacity
+
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+
+        first = self.counts[slot] == 0
+        self.counts[slot] += 1
+
+        for index, value in enumerate(values):
+            if first:
+                self.minimum[index][slot] = value
+                self.maximum[index][slot] = value
+                self.total[index][slot] = value
+            else:
+                self.minimum[index][slot] = min(self.minimum[index][slot], value)
+                self.maximum[index][slot] = max(self.maximum[index][slot], value)
+                self.total[index][slot] += value
+
+    def query(self, since: float, until: float, points: int) -> dict[str, Any]:
+        """
+        Read the buckets of a time window, merging neighbouring buckets to stay
+        within the point budget.
+
+        Args:
+            since (float): The start of the window.
+            until (float): The end of the window.
+            points (int): The maximum number of points returned.
+
+        Returns:
+            dict[str, Any]: The resolution and the columns of the points.
+        """
+
+        last = int(until // self.resolution)
+        first = max(int(since // self.resolution), last - self.capacity + 1)
+        merge = max(1, math.ceil((last - first + 1) / points))
+
+        result: dict[str, Any] = {
+            "resolution": self.resolution * merge,
+            "time": [],
+        } | {field: {"min": [], "max": [], "avg": []} for field in FIELDS}
+
+        group: int | None = None
+        count = 0
+        minimum = [0.0] * len(FIELDS)
+        maximum = [0.0] * len(FIELDS)
+        total = [0.0] * len(FIELDS)
+
+        def emit(group: int) -> None:
+            result["time"].append(group * merge * self.resolution)
+            for index, field in enumerate(FIELDS):
+                result[field]["min"].append(minimum[index])
+                result[field]["max"].append(maximum[index])
+                result[field]["avg"].append(total[index] / count)
+
+        for bucket in range(first, last + 1):
+            slot = bucket % self.capacity
+            if self.buckets[slot] != bucket or self.counts[slot] == 0:
+                continue
+
+            if bucket // merge != group:
+                if group is not None:
+                    emit(group)
+                group = bucket // merge
+                count = 0
+
+            for index in range(len(FIELDS)):
+                if count == 0:
+                    minimum[index] = self.minimum[index][slot]
+                    maximum[index] = self.maximum[index][slot]
+                    total[index] = self.total[index][slot]
+                else:
+                    minimum[index] = min(minimum[index], self.minimum[index][slot])
+                    maximum[index] = max(maximum[index], self.maximum[index][slot])
+                    total[index] += self.total[index][slot]
+            count += self.counts[slot]
+
+        if group is not None:
+            emit(group)
+
+        return result
+
+
+class TelemetryStore:
+    """
+    Embedded time series of the printer status at several resolutions.
+
+    The poller's latest status is sampled at the finest resolution and added to every
+    ring, so the coarser rollups are always up to date without any background work.
+    Memory is fixed by RESOLUTIONS, and queries read the coarsest ring needed for the
+    window, never the raw samples of long windows.
+    """
+
+    _instance: TelemetryStore | None = None
+
+    def __init__(self, printer: str):
+        TelemetryStore._instance = self
+
+        self.printer: str = printer
+        self.rings: list[TelemetryRing] = [
+            TelemetryRing(resolution, capacity) for resolution, capacity in RESOLUTIONS
+        ]
+        self._sample_task: asyncio.Task[None] | None = None
+
+    @classmethod
+    def get_instance(cls) -> TelemetryStore:
+        if cls._instance is None:
+            raise ValueError("TelemetryStore instance not initialized")
+        return cls._instance
+
+    async def start(self) -> None:
+        """
+        Start sampling the poller's printer status.
+        """
+
+        self._sample_task = asyncio.create_task(self._sample_loop())
+
+    async def stop(self) -> None:
+        """
+        Stop sampling.
+        """
+
+        if self._sample_task:
+            _ = self._sample_task.cancel()
+            self._sample_task = None
+
+    def add(self, timestamp: float, values: tuple[float, ...]) -> None:
+        """
+        Add a sample to every ring.
+
+        Args:
+            timestamp (float): The time of the sample.
+            values (tuple[float, ...]): The value of every field, in the order of FIELDS.
+        """
+
+        for ring in self.rings:
+            ring.add(timestamp, values)
+
+    def query(
+        self, since: float, until: float | None = None, points: int = 500
+    ) -> dict[str, Any]:
+        """
+        Query a time window, from the finest ring covering it within the point budget.
+
+        Args:
+            since (float): The start of the window.
+            until (float | None): The end of the window, defaults to now.
+            points (int): The maximum number of points returned.
+
+        Returns:
+            dict[str, Any]: The printer, the resolution and the columns of the points.
+        """
+
+        until = time.time() if until is None else until
+        window = max(until - since, 0.0)
+
+        ring = next(
+            (
+                ring
+                for ring in self.rings
+                if ring.retention >= window and window / ring.resolution <= points
+            ),
+            self.rings[-1],
+        )
+
+        return {"printer": self.printer} | ring.query(since, until, points)
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Describe the rings and the memory they use.
+
+        Returns:
+            dict[str, Any]: The resolution, retention and size of every ring.
+        """
+
+        return {
+            "printer": self.printer,
+            "fields": list(FIELDS),
+            "rings": [
+                {
+                    "resolution": ring.resolution,
+                    "retention": ring.retention,
+                    "memoryBytes": ring.memory_bytes,
+                }
+                for ring in self.rings
+            ],
+            "memoryBytes": sum(ring.memory_bytes for ring in self.rings),
+        }
+
+    async def _sample_loop(self) -> None:
+        data_poller = DataPoller.get_instance()
+        interval = self.rings[0].resolution
+
+        while True:
+            await asyncio.sleep(interval - time.time() % interval)
+
+            status = data_poller.printer_status
+            polled_at = data_poller.polled_at
+            if (
+                status is None
+                or polled_at is None
+                or time.monotonic() - polled_at > STALE_AFTER
+            ):
+                continue
+
+            self.add(
+                time.time(), tuple(float(getattr(status, field)) for field in FIELDS)
+            )
@@ -0,0 +1,481 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+from data_poller import DataPoller
+from print_job import PrintJob
+from printer_status import PrinterState, PrinterStatus
+from prusa_link import PrusaLink
+from tracing import detached
+
+logger = logging.getLogger(__name__)
+
+# Smallest rise of the nozzle counted as a new layer, in millimeters
+MIN_LAYER_STEP: float = 0.05
+
+# Frame rate of the rendered videos
+FRAMES_PER_SECOND: int = 25
+
+# Scheduling priority of the render process and the number of threads it may use
+RENDER_NICENESS: int = 19
+RENDER_THREADS: int = 1
+
+# Time a snapshot from the configured camera URL may take, in seconds
+SNAPSHOT_TIMEOUT: float = 5.0
+
+VIDEO_EXTENSION: str = ".mp4"
+
+SAFE_NAME_PATTERN: re.Pattern[str] = re.compile(r"[^\w.-]+")
+
+
+class Timelapse:
+    """
+    Records a timelapse of every print, one frame per layer.
+
+    Layer changes are detected from the z height of the status updates. The subscriber
+    only compares heights and starts the capture as a task, skipping the layer while
+    the previous capture is still running, so it never delays the poll loop. Frames are
+    written to disk on a thread. When the print has ended, ffmpeg renders the frames to
+    a video in its own process, one render at a time, at the lowest scheduling priority
+    and with RENDER_THREADS threads, so it cannot starve serving clients.
+    """
+
+    _instance: Timelapse | None = None
+
+    def __init__(
+        self, directory: Path, link: PrusaLink, snapshot_url: str | None = None
+    ):
+        """
+        Args:
+            directory (Path): The directory of the videos, frames are kept below it.
+            link (PrusaLink): The printer, used for snapshots if no URL is given.
+            snapshot_url (str | None): The URL of a camera snapshot.
+        """
+
+        Timelapse._instance = self
+
+        self.directory: Path = directory
+        self.frames_directory: Path = directory / "frames"
+        self.link: PrusaLink = link
+        self.snapshot_url: str | None = snapshot_url
+
+        # Name of the timelapse being recorded
+        self.recording: str | None = None
+        self.frames: int = 0
+        self.skipped_frames: int = 0
+        self.rendering: set[str] = set()
+
+        self._print_id: int | None = None
+        self._layer_z: float | None = None
+        self._snapshot_failed: bool = False
+        self._capture_task: asyncio.Task[None] | None = None
+        self._render_tasks: set[asyncio.Task[None]] = set()
+        self._render_lock: asyncio.Lock = asyncio.Lock()
+        self._client: httpx.AsyncClient | None = None
+
+    @classmethod
+    def get_instance(cls) -> Timelapse:
+        if cls._instance is None:
+            raise ValueError("Timelapse instance not initialized")
+        return cls._instance
+
+    async def start(self) -> None:
+        """
+        Create the directories and the client for the camera URL.
+        """
+
+        await asyncio.to_thread(
+            self.frames_directory.mkdir, parents=True, exist_ok=True
+        )
+
+        if self.snapshot_url is not None:
+            self._client = httpx.AsyncClient(timeout=SNAPSHOT_TIMEOUT)
+
+    async def stop(self) -> None:
+        """
+        Cancel the running capture and renders. Unrendered frames are kept.
+        """
+
+        if self._capture_task:
+            _ = self._capture_task.cancel()
+
+        for task in list(self._render_tasks):
+            _ = task.cancel()
+
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    async def handle_status(self, update: PrintJob | PrinterStatus) -> None:
+        """
+        Capture a frame when the printer started a new layer.
+        Subscriber to DataPoller.Event.PRINTER_STATUS
+
+        Args:
+            update (PrinterStatus): The new printer status.
+        """
+
+        if not isinstance(update, PrinterStatus):
+            raise ValueError("handle_status was called without a PrinterStatus")
+
+        current_print = DataPoller.get_instance().current_print
+        if update.state != PrinterState.PRINTING or current_print is None:
+            return
+
+        if current_print.print_id != self._print_id:
+            self._begin(current_print)
+
+        # Z-hops on travel moves can move this ahead of the layer, skipping a few frames
+        if (
+            self._layer_z is not None
+            and update.z_height < self._layer_z + MIN_LAYER_STEP
+        ):
+            return
+
+        self._layer_z = update.z_height
+
+        if self._capture_task is not None and not self._capture_task.done():
+            self.skipped_frames += 1
+            return
+
+        assert self.recording is not None
+        self._capture_task = asyncio.create_task(
+            self._capture(self.recording), context=detached()
+        )
+
+    async def handle_job_end(self, update: PrintJob | PrinterStatus) -> None:
+        """
+        Render the timelapse of the print that ended.
+        Subscriber to DataPoller.Event.PRINT_JOB_ENDED
+
+        Args:
+            update (PrintJob): The finished print job.
+        """
+
+        if not isinstance(update, PrintJob):
+            raise ValueError("handle_job_end was called without a PrintJob")
+
+        if update.print_id != self._print_id or self.recording is None:
+            return
+
+        logger.info(
+            "Timelapse %s recorded %d frames, skipped %d",
+            self.recording,
+            self.frames,
+            self.skipped_frames,
+        )
+
+        task = asyncio.create_task(
+            self._render(self.recording, self._capture_task), context=detached()
+        )
+        self._render_tasks.add(task)
+        task.add_done_callback(self._render_tasks.discard)
+
+        self.recording = None
+        self._print_id = None
+
+    async def list_timelapses(self, unrendered: bool = False) -> dict[str, Any]:
+        """
+        List the timelapses in the format of OctoPrint's timelapse API.
+
+        Args:
+            unrendered (bool): Also list the recordings that have not been rendered.
+
+        Returns:
+            dict[str, Any]: The timelapse configuration, videos and unrendered recordings.
+        """
+
+        files, recordings = await asyncio.to_thread(self._scan, unrendered)
+
+        result: dict[str, Any] = {
+            "config": {
+                "type": "zchange",
+                "fps": FRAMES_PER_SECOND,
+                "postRoll": 0,
+                "retractionZHop": 0,
+                "minDelay": 0,
+            },
+            "enabled": True,
+            "files": files,
+        }
+
+        if unrendered:
+            result["unrendered"] = recordings
+
+        return result
+
+    def video_path(self, filename: str) -> Path | None:
+        """
+        Get the path of a rendered video.
+
+        Args:
+            filename (str): The file name of the video.
+
+        Returns:
+            Path | None: The path, or None if there is no such video.
+        """
+
+        if not _is_safe_name(filename) or not filename.endswith(VIDEO_EXTENSION):
+            return None
+
+        path = self.directory / filename
+        return path if path.is_file() else None
+
+    async def delete(self, filename: str) -> bool:
+        """
+        Delete a rendered video.
+
+        Args:
+            filename (str): The file name of the video.
+
+        Returns:
+            bool: True if the video was deleted, False if there is no such video.
+        """
+
+        if (path := self.video_path(filename)) is None:
+            return False
+
+        await asyncio.to_thread(path.unlink, missing_ok=True)
+        return True
+
+    async def delete_unrendered(self, name: str) -> bool:
+        """
+        Delete the frames of a recording that is neither recording nor rendering.
+
+        Args:
+            name (str): The name of the recording.
+
+        Returns:
+            bool: True if the frames were deleted, False otherwise.
+        """
+
+        if (
+            not _is_safe_name(name)
+            or name == self.recording
+            or name in self.rendering
+            or not (self.frames_directory / name).is_dir()
+        ):
+            return False
+
+        await asyncio.to_thread(shutil.rmtree, self.frames_directory / name, True)
+        return True
+
+    def _begin(self, print_job: PrintJob) -> None:
+        stem = Path(print_job.display_name).stem
+        name = f"{SAFE_NAME_PATTERN.sub('_', stem)}_{time.strftime('%Y%m%d%H%M%S')}"
+
+        self.recording = name
+        self.frames = 0
+        self.skipped_frames = 0
+        self._print_id = print_job.print_id
+        self._layer_z = None
+        self._snapshot_failed = False
+
+    async def _capture(self, name: str) -> None:
+        if (snapshot := await self._snapshot()) is None:
+            if not self._snapshot_failed:
+                logger.error("Could not take a snapshot for timelapse %s", name)
+                self._snapshot_failed = True
+            return
+
+        content, content_type = snapshot
+        extension = "png" if "png" in content_type else "jpg"
+        path = self.frames_directory / name / f"{self.frames:06d}.{extension}"
+
+        try:
+            await asyncio.to_thread(_write_frame, path, content)
+        except OSError as e:
+            logger.error("Could not write timelapse frame: %s", e)
+            return
+
+        # Counted once written, ffmpeg stops reading at the first gap in the numbers
+        self.frames += 1
+
+    async def _snapshot(self) -> tuple[bytes, str] | None:
+        if self._client is None or self.snapshot_url is None:
+            return await self.link.get_snapshot()
+
+        try:
+            response = await self._client.get(self.snapshot_url)
+            _ = response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error("Could not get a snapshot from %s: %r", self.snapshot_url, e)
+            return None
+
+        return response.content, response.headers.get("content-type", "")
+
+    async def _render(self, name: str, capture: asyncio.Task[None] | None) -> None:
+        if capture is not None and not capture.done():
+            _ = await asyncio.wait({capture})
+
+        async with self._render_lock:
+            self.rendering.add(name)
+            try:
+                rendered = await self._run_ffmpeg(name)
+            finally:
+                self.rendering.discard(name)
+
+        if rendered:
+            await asyncio.to_thread(shutil.rmtree, self.frames_directory / name, True)
+
+    async def _run_ffmpeg(self, name: str) -> bool:
+        frames = self.frames_directory / name
+        images = sorted(await asyncio.to_thread(_list_dir, frames))
+        if not images:
+            await asyncio.to_thread(shutil.rmtree, frames, True)
+            return False
+
+        extension = images[0].rsplit(".", 1)[-1]
+        output = self.directory / f"{name}{VIDEO_EXTENSION}"
+        partial = self.directory / f".{name}{VIDEO_EXTENSION}.part"
+
+        try:
+            # Started through nice, so the threads ffmpeg spawns inherit the priority
+            process = await asyncio.create_subprocess_exec(
+                "nice",
+                "-n",
+                str(RENDER_NICENESS),
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-framerate",
+                str(FRAMES_PER_SECOND),
+                "-i",
+                str(frames / f"%06d.{extension}"),
+                "-threads",
+                str(RENDER_THREADS),
+                "-filter_threads",
+                str(RENDER_THREADS),
+                # libx264 needs even dimensions
+                "-vf",
+                "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-c:v",
+                "libx264",
+                "-preset",
+                "veryfast",
+                "-pix_fmt",
+                "yuv420p",
+                "-f",
+                "mp4",
+                str(partial),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            logger.error("nice is not installed, timelapse %s not rendered", name)
+            return False
+
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            partial.unlink(missing_ok=True)
+            raise
+
+        if process.returncode == 127:
+            logger.error("ffmpeg is not installed, timelapse %s not rendered", name)
+            partial.unlink(missing_ok=True)
+            return False
+
+        if process.returncode != 0:
+            logger.error(
+                "Rendering timelapse %s failed: %s", name, stderr.decode()[-500:]
+            )
+            partial.unlink(missing_ok=True)
+            return False
+
+        _ = partial.replace(output)
+        logger.info("Rendered timelapse %s", output.name)
+        return True
+
+    def _scan(
+        self, unrendered: bool
+    ) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        files: list[dict[str, Any]] = []
+        recordings: list[dict[str, Any]] = []
+
+        for path in sorted(self.directory.glob(f"*{VIDEO_EXTENSION}")):
+            stat = path.stat()
+            files.append(
+                {
+                    "name": path.name,
+                    "bytes": stat.st_size,
+                    "size": _formatted_size(stat.st_size),
+                    "date": _formatted_date(stat.st_mtime),
+                    "timestamp": stat.st_mtime,
+                    "url": f"/downloads/timelapse/{path.name}",
+                }
+            )
+
+        if not unrendered:
+            return files, recordings
+
+        for directory in sorted(self.frames_directory.iterdir()):
+            if not directory.is_dir():
+                continue
+
+            stats = [frame.stat() for frame in directory.iterdir()]
+            size = sum(stat.st_size for stat in stats)
+            modified = max(
+                (stat.st_mtime for stat in stats), default=directory.stat().st_mtime
+            )
+            rendering = (
+                directory.name in self.rendering
+                or (
+                    self.directory / f".{directory.name}{VIDEO_EXTENSION}.part"
+                ).exists()
+            )
+
+            recordings.append(
+                {
+                    "name": directory.name,
+                    "bytes": size,
+                    "size": _formatted_size(size),
+                    "date": _formatted_date(modified),
+                    "timestamp": modified,
+                    "recording": directory.name == self.recording,
+                    "rendering": rendering,
+                    "processing": rendering,
+                }
+            )
+
+        return files, recordings
+
+
+def _is_safe_name(name: str) -> bool:
+    return bool(name) and not name.startswith(".") and "/" not in name
+
+
+def _write_frame(path: Path, content: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _ = path.write_bytes(content)
+
+
+def _list_dir(path: Path) -> list[str]:
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+
+def _formatted_size(size: float) -> str:
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:3.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def _formatted_date(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import Context, ContextVar, copy_context
+from pathlib import Path
+from typing import Any
+
+from config import DATA_DIR, TRACE_SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+TRACE_PATH: Path = DATA_DIR / "traces.jsonl"
+
+# Size at which the trace file is rotated, and the number of rotated files kept
+TRACE_FILE_MAX_BYTES: int = 5 * 1024 * 1024
+TRACE_FILE_BACKUPS: int = 3
+
+# Number of finished traces kept in memory for the slowest traces endpoint
+RECENT_TRACES: int = 500
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class Trace:
+    """
+    A tree of spans, exported once the root and all spans started under it have ended.
+    Spans started after that are not recorded.
+    """
+
+    def __init__(self, tracer: Tracer, name: str):
+        self.tracer: Tracer = tracer
+        self.trace_id: str = os.urandom(8).hex()
+        self.name: str = name
+        self.started_at: float = time.time()
+        self.started: float = time.perf_counter()
+        self.spans: list[dict[str, Any]] = []
+        self.exported: bool = False
+        self._open_spans: int = 0
+        self._next_span_id: int = 0
+
+    def _span_opened(self) -> int:
+        self._open_spans += 1
+        self._next_span_id += 1
+        return self._next_span_id
+
+    def _span_closed(self, span: dict[str, Any]) -> None:
+        self.spans.append(span)
+        self._open_spans -= 1
+
+        if self._open_spans == 0 and not self.exported:
+            self.exported = True
+            self.tracer.export(self)
+
+    def to_dict(self) -> dict[str, Any]:
+        root = next(span for span in self.spans if span["parent"] is None)
+
+        return {
+            "traceId": self.trace_id,
+            "name": self.name,
+            "start": self.started_at,
+            "duration": root["duration"],
+            "spans": sorted(self.spans, key=lambda span: span["start"]),
+        }
+
+
+class Span:
+    """
+    A timed operation within a trace. Used as context manager it becomes the parent of
+    spans started inside it, otherwise it has to be ended explicitly.
+    """
+
+    def __init__(self, trace: Trace, name: str, parent: int | None, **attributes: Any):
+        self.trace: Trace = trace
+        self.name: str = name
+        self.parent: int | None = parent
+        self.attributes: dict[str, Any] = attributes
+        self.span_id: int = trace._span_opened()
+        self._started: float = time.perf_counter()
+        self._ended: bool = False
+        self._token: Any = None
+
+    def __enter__(self) -> Span:
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        self.end()
+
+    def set(self, **attributes: Any) -> None:
+        """
+        Add attributes to the span.
+        """
+
+        self.attributes.update(attributes)
+
+    def end(self, **attributes: Any) -> None:
+        """
+        End the span.
+
+        Args:
+            **attributes (Any): Attributes to add to the span.
+        """
+
+        if self._ended:
+            return
+
+        self._ended = True
+        self.attributes.update(attributes)
+        now = time.perf_counter()
+
+        self.trace._span_closed(
+            {
+                "id": self.span_id,
+                "parent": self.parent,
+                "name": self.name,
+                # Milliseconds since the start of the trace
+                "start": round((self._started - self.trace.started) * 1000, 3),
+                "duration": round((now - self._started) * 1000, 3),
+                "attributes": self.attributes,
+            }
+        )
+
+
+class _NoopSpan:
+    """
+    Stands in for a span when the current operation is not sampled.
+    """
+
+    def __enter__(self) -> _NoopSpan:
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        pass
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def end(self, **attributes: Any) -> None:
+        pass
+
+
+NOOP_SPAN: _NoopSpan = _NoopSpan()
+
+
+class Tracer:
+    """
+    Samples traces and exports them to a rotating JSONL file.
+
+    Unsampled operations only cost a context variable lookup per span. Finished traces
+    are written on a dedicated thread and the most recent ones are kept in memory.
+    """
+
+    _instance: Tracer | None = None
+
+    def __init__(self, path: Path = TRACE_PATH, sample_rate: float = TRACE_SAMPLE_RATE):
+        Tracer._instance = self
+
+        self.path: Path = path
+        self.sample_rate: float = sample_rate
+        self.recent: deque[dict[str, Any]] = deque(maxlen=RECENT_TRACES)
+
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tracing"
+        )
+
+    @classmethod
+    def get_instance(cls) -> Tracer:
+        if cls._instance is None:
+            cls._instance = Tracer()
+        return cls._instance
+
+    def trace(self, name: str, **attributes: Any) -> Span | _NoopSpan:
+        """
+        Start a trace, if it is sampled.
+
+        Args:
+            name (str): The name of the root span.
+            **attributes (Any): Attributes of the root span.
+
+        Returns:
+            Span | _NoopSpan: The root span, to be used as context manager.
+        """
+
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+
+        return Span(Trace(self, name), name, None, **attributes)
+
+    def export(self, trace: Trace) -> None:
+        """
+        Keep a finished trace in memory and queue it for writing.
+
+        Args:
+            trace (Trace): The finished trace.
+        """
+
+        data = trace.to_dict()
+        self.recent.append(data)
+        _ = self._executor.submit(self._write, json.dumps(data) + "\n")
+
+    def slowest(self, limit: int) -> list[dict[str, Any]]:
+        """
+        Get the slowest of the recent traces.
+
+        Args:
+            limit (int): The maximum number of traces returned.
+
+        Returns:
+            list[dict[str, Any]]: The traces, slowest first.
+        """
+
+        return sorted(self.recent, key=lambda trace: trace["duration"], reverse=True)[
+            :limit
+        ]
+
+    def _write(self, line: str) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            if (
+                self.path.exists()
+                and self.path.stat().st_size + len(line) > TRACE_FILE_MAX_BYTES
+            ):
+                for index in range(TRACE_FILE_BACKUPS - 1, 0, -1):
+                    backup = self.path.with_name(f"{self.path.name}.{index}")
+                    if backup.exists():
+                        _ = backup.replace(
+                            self.path.with_name(f"{self.path.name}.{index + 1}")
+                        )
+                _ = self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+
+            with self.path.open("a") as file:
+                _ = file.write(line)
+        except OSError as e:
+            logger.error("Could not write trace: %s", e)
+
+
+def span(name: str, **attributes: Any) -> Span | _NoopSpan:
+    """
+    Start a child span of the current span. Used as context manager it ends with the
+    block, otherwise it has to be ended explicitly, for work finished elsewhere.
+
+    Args:
+        name (str): The name of the span.
+        **attributes (Any): Attributes of the span.
+
+    Returns:
+        Span | _NoopSpan: The span, or a no-op span if the current operation is not traced.
+    """
+
+    parent = _current_span.get()
+    if parent is None or parent.trace.exported:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, **attributes)
+
+
+def detached() -> Context:
+    """
+    Copy the current context without the current span, for tasks and callbacks that
+    outlive the operation starting them, so their spans do not reopen its trace.
+
+    Returns:
+        Context: The context to run the task or callback in.
+    """
+
+    context = copy_context()
+    _ = context.run(_current_span.set, None)
+    return context
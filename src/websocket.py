@@ -1,12 +1,32 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 import time
 from typing import Any
 
-from fastapi import WebSocket, WebSocketDisconnect
+from fastapi import WebSocket
 
+from config import WS_MEASURE_BANDWIDTH
+from data_poller import DataPoller
+from gcode_analysis import GcodeAnalyzer
+from gcode_cache import GcodeCache
 from print_job import PrintJob
 from printer_status import PrinterState, PrinterStatus
+from progress_model import ProgressModel
+from sockjs import SockJSConnection, encode
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Time since the last poll after which a new client triggers a refresh, in seconds
+SNAPSHOT_MAX_AGE: float = 10.0
+
+# Interval multiplied by a client's throttle factor, in seconds (OctoPrint's base rate)
+THROTTLE_BASE_INTERVAL: float = 0.5
+
+# Interval of the progress updates extrapolated between job polls, in seconds
+PROGRESS_INTERVAL: float = 1.0
 
 PAYLOAD_TEMPLATE = {
     "current": {
@@ -48,9 +68,6 @@ PAYLOAD_TEMPLATE = {
                 "name": "",
                 "display": "",
                 "path": "",
-                "type": "machinecode",
-                "typePath": ["machinecode", "gcode"],
-                "user": "prusa_admin",
             },
             "estimatedPrintTime": 0,
             "lastPrintTime": None,
@@ -67,13 +84,148 @@ PAYLOAD_TEMPLATE = {
 }
 
 
+CONNECTED_PAYLOAD = {
+    "connected": {
+        "version": "1.9.0",
+        "display_version": "1.9.0",
+        "branch": "master",
+        "module": "OctoPrint",
+        "apikey": "dummy",
+        "config_hash": "dummy",
+    }
+}
+
+
+STATE_TEXT: dict[PrinterState, str] = {
+    PrinterState.PRINTING: "Printing",
+    PrinterState.PAUSED: "Paused",
+    PrinterState.ERROR: "Error",
+}
+
+
+def state_payload(state: PrinterState, online: bool = True) -> dict[str, Any]:
+    """
+    Build the OctoPrint state object for a printer state.
+
+    Args:
+        state (PrinterState): The printer state.
+        online (bool): Whether the printer is reachable, the state is ignored if not.
+
+    Returns:
+        dict[str, Any]: The state text and flags.
+    """
+
+    if not online:
+        return {
+            "text": "Offline",
+            "flags": {
+                "operational": False,
+                "printing": False,
+                "closedOrError": True,
+                "error": False,
+                "paused": False,
+                "ready": False,
+                "sdReady": False,
+            },
+        }
+
+    return {
+        "text": STATE_TEXT.get(state, "Operational"),
+        "flags": {
+            "operational": state != PrinterState.ERROR,
+            "printing": state == PrinterState.PRINTING or state == PrinterState.PAUSED,
+            "closedOrError": state == PrinterState.ERROR,
+            "error": state == PrinterState.ERROR,
+            "paused": state == PrinterState.PAUSED,
+            "ready": state == PrinterState.READY,
+            "sdReady": True,
+        },
+    }
+
+
+class ClientSubscription:
+    """
+    Delivery settings a client chose with OctoPrint's throttle and subscribe messages.
+    """
+
+    def __init__(self):
+        # Multiple of THROTTLE_BASE_INTERVAL between current messages, None for unthrottled
+        self.throttle: int | None = None
+        # Whether the client wants current messages at all
+        self.state: bool = True
+        # Sections of the current message the client unsubscribed from
+        self.excluded_sections: frozenset[str] = frozenset()
+
+    @property
+    def min_interval(self) -> float:
+        """
+        The minimum time between current messages, in seconds.
+        """
+        return (self.throttle or 0) * THROTTLE_BASE_INTERVAL
+
+    def update(self, message: Any) -> bool:
+        """
+        Apply a throttle or subscribe message.
+
+        Args:
+            message (Any): The message sent by the client.
+
+        Returns:
+            bool: True if the message was a delivery setting, False otherwise.
+        """
+
+        if not isinstance(message, dict):
+            return False
+
+        if "throttle" in message:
+            try:
+                self.throttle = max(int(message["throttle"]), 1)
+            except (TypeError, ValueError):
+                logger.warning("Invalid throttle: %s", message["throttle"])
+            return True
+
+        if "subscribe" in message:
+            # Only current messages are sent, so the events and plugins subscriptions
+            # have nothing to filter. A boolean turns all messages on or off.
+            subscribe: Any = message["subscribe"]
+            state = (
+                subscribe.get("state", True)
+                if isinstance(subscribe, dict)
+                else subscribe is not False
+            )
+
+            # OctoPrint filters the logs and messages sections this way, any other
+            # section of the current message can be left out just the same
+            self.state = state is not False
+            self.excluded_sections = frozenset(
+                section
+                for section, wanted in (
+                    state if isinstance(state, dict) else {}
+                ).items()
+                if wanted is False
+            )
+            return True
+
+        return False
+
+
 class WebSocketHandler:
     _instance: WebSocketHandler | None = None
 
     def __init__(self):
         WebSocketHandler._instance = self
-        self.websockets: set[WebSocket] = set()
+        self.websockets: dict[SockJSConnection, ClientSubscription] = {}
         self.cached_payload: dict[str, Any] = PAYLOAD_TEMPLATE
+        # Encoding of the cached payload, None when it changed since
+        self.cached_encoded: str | None = encode(PAYLOAD_TEMPLATE)
+        self._optimistic_state: tuple[PrinterState, set[PrinterState], float] | None = (
+            None
+        )
+        # Monotonic time of the last update to the cached payload
+        self.updated_at: float | None = None
+        # Model of the current job's progress, corrected by every job poll
+        self.progress_model: ProgressModel | None = None
+        self._progress_task: asyncio.Task[None] | None = None
 
     @classmethod
     def get_instance(cls) -> WebSocketHandler:
@@ -81,80 +233,127 @@ class WebSocketHandler:
             cls._instance = WebSocketHandler()
         return cls._instance
 
-    async def register_ws(self, websocket: WebSocket) -> None:
+    async def start(self) -> None:
+        """
+        Start sending extrapolated progress updates between job polls.
+        """
+
+        self._progress_task = asyncio.create_task(self._progress_loop())
+
+    async def stop(self) -> None:
+        """
+        Stop sending extrapolated progress updates.
+        """
+
+        if self._progress_task:
+            _ = self._progress_task.cancel()
+            self._progress_task = None
+
+    async def register_ws(self, websocket: WebSocket, framed: bool = True) -> None:
         """
         Register a new WebSocket connection to receive updates.
 
         Args:
             websocket (WebSocket): The WebSocket connection to register.
+            framed (bool): Whether the client uses SockJS framing, False for raw websockets.
         """
 
-        await websocket.accept()
+        connection = SockJSConnection(websocket, framed, self.unregister_ws)
+        await connection.open()
 
         # Send the connected payload of OctoPrint
-        await websocket.send_json(
-            {
-                "connected": {
-                    "version": "1.9.0",
-                    "display_version": "1.9.0",
-                    "branch": "master",
-                    "module": "OctoPrint",
-                    "apikey": "dummy",
-                    "config_hash": "dummy",
-                }
-            }
-        )
+        connection.send(CONNECTED_PAYLOAD)
+
+        # Send the current snapshot, so the client does not wait for the next change
+        if self.updated_at is not None:
+            if self.cached_encoded is None:
+                self.cached_encoded = encode(self.cached_payload)
+            connection.send_encoded(self.cached_encoded)
 
-        self.websockets.add(websocket)
+        self.websockets[connection] = ClientSubscription()
 
-        # Keep the connection alive
-        try:
-            while True:
-                data = await websocket.receive_text()
-                print(f"Received data: {data}")
-        except WebSocketDisconnect:
-            print("Client disconnected")
-            await self.unregister_ws(websocket)
-        except Exception as e:
-            print(f"Error occurred: {e}")
-            await self.unregister_ws(websocket)
+        # Only refresh if the printer was not polled recently, other clients are unaffected
+        data_poller = DataPoller.get_instance()
+        if (
+            self.updated_at is None
+            or data_poller.polled_at is None
+            or time.monotonic() - data_poller.polled_at > SNAPSHOT_MAX_AGE
+        ):
+            data_poller.request_update(
+                DataPoller.Resource.STATUS, DataPoller.Resource.JOB
+            )
 
-    async def unregister_ws(self, websocket: WebSocket) -> None:
+        await connection.serve(lambda message: self.handle_message(connection, message))
+
+    def unregister_ws(self, connection: SockJSConnection) -> None:
         """
         Unregister a WebSocket connection.
 
         Args:
-            websocket (WebSocket): The WebSocket connection to unregister.
+            connection (SockJSConnection): The connection to unregister.
+        """
+
+        _ = self.websockets.pop(connection, None)
+
+    async def handle_message(self, connection: SockJSConnection, message: Any) -> None:
+        """
+        Handle a message sent by a client.
+
+        Args:
+            connection (SockJSConnection): The connection the message came from.
+            message (Any): The decoded message.
         """
 
-        self.websockets.remove(websocket)
+        if not isinstance(message, dict):
+            logger.debug("Ignoring malformed message: %s", message)
+            return
+
+        subscription = self.websockets.get(connection)
+        if subscription is not None and subscription.update(message):
+            return
+
+        if "auth" in message:
+            # Any session is accepted, like the login endpoint does
+            return
+
+        logger.debug("Received data: %s", message)
 
     async def handle_update(self, update_data: PrinterStatus | PrintJob) -> None:
         """
         Handle an update event.
-        Subscriber for DataPoller.Event.PRINTER_STATUS
+        Subscriber for DataPoller.Event.PRINTER_STATUS, PRINT_JOB and CONNECTION
 
         Args:
             data (dict[str, Any]): The update data.
         """
 
+        with span("ws.payload"):
+            current_payload = self._build_payload(update_data)
+
+        self.cached_payload = current_payload
+        self.updated_at = time.monotonic()
+
+        await self._broadcast(current_payload)
+
+    def _build_payload(self, update_data: PrinterStatus | PrintJob) -> dict[str, Any]:
         current_payload = self.cached_payload
         current_payload["current"]["serverTime"] = time.time()
 
         if isinstance(update_data, PrinterStatus):
-            current_payload["current"]["state"] = {
-                "text": "Operational",
-                "flags": {
-                    "operational": update_data.state != PrinterState.ERROR,
-                    "printing": update_data.state == PrinterState.PRINTING
-                    or update_data.state == PrinterState.PAUSED,
-                    "closedOrError": update_data.state == PrinterState.ERROR,
-                    "error": update_data.state == PrinterState.ERROR,
-                    "paused": update_data.state == PrinterState.PAUSED,
-                    "ready": update_data.state == PrinterState.READY,
-                    "sdReady": True,
-                },
-            }
+            state = update_data.state
+
+            if self._optimistic_state is not None:
+                shown_state, accepted_states, deadline = self._optimistic_state
+                if state in accepted_states or time.monotonic() > deadline:
+                    self._optimistic_state = None
+                else:
+                    # The printer has not caught up with the command yet
+                    state = shown_state
+
+            # Offline clients keep the last known values, marked offline
+            current_payload["current"]["state"] = state_payload(
+                state, DataPoller.get_instance().online is not False
+            )
             current_payload["current"]["realTimeStats"] = {
                 "toolhead": {
                     "speedMmPerS": update_data.speed,
@@ -177,33 +376,194 @@ class WebSocketHandler:
             ]
 
         else:
+            if (
+                self.progress_model is None
+                or self.progress_model.print_id != update_data.print_id
+            ):
+                self.progress_model = ProgressModel(update_data.print_id)
+            self.progress_model.observe(update_data)
+
+            file_path = update_data.path + "/" + update_data.display_name
+            analysis = GcodeAnalyzer.get_instance().lookup(update_data.file_path) or {}
             current_payload["current"]["job"] = {
                 "file": {
                     "name": update_data.display_name,
                     "display": update_data.display_name,
-                    "path": update_data.path + "/" + update_data.display_name,
-                    "type": "machinecode",
-                    "typePath": ["machinecode", "gcode"],
-                    "user": "prusa_admin",
+                    "path": file_path,
                     "origin": "sdcard",
                 },
-                "estimatedPrintTime": update_data.time_printing_seconds
-                + update_data.time_remaining_seconds,
+                "estimatedPrintTime": analysis.get(
+                    "estimatedPrintTime",
+                    update_data.time_printing_seconds
+                    + update_data.time_remaining_seconds,
+                ),
                 "lastPrintTime": None,
                 "user": "prusa_admin",
             }
             current_payload["current"]["progress"] = {
                 "completion": update_data.progress,
-                "filepos": 500,
+                "filepos": GcodeCache.get_instance().file_position(
+                    update_data.file_path, update_data.progress
+                )
+                or 0,
                 "printTime": update_data.time_printing_seconds,
                 "printTimeLeft": update_data.time_remaining_seconds,
                 "printTimeOrigin": "linear",
             }
 
-        self.cached_payload = current_payload
+        return current_payload
 
-        for websocket in self.websockets:
-            try:
-                await websocket.send_json(current_payload)
-            except Exception as e:  # Client disconnected
-                print(f"Error: {e}")
+    async def _progress_loop(self) -> None:
+        """
+        Advance the progress of the running job with the progress model and broadcast
+        it, so clients see a smoothly moving print time while the job is polled only
+        every few seconds. Only the server time and progress are sent, the rest of the
+        payload did not change and clients append every temperature they receive.
+        """
+
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+
+            if not self.websockets or self.progress_model is None:
+                continue
+
+            data_poller = DataPoller.get_instance()
+            job = data_poller.current_print
+            status = data_poller.printer_status
+            if (
+                not data_poller.online
+                or job is None
+                or not job.running
+                or job.print_id != self.progress_model.print_id
+                or status is None
+                or status.state != PrinterState.PRINTING
+                or self._optimistic_state is not None
+            ):
+                continue
+
+            estimate = self.progress_model.estimate(time.monotonic())
+            if estimate is None:
+                continue
+
+            current = self.cached_payload["current"]
+            current["serverTime"] = time.time()
+            current["progress"] = {
+                **current["progress"],
+                "completion": estimate.completion,
+                "filepos": GcodeCache.get_instance().file_position(
+                    job.file_path, estimate.completion
+                )
+                or 0,
+                "printTime": estimate.print_time,
+                "printTimeLeft": estimate.print_time_left,
+            }
+            self.cached_encoded = None
+
+            await self._broadcast(
+                {
+                    "current": {
+                        "serverTime": current["serverTime"],
+                        "progress": current["progress"],
+                    }
+                },
+                partial=True,
+            )
+
+    async def apply_optimistic_state(
+        self,
+        state: PrinterState,
+        accepted_states: set[PrinterState],
+        hold_seconds: float = 5.0,
+    ) -> None:
+        """
+        Broadcast a state the printer is expected to enter, before a poll confirms it.
+        The state is kept until the printer reports one of the accepted states or the hold time runs out.
+
+        Args:
+            state (PrinterState): The state to show.
+            accepted_states (set[PrinterState]): The printer states that confirm the command.
+            hold_seconds (float): How long to keep the state without confirmation.
+        """
+
+        self._optimistic_state = (
+            state,
+            accepted_states,
+            time.monotonic() + hold_seconds,
+        )
+
+        self.cached_payload["current"]["serverTime"] = time.time()
+        self.cached_payload["current"]["state"] = state_payload(state)
+        self.updated_at = time.monotonic()
+
+        await self._broadcast(self.cached_payload)
+
+    def bandwidth_report(self) -> dict[str, Any]:
+        """
+        Report the measured websocket traffic of the connected clients.
+
+        Returns:
+            dict[str, Any]: The traffic per client and the totals per hour.
+        """
+
+        clients = [
+            connection.meter.report()
+            for connection in self.websockets
+            if connection.meter is not None
+        ]
+
+        return {
+            "enabled": WS_MEASURE_BANDWIDTH,
+            "connections": len(self.websockets),
+            "clients": clients,
+            "rawBytesPerHour": sum(client["rawBytesPerHour"] for client in clients),
+            "wireBytesPerHour": sum(client["wireBytesPerHour"] for client in clients),
+            "compressMillisecondsPerHour": sum(
+                client["compressMillisecondsPerHour"] for client in clients
+            ),
+        }
+
+    async def _broadcast(self, payload: dict[str, Any], partial: bool = False) -> None:
+        """
+        Send a payload to all clients subscribed to the state.
+
+        Args:
+            payload (dict[str, Any]): The payload.
+            partial (bool): Whether the payload only carries some sections. It is then
+                not kept for new clients, and a full payload still waiting for a
+                throttled client is not replaced by it.
+        """
+
+        with span("ws.broadcast", clients=len(self.websockets)):
+            # Serialize once for all clients, sending only queues the message
+            payload_encoded = encode(payload)
+            if not partial:
+                self.cached_encoded = payload_encoded
+
+            # Clients leaving out the same sections share one encoding
+            encoded: dict[frozenset[str], str] = {frozenset(): payload_encoded}
+
+            for connection, subscription in list(self.websockets.items()):
+                if not subscription.state:
+                    continue
+
+                sections = subscription.excluded_sections
+                if partial and sections.issuperset(
+                    payload["current"].keys() - {"serverTime"}
+                ):
+                    # Nothing the client asked for
+                    continue
+
+                if sections not in encoded:
+                    encoded[sections] = encode(
+                        {
+                            "current": {
+                                key: value
+                                for key, value in payload["current"].items()
+                                if key not in sections
+                            }
+                        }
+                    )
+
+                connection.send_latest(
+                    encoded[sections], subscription.min_interval, partial=partial
+                )
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import time
+import zlib
+from collections.abc import Mapping
+from typing import Any
+
+try:
+    import ws_deflate
+except ImportError:  # websockets is an optional dependency of uvicorn
+    ws_deflate = None
+
+# uvicorn picks its default without it
+CompressedWebSocketProtocol = (
+    ws_deflate.CompressedWebSocketProtocol if ws_deflate is not None else None
+)
+
+__all__ = ["BandwidthMeter", "CompressedWebSocketProtocol", "compression_min_size"]
+
+
+def compression_min_size(scope: Mapping[str, Any]) -> int | None:
+    """
+    Find the size from which frames to a websocket client are compressed.
+
+    Args:
+        scope (Mapping[str, Any]): The ASGI scope of the websocket, after the handshake.
+
+    Returns:
+        int | None: The minimum size of compressed frames in bytes, or None if
+            permessage-deflate was not negotiated.
+    """
+
+    if ws_deflate is not None:
+        reported = scope.get("extensions", {}).get(ws_deflate.DEFLATE_EXTENSION)
+        if reported is not None:
+            return reported["minSize"] if reported["enabled"] else None
+
+    # uvicorn's own protocols accept permessage-deflate whenever the client offers it
+    offered = any(
+        name == b"sec-websocket-extensions" and b"permessage-deflate" in value
+        for name, value in scope.get("headers", [])
+    )
+    return 0 if offered else None
+
+
+def frame_header_size(payload_size: int) -> int:
+    # Frames from the server are not masked
+    if payload_size < 126:
+        return 2
+    if payload_size < 1 << 16:
+        return 4
+    return 10
+
+
+class BandwidthMeter:
+    """
+    Measures the bytes a websocket client receives on the wire, frame headers included.
+
+    When the connection negotiated permessage-deflate, frames the server compresses
+    are compressed again with a private deflate context, mirroring the connection's
+    context takeover, to measure the compressed size and the CPU time spent
+    compressing. All other frames count with their raw size.
+    """
+
+    def __init__(self, scope: Mapping[str, Any]):
+        """
+        Args:
+            scope (Mapping[str, Any]): The ASGI scope of the websocket. The negotiated
+                compression is read from it when the first frame is recorded.
+        """
+
+        self.scope: Mapping[str, Any] = scope
+        self.started_at: float = time.monotonic()
+        self.frames: int = 0
+        self.raw_bytes: int = 0
+        self.wire_bytes: int = 0
+        self.compress_seconds: float = 0.0
+        # Known after the handshake, None while unknown or not negotiated
+        self.min_size: int | None = None
+        self._encoder: Any = None
+
+    def record(self, frame: str) -> None:
+        """
+        Record a frame sent to the client.
+
+        Args:
+            frame (str): The frame.
+        """
+
+        data = frame.encode("utf-8")
+        self.frames += 1
+        self.raw_bytes += len(data)
+
+        if self.frames == 1:
+            self.min_size = compression_min_size(self.scope)
+            if self.min_size is not None:
+                self._encoder = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+        if self.min_size is None or len(data) < self.min_size:
+            self.wire_bytes += frame_header_size(len(data)) + len(data)
+            return
+
+        started = time.perf_counter()
+        compressed = self._encoder.compress(data) + self._encoder.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+        self.compress_seconds += time.perf_counter() - started
+        # The trailing empty block is stripped on the wire
+        payload_size = len(compressed) - 4
+        self.wire_bytes += frame_header_size(payload_size) + payload_size
+
+    def report(self) -> dict[str, float]:
+        """
+        Summarize the measured traffic.
+
+        Returns:
+            dict[str, float]: Totals and per-hour rates.
+        """
+
+        hours = max(time.monotonic() - self.started_at, 1.0) / 3600
+
+        return {
+            "permessageDeflate": self.min_size is not None,
+            "frames": self.frames,
+            "rawBytes": self.raw_bytes,
+            "wireBytes": self.wire_bytes,
+            "rawBytesPerHour": self.raw_bytes / hours,
+            "wireBytesPerHour": self.wire_bytes / hours,
+            "compressionRatio": self.wire_bytes / self.raw_bytes
+            if self.raw_bytes
+            else 1.0,
+            "compressMillisecondsPerHour": self.compress_seconds * 1000 / hours,
+        }
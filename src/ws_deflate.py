@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+from typing import Any
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import Frame, Opcode
+
+from config import WS_COMPRESSION_MIN_SIZE
+
+# Needs websockets, an optional dependency of uvicorn. Import the protocol from
+# ws_compression, which falls back to None when it is missing.
+
+# ASGI scope extension the protocol reports the negotiated compression in
+DEFLATE_EXTENSION: str = "websocket.permessage_deflate"
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that sends small messages uncompressed.
+
+    The RSV1 bit is set per message, so skipping compression for a message is
+    allowed and leaves the shared compression context untouched.
+    """
+
+    def __init__(self, min_size: int, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.min_size: int = min_size
+
+    def encode(self, frame: Frame) -> Frame:
+        if (
+            frame.opcode in (Opcode.TEXT, Opcode.BINARY)
+            and frame.fin
+            and len(frame.data) < self.min_size
+        ):
+            return frame
+
+        return super().encode(frame)
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    """
+    Negotiates permessage-deflate with context takeover, using ThresholdPerMessageDeflate.
+    """
+
+    def __init__(self, min_size: int):
+        super().__init__()
+        self.min_size: int = min_size
+
+    def process_request_params(self, params: Any, accepted_extensions: Any) -> Any:
+        response_params, extension = super().process_request_params(
+            params, accepted_extensions
+        )
+
+        return response_params, ThresholdPerMessageDeflate(
+            self.min_size,
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+        )
+
+
+class CompressedWebSocketProtocol(WebSocketProtocol):
+    """
+    uvicorn's websockets protocol with a size threshold for permessage-deflate.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [
+                ThresholdPerMessageDeflateFactory(WS_COMPRESSION_MIN_SIZE)
+            ]
+
+    async def ws_handler(self, protocol: Any, path: str) -> Any:
+        # Called once the handshake is done, so the extensions are negotiated
+        deflate = next(
+            (
+                extension
+                for extension in self.extensions
+                if isinstance(extension, PerMessageDeflate)
+            ),
+            None,
+        )
+        self.scope.setdefault("extensions", {})[DEFLATE_EXTENSION] = {
+            "enabled": deflate is not None,
+            "minSize": deflate.min_size
+            if isinstance(deflate, ThresholdPerMessageDeflate)
+            else 0,
+        }
+
+        return await super().ws_handler(protocol, path)